@@ -41,12 +41,23 @@ setup(
     entry_points={
         'console_scripts': [
             'smartmob-filestore = smartmob_filestore.__main__:entry_point',
+            'smartmob-filestore-benchmark ='
+            ' smartmob_filestore.benchmark.__main__:entry_point',
+            'smartmob-filestore-migrate ='
+            ' smartmob_filestore.migrate.__main__:entry_point',
+            'smartmob-filestore-rebalance ='
+            ' smartmob_filestore.rebalance.__main__:entry_point',
          ],
     },
     install_requires=[
         'aiohttp>=1,<2',
         'aiotk>=0.2,<0.3',
-        'fluent-logger>=0.4,<0.5',
+        'msgpack-python>=0.4,<1',
         'structlog>=16,<17',
     ],
+    extras_require={
+        'fast-logging': [
+            'ujson',
+        ],
+    },
 )
@@ -5,16 +5,55 @@ import aiohttp.web
 import aiotk
 import argparse
 import asyncio
-import fluent.sender
+import base64
+import binascii
+import bisect
+import collections
+import concurrent.futures
+import contextlib
+import cProfile
+import email.utils
+import errno
+import functools
+import gzip
+import hashlib
+import hmac
+import io
+import itertools
+import json
+import math
+import mimetypes
+import msgpack
 import timeit
 import sys
 import pkg_resources
+import random
+import re
+import signal
+import socket
+import sqlite3
 import structlog
+import threading
+import time
 import uuid
 import os
+import stat
+import struct
+import tarfile
+import zlib
 
 from datetime import datetime, timezone
-from urllib.parse import urlsplit
+from urllib.parse import parse_qsl, quote, unquote, urlsplit
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
 
 version = pkg_resources.resource_string('smartmob_filestore', 'version.txt')
@@ -22,6 +61,22 @@ version = version.decode('utf-8').strip()
 """Package version (as a dotted string)."""
 
 
+DURABILITY_MODES = ('none', 'fsync', 'group')
+"""Values of the ``--durability`` option."""
+
+LAYOUTS = ('flat', 'sharded')
+"""Values of the ``--layout`` option (see ``make_layout()``)."""
+
+BACKENDS = ('local', 'memory', 'pack')
+"""Values of the ``--backend`` option."""
+
+CLUSTER_ROUTING = ('redirect', 'proxy')
+"""Values of the ``--cluster-routing`` option (see ``Cluster``)."""
+
+PROFILE_FORMATS = {'collapsed': '.folded', 'pstats': '.pstats'}
+"""Values of the ``--profile-format`` option and their file extension."""
+
+
 cli = argparse.ArgumentParser(description="Run the HTTP file server.")
 cli.add_argument('--version', action='version', version=version,
                  help="Print version and exit.")
@@ -33,17 +88,164 @@ cli.add_argument('--logging-endpoint', action='store', dest='logging_endpoint',
                  default=None)
 cli.add_argument('--storage', action='store', dest='storage',
                  type=str, default='.')
+cli.add_argument('--backend', action='store', dest='backend',
+                 choices=BACKENDS, default='local',
+                 help="Where files are stored: in the storage root, in"
+                      " memory (see ``MemoryBackend``) or, for small files,"
+                      " in pack files (see ``PackBackend``).")
+cli.add_argument('--pack-max-size', action='store', dest='pack_max_size',
+                 type=int, default=16 * 1024,
+                 help="Size of the largest file stored in pack files.")
+cli.add_argument('--pack-segment-size', action='store',
+                 dest='pack_segment_size', type=int, default=64 * 1024 ** 2,
+                 help="Size at which pack files are sealed.")
+cli.add_argument('--layout', action='store', dest='layout',
+                 choices=LAYOUTS, default='flat',
+                 help="How files are arranged in the storage root (use"
+                      " smartmob-filestore-migrate to switch).")
+cli.add_argument('--io-threads', action='store', dest='io_threads',
+                 type=int, default=4,
+                 help="Number of threads used for file system access.")
+cli.add_argument('--partial-upload-ttl', action='store',
+                 dest='partial_upload_ttl', type=float, default=86400.0,
+                 help="Seconds after which unfinished resumable uploads are"
+                      " removed, when the server starts.")
+cli.add_argument('--archive-threads', action='store', dest='archive_threads',
+                 type=int, default=4,
+                 help="Number of archive uploads extracted at once.")
+cli.add_argument('--archive-read-timeout', action='store',
+                 dest='archive_read_timeout', type=float, default=60.0,
+                 help="Seconds an archive upload may stall before it fails"
+                      " with a 408.")
+cli.add_argument('--dedup', action='store_true', dest='dedup',
+                 default=False,
+                 help="Store identical files only once.")
+cli.add_argument('--cache-bytes', action='store', dest='cache_bytes',
+                 type=int, default=0,
+                 help="Memory budget for caching small files (0 disables).")
+cli.add_argument('--cache-max-object', action='store',
+                 dest='cache_max_object', type=int, default=256 * 1024,
+                 help="Size of the largest file that may be cached.")
+cli.add_argument('--max-uploads', action='store', dest='max_uploads',
+                 type=int, default=0,
+                 help="Maximum number of concurrent uploads, per process"
+                      " (0 means no limit).")
+cli.add_argument('--max-upload-bytes', action='store',
+                 dest='max_upload_bytes', type=int, default=0,
+                 help="Maximum size of concurrent uploads, per process"
+                      " (0 means no limit).")
+cli.add_argument('--upload-queue-timeout', action='store',
+                 dest='upload_queue_timeout', type=float, default=0.0,
+                 help="Seconds an upload may wait for its turn when over"
+                      " the limits before it's rejected (0 rejects it right"
+                      " away).")
+cli.add_argument('--durability', action='store', dest='durability',
+                 choices=DURABILITY_MODES, default='none',
+                 help="When uploads reach the disk, relative to their"
+                      " acknowledgement (see ``Durability``).")
+cli.add_argument('--group-commit-window', action='store',
+                 dest='group_commit_window', type=float, default=0.005,
+                 help="Seconds during which uploads join the same flush, in"
+                      " group commit mode.")
+cli.add_argument('--peer-token', action='store', dest='peer_token',
+                 default=None,
+                 help="Secret shared by the replication peers and cluster"
+                      " members, which only trust each other's requests"
+                      " when they carry it.")
+cli.add_argument('--replicate-to', action='append', dest='replicate_to',
+                 default=[], metavar='URL',
+                 help="Copy stored files to the smartmob-filestore server at"
+                      " this URL, in the background (repeat for several"
+                      " peers).")
+cli.add_argument('--replicas', action='store', dest='replicas',
+                 type=int, default=0,
+                 help="Number of peers that must store an upload before"
+                      " it's acknowledged (0 acknowledges it right away).")
+cli.add_argument('--replication-queue-size', action='store',
+                 dest='replication_queue_size', type=int, default=10000,
+                 help="Number of files that may wait for a peer before"
+                      " uploads are rejected.")
+cli.add_argument('--replication-timeout', action='store',
+                 dest='replication_timeout', type=float, default=30.0,
+                 help="Seconds an upload waits for --replicas peers before"
+                      " it fails with a 504 (the file is still stored and"
+                      " copied later).")
+cli.add_argument('--cluster-member', action='append',
+                 dest='cluster_members', default=[], metavar='URL',
+                 help="Base URL of a cluster member, including this server"
+                      " (repeat for each member).")
+cli.add_argument('--cluster-self', action='store', dest='cluster_self',
+                 default=None, metavar='URL',
+                 help="Base URL of this server among the cluster members.")
+cli.add_argument('--cluster-vnodes', action='store', dest='cluster_vnodes',
+                 type=int, default=64,
+                 help="Points of each member on the consistent hash ring.")
+cli.add_argument('--cluster-routing', action='store',
+                 dest='cluster_routing', choices=CLUSTER_ROUTING,
+                 default='redirect',
+                 help="Redirect requests for files owned by other members"
+                      " (307) or proxy them.")
+cli.add_argument('--compress', action='store_true', dest='compress',
+                 default=False,
+                 help="Store compressed copies of text files on upload.")
+cli.add_argument('--compress-min-size', action='store',
+                 dest='compress_min_size', type=int, default=1024,
+                 help="Size of the smallest file that may be compressed.")
+cli.add_argument('--metrics-port', action='store', dest='metrics_port',
+                 type=int, default=None,
+                 help="Serve Prometheus metrics on this port (worker N of"
+                      " the pool uses the next Nth port).")
+cli.add_argument('--metrics-host', action='store', dest='metrics_host',
+                 default='127.0.0.1',
+                 help="Address of the metrics port (loopback by default).")
+cli.add_argument('--fast-logging', action='store_true', dest='fast_logging',
+                 default=False,
+                 help="Use the faster log rendering pipeline (timestamps"
+                      " are always rendered with microseconds).")
+cli.add_argument('--profile-dir', action='store', dest='profile_dir',
+                 default=None, metavar='DIR',
+                 help="Profile the server on SIGUSR1 (or POST /profile on"
+                      " the metrics port) and write results here.")
+cli.add_argument('--profile-token', action='store', dest='profile_token',
+                 default=None,
+                 help="Secret that POST /profile requests must send in the"
+                      " X-Smartmob-Token header.")
+cli.add_argument('--profile-seconds', action='store', dest='profile_seconds',
+                 type=float, default=30.0,
+                 help="Duration of profiles started by SIGUSR1.")
+cli.add_argument('--profile-format', action='store', dest='profile_format',
+                 choices=sorted(PROFILE_FORMATS), default='collapsed',
+                 help="Sampled stacks for flame graphs or cProfile stats.")
+cli.add_argument('--timing-sample-rate', action='store',
+                 dest='timing_sample_rate', type=float, default=0.0,
+                 help="Fraction of the requests whose access log entry"
+                      " details the time spent in each stage.")
+cli.add_argument('--workers', action='store', dest='workers',
+                 type=int, default=1,
+                 help="Number of server processes sharing the socket.")
+cli.add_argument('--socket-fd', action='store', dest='socket_fd',
+                 type=int, default=None,
+                 help=argparse.SUPPRESS)
 
 
 class FluentLoggerFactory:
-    """For use with ``structlog.configure(logger_factory=...)``."""
+    """For use with ``structlog.configure(logger_factory=...)``.
+
+    Events are handed over to a ``FluentShipper`` so that logging never
+    waits on the FluentD socket.  The shipper can be tuned using query string
+    parameters in the logging endpoint URL:
+
+    - ``queue-size``: maximum number of events waiting to be shipped;
+    - ``batch-size``: maximum number of events sent at once;
+    - ``overflow``: one of ``drop-oldest``, ``drop-newest`` or ``block``.
+    """
 
     @classmethod
     def from_url(cls, url):
         parts = urlsplit(url)
         if parts.scheme != 'fluent':
             raise ValueError('Invalid URL: "%s".' % url)
-        if parts.query or parts.fragment:
+        if parts.fragment:
             raise ValueError('Invalid URL: "%s".' % url)
         netloc = parts.netloc.rsplit(':', 1)
         if len(netloc) == 1:
@@ -54,13 +256,20 @@ class FluentLoggerFactory:
                 port = int(port)
             except ValueError:
                 raise ValueError('Invalid URL: "%s".' % url)
-        return FluentLoggerFactory(parts.path[1:], host, port)
+        options = {}
+        for key, value in parse_qsl(parts.query, keep_blank_values=True):
+            try:
+                option, convert = FLUENT_OPTIONS[key]
+                options[option] = convert(value)
+            except (KeyError, ValueError):
+                raise ValueError('Invalid URL: "%s".' % url)
+        return FluentLoggerFactory(parts.path[1:], host, port, **options)
 
-    def __init__(self, app, host, port):
+    def __init__(self, app, host, port, **options):
         self._app = app
         self._host = host
         self._port = port
-        self._sender = fluent.sender.FluentSender(app, host=host, port=port)
+        self._shipper = FluentShipper(app, host, port, **options)
 
     @property
     def host(self):
@@ -74,18 +283,378 @@ class FluentLoggerFactory:
     def app(self):
         return self._app
 
+    @property
+    def shipper(self):
+        return self._shipper
+
+    def close(self):
+        """Ship all pending events and disconnect."""
+        self._shipper.close()
+
     def __call__(self):
-        return FluentLogger(self._sender)
+        return FluentLogger(self._shipper)
+
+
+def _overflow_policy(value):
+    if value not in FLUENT_OVERFLOW_POLICIES:
+        raise ValueError(value)
+    return value
+
+
+FLUENT_OVERFLOW_POLICIES = ('drop-oldest', 'drop-newest', 'block')
+"""Supported ways to handle events when the shipping queue is full."""
+
+FLUENT_OPTIONS = {
+    'queue-size': ('queue_size', int),
+    'batch-size': ('batch_size', int),
+    'overflow': ('overflow', _overflow_policy),
+}
+"""Query string parameters supported in FluentD logging endpoints."""
+
+
+class FluentShipper:
+    """Ship events to FluentD from a background thread, in batches.
+
+    Events are queued in a bounded, in-memory queue and a background thread
+    sends them using the Forward mode of the FluentD forward protocol (one
+    message per tag, with many entries).  When the queue is full, the
+    ``overflow`` policy decides whether to drop the oldest event, drop the
+    new event or block the caller until there is room.
+
+    Batches that cannot be delivered are dropped and counted as such, and
+    so are events that can't be serialized.
+
+    See:
+    - https://github.com/fluent/fluentd/wiki/Forward-Protocol-Specification-v0
+    """
+
+    def __init__(self, app, host, port, queue_size=10000, batch_size=100,
+                 overflow='drop-oldest', timeout=3.0):
+        self._app = app
+        self._host = host
+        self._port = port
+        self._queue_size = queue_size
+        self._batch_size = batch_size
+        self._overflow = overflow
+        self._timeout = timeout
+        self._events = collections.deque()
+        self._ready = threading.Condition()
+        self._thread = None
+        self._closed = False
+        self._socket = None
+        self._dropped = 0
+        self._batches = 0
+
+    @property
+    def dropped(self):
+        """Number of events discarded without being delivered."""
+        return self._dropped
+
+    @property
+    def batches(self):
+        """Number of batches successfully sent."""
+        return self._batches
+
+    def emit(self, label, data):
+        """Queue an event for shipping (doesn't perform any I/O)."""
+        tag = '.'.join((self._app, label)) if label else self._app
+        event = (tag, int(time.time()), data)
+        with self._ready:
+            if self._closed:
+                self._dropped += 1
+                return
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run)
+                self._thread.daemon = True
+                self._thread.start()
+            if len(self._events) >= self._queue_size:
+                if self._overflow == 'drop-newest':
+                    self._dropped += 1
+                    return
+                if self._overflow == 'drop-oldest':
+                    self._events.popleft()
+                    self._dropped += 1
+                else:
+                    while len(self._events) >= self._queue_size:
+                        self._ready.wait()
+            self._events.append(event)
+            self._ready.notify_all()
+
+    def close(self):
+        """Ship all pending events and stop the background thread."""
+        with self._ready:
+            self._closed = True
+            self._ready.notify_all()
+            thread = self._thread
+        if thread:
+            thread.join()
+
+    def _run(self):
+        while True:
+            with self._ready:
+                while not (self._events or self._closed):
+                    self._ready.wait()
+                if not self._events:
+                    break
+                size = min(self._batch_size, len(self._events))
+                batch = [self._events.popleft() for _ in range(size)]
+                self._ready.notify_all()
+            self._send(batch)
+        if self._socket:
+            self._socket.close()
+            self._socket = None
+
+    def _send(self, batch):
+        # Group consecutive events with the same tag into Forward messages.
+        packets = []
+        size = 0
+        for tag, events in itertools.groupby(batch, key=lambda e: e[0]):
+            entries = [[timestamp, data] for _, timestamp, data in events]
+            try:
+                packets.append(msgpack.packb([tag, entries]))
+            except Exception:
+                # Don't let one bad value stop the shipper thread.
+                self._dropped += len(entries)
+            else:
+                size += len(entries)
+        if not packets:
+            return
+        try:
+            if self._socket is None:
+                self._socket = socket.create_connection(
+                    (self._host, self._port), self._timeout,
+                )
+            self._socket.sendall(b''.join(packets))
+            self._batches += 1
+        except OSError:
+            if self._socket:
+                self._socket.close()
+                self._socket = None
+            self._dropped += size
 
 
 class FluentLogger:
     """Structlog logger that sends events to FluentD."""
 
-    def __init__(self, sender):
-        self._sender = sender
+    def __init__(self, shipper):
+        self._shipper = shipper
 
     def info(self, event, **kwds):
-        self._sender.emit(event, kwds)
+        self._shipper.emit(event, kwds)
+
+    warning = error = info
+
+
+class FileLoggerFactory:
+    """For use with ``structlog.configure(logger_factory=...)``.
+
+    Rendered events are handed over to a ``FileSink``, which writes them in
+    large blocks.  The sink can be tuned using query string parameters in
+    the logging endpoint URL:
+
+    - ``buffer-size``: number of bytes collected before writing (0 writes
+      each event immediately, the default for ``/dev/stdout`` and
+      ``/dev/stderr``);
+    - ``flush-interval``: maximum number of seconds an event is kept in the
+      buffer;
+    - ``max-bytes``: size at which the log file is rotated (0 disables
+      rotation);
+    - ``backups``: number of rotated log files that are kept.
+    """
+
+    @classmethod
+    def from_url(cls, url):
+        parts = urlsplit(url)
+        if parts.scheme != 'file' or parts.fragment:
+            raise ValueError('Invalid URL: "%s".' % url)
+        path = parts.netloc + parts.path
+        options = {}
+        for key, value in parse_qsl(parts.query, keep_blank_values=True):
+            try:
+                option, convert = FILE_OPTIONS[key]
+                options[option] = convert(value)
+            except (KeyError, ValueError):
+                raise ValueError('Invalid URL: "%s".' % url)
+        if path in ('/dev/stdout', '/dev/stderr'):
+            options.setdefault('buffer_size', 0)
+            if options.get('max_bytes'):
+                raise ValueError('Invalid URL: "%s".' % url)
+            stream = sys.stdout if path == '/dev/stdout' else sys.stderr
+            return FileLoggerFactory(FileSink(None, stream=stream, **options))
+        return FileLoggerFactory(FileSink(path, **options))
+
+    def __init__(self, sink):
+        self._sink = sink
+
+    @property
+    def sink(self):
+        return self._sink
+
+    def flush(self):
+        """Write all buffered events."""
+        self._sink.flush()
+
+    def close(self):
+        """Write all buffered events and close the log file."""
+        self._sink.close()
+
+    def __call__(self, *args):
+        return FileLogger(self._sink)
+
+
+def _non_negative(convert):
+    def parse(value):
+        value = convert(value)
+        if value < 0:
+            raise ValueError(value)
+        return value
+    return parse
+
+
+FILE_OPTIONS = {
+    'buffer-size': ('buffer_size', _non_negative(int)),
+    'flush-interval': ('flush_interval', _non_negative(float)),
+    'max-bytes': ('max_bytes', _non_negative(int)),
+    'backups': ('backups', _non_negative(int)),
+}
+"""Query string parameters supported in file logging endpoints."""
+
+
+class FileSink:
+    """Write log lines to a file in large blocks.
+
+    Lines are collected in memory and written once ``buffer_size`` bytes
+    are pending or when the oldest pending line is ``flush_interval``
+    seconds old, whichever comes first (a background thread takes care of
+    the latter).  Nothing is lost on shutdown as long as ``close()`` is
+    called.  Callers never wait for the disk: pending lines are swapped out
+    under a lock and written after releasing it.
+
+    When ``max_bytes`` is set, the log file is rotated before it grows past
+    that size: ``path`` is renamed to ``path.1``, ``path.1`` to ``path.2``
+    and so on, keeping ``backups`` files.  This replaces logrotate's
+    copy-truncate, which loses lines written during the copy.  Rotation
+    assumes a single process writes to the file (see ``check_logging()``).
+
+    Lines that can't be written (e.g. disk full) are dropped and counted.
+    """
+
+    def __init__(self, path, stream=None, buffer_size=64 * 1024,
+                 flush_interval=0.1, max_bytes=0, backups=5):
+        self._path = path
+        self._owned = stream is None
+        self._stream = stream or open(path, 'a')
+        self._buffer_size = buffer_size
+        self._flush_interval = flush_interval
+        self._max_bytes = max_bytes
+        self._backups = backups
+        self._lines = []
+        self._pending = 0
+        self._written = 0
+        if self._owned:
+            self._written = os.fstat(self._stream.fileno()).st_size
+        self._ready = threading.Condition()
+        # Serializes I/O (taken before ``_ready``, never while holding it).
+        self._output = threading.Lock()
+        self._thread = None
+        self._closed = False
+        self._dropped = 0
+        self._rotations = 0
+
+    @property
+    def dropped(self):
+        """Number of lines discarded without being written."""
+        return self._dropped
+
+    @property
+    def rotations(self):
+        """Number of times the log file was rotated."""
+        return self._rotations
+
+    def write(self, line):
+        """Queue a line (usually without performing any I/O)."""
+        with self._ready:
+            self._lines.append(line + '\n')
+            self._pending += len(self._lines[-1])
+            if not (self._closed or self._pending >= self._buffer_size):
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run)
+                    self._thread.daemon = True
+                    self._thread.start()
+                if len(self._lines) == 1:
+                    self._ready.notify_all()
+                return
+        self.flush()
+
+    def flush(self):
+        """Write all pending lines."""
+        with self._output:
+            with self._ready:
+                lines, self._lines = self._lines, []
+                self._pending = 0
+            if lines:
+                self._write(''.join(lines), len(lines))
+
+    def close(self):
+        """Write all pending lines and stop the background thread."""
+        with self._ready:
+            self._closed = True
+            self._ready.notify_all()
+            thread = self._thread
+        if thread:
+            thread.join()
+        self.flush()
+        if self._owned:
+            with self._output:
+                self._stream.close()
+
+    def _run(self):
+        while True:
+            with self._ready:
+                if self._closed:
+                    return
+                if not self._lines:
+                    self._ready.wait()
+                    continue
+                self._ready.wait(self._flush_interval)
+            self.flush()
+
+    def _write(self, data, lines):
+        try:
+            if self._max_bytes and self._written and \
+               self._written + len(data) > self._max_bytes:
+                self._rotate()
+            self._stream.write(data)
+            self._stream.flush()
+            self._written += len(data)
+        except (OSError, ValueError):
+            self._dropped += lines
+
+    def _rotate(self):
+        self._stream.close()
+        for i in range(self._backups - 1, 0, -1):
+            if os.path.exists('%s.%d' % (self._path, i)):
+                os.replace('%s.%d' % (self._path, i),
+                           '%s.%d' % (self._path, i + 1))
+        if self._backups:
+            os.replace(self._path, self._path + '.1')
+        else:
+            os.unlink(self._path)
+        self._stream = open(self._path, 'a')
+        self._written = 0
+        self._rotations += 1
+
+
+class FileLogger:
+    """Structlog logger that writes rendered events to a ``FileSink``."""
+
+    def __init__(self, sink):
+        self._sink = sink
+
+    def msg(self, message):
+        self._sink.write(message)
+
+    log = debug = info = warning = error = critical = msg
 
 
 class TimeStamper(object):
@@ -98,6 +667,7 @@ class TimeStamper(object):
     def __init__(self, key, utc):
         self._key = key
         self._utc = utc
+        self._zone = timezone.utc if utc else None
         if utc:
             def now():
                 return datetime.utcnow().replace(tzinfo=timezone.utc)
@@ -110,33 +680,93 @@ class TimeStamper(object):
         timestamp = event_dict.get('@timestamp')
         if timestamp is None:
             timestamp = self._now()
+        # Floats are POSIX timestamps, as returned by ``time.time()``.
+        if isinstance(timestamp, float):
+            timestamp = datetime.fromtimestamp(timestamp, self._zone)
         if isinstance(timestamp, datetime):
             timestamp = timestamp.isoformat()
         event_dict['@timestamp'] = timestamp
         return event_dict
 
 
-def configure_logging(log_format, utc, endpoint):
+class CachedTimeStamper(TimeStamper):
+    """Faster ``TimeStamper`` for the fast rendering pipeline.
+
+    Timestamps are taken as floats from ``time.time()`` and the date and time
+    is only formatted once per second: each event formats its microseconds
+    only.  Unlike ``datetime.isoformat()``, microseconds are always rendered.
+    """
+
+    def __init__(self, key, utc):
+        super().__init__(key, utc)
+        self._cache = (None, '', '')
+
+    def _format(self, timestamp):
+        second, micro = divmod(int(round(timestamp * 1000000)), 1000000)
+        # NOTE: read and replace the cache as a whole since loggers can be
+        #       used from several threads.
+        cache = self._cache
+        if cache[0] != second:
+            text = datetime.fromtimestamp(second, self._zone).isoformat()
+            cache = (second, text[:19], text[19:])
+            self._cache = cache
+        return '%s.%06d%s' % (cache[1], micro, cache[2])
+
+    def __call__(self, _, __, event_dict):
+        timestamp = event_dict.get('@timestamp')
+        if timestamp is None:
+            timestamp = time.time()
+        if isinstance(timestamp, float):
+            event_dict['@timestamp'] = self._format(timestamp)
+            return event_dict
+        return super().__call__(_, __, event_dict)
+
+
+class FastJSONRenderer(object):
+    """Faster ``structlog.processors.JSONRenderer(sort_keys=True)``.
+
+    The encoder is built once instead of on each event and uses ``ujson``
+    when it is installed, falling back to the standard library for values
+    it can't encode.
+    """
+
+    def __init__(self):
+        self._encode = json.JSONEncoder(
+            sort_keys=True,
+            default=repr,
+        ).encode
+
+    def __call__(self, _, __, event_dict):
+        if ujson is not None:
+            try:
+                return ujson.dumps(event_dict, sort_keys=True,
+                                   escape_forward_slashes=False)
+            except (TypeError, ValueError, OverflowError):
+                pass
+        return self._encode(event_dict)
+
+
+def configure_logging(log_format, utc, endpoint, fast=False):
+    """Configure ``structlog`` and return the logger factory.
+
+    The ``fast`` pipeline caches formatted timestamps, uses a faster JSON
+    encoder and caches loggers on first use.
+    """
     processors = [
-        TimeStamper(
+        (CachedTimeStamper if fast else TimeStamper)(
             key='@timestamp',
             utc=utc,
         ),
     ]
     if endpoint.startswith('file://'):
-        path = endpoint[7:]
-        if path == '/dev/stdout':
-            stream = sys.stdout
-        elif path == '/dev/stderr':
-            stream = sys.stderr
-        else:
-            stream = open(path, 'w')
-        logger_factory = structlog.PrintLoggerFactory(file=stream)
+        logger_factory = FileLoggerFactory.from_url(endpoint)
         if log_format == 'kv':
             processors.append(structlog.processors.KeyValueRenderer(
                 sort_keys=True,
                 key_order=['@timestamp', 'event'],
             ))
+        elif fast:
+            processors.append(FastJSONRenderer())
         else:
             processors.append(structlog.processors.JSONRenderer(
                 sort_keys=True,
@@ -149,7 +779,9 @@ def configure_logging(log_format, utc, endpoint):
     structlog.configure(
         processors=processors,
         logger_factory=logger_factory,
+        cache_logger_on_first_use=fast,
     )
+    return logger_factory
 
 
 async def inject_request_id(app, handler):
@@ -174,69 +806,379 @@ async def echo_request_id(request, response):
     response.headers['x-request-id'] = request.get('x-request-id', '?')
 
 
+class RequestTimer:
+    """Time spent in each stage of a request (see ``request_timer()``).
+
+    Handlers measure stages in named spans, which the access log reports in
+    its ``spans`` field.  Spans with the same name add up: the ``recv`` span
+    of an upload covers all reads of the request body.  Spans may overlap.
+    """
+
+    def __init__(self, clock):
+        self._clock = clock
+        self.spans = {}
+
+    def now(self):
+        """Start a span that doesn't fit in a ``with`` block."""
+        return self._clock()
+
+    def record(self, name, ref):
+        """End a span started with ``now()``."""
+        self.spans[name] = self.spans.get(name, 0.0) + (self._clock() - ref)
+
+    @contextlib.contextmanager
+    def span(self, name):
+        """Measure the stage in the ``with`` block."""
+        ref = self._clock()
+        try:
+            yield
+        finally:
+            self.record(name, ref)
+
+
+class NullTimer:
+    """``RequestTimer`` of requests that aren't sampled: measures nothing."""
+
+    def now(self):
+        return None
+
+    def record(self, name, ref):
+        pass
+
+    def span(self, name):
+        return self
+
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *args):
+        pass
+
+
+NULL_TIMER = NullTimer()
+"""Shared ``NullTimer``."""
+
+
+def request_timer(request):
+    """``RequestTimer`` of a request, if it's sampled (``NULL_TIMER`` if not).
+
+    See ``--timing-sample-rate``.
+    """
+    return request.get('smartmob.timer', NULL_TIMER)
+
+
 async def access_log_middleware(app, handler):
-    """Log each request in structured event log."""
+    """Log each request in structured event log.
+
+    A sample of the requests (see ``--timing-sample-rate``) get a
+    ``RequestTimer`` and their entry details the time spent in each stage.
+    """
 
     event_log = app.get('smartmob.event_log') or structlog.get_logger()
     clock = app.get('smartmob.clock') or timeit.default_timer
+    executor = app.get('smartmob.executor')
+    cache = app.get('smartmob.cache')
+    admission = app.get('smartmob.admission')
+    sample_rate = app.get('smartmob.timing_sample_rate', 0.0)
 
     # Keep the request arrival time to ensure we get intuitive logging of
     # events.
-    arrival_time = datetime.utcnow().replace(tzinfo=timezone.utc)
+    arrival_time = time.time()
+
+    def log(request, outcome, ref):
+        extra = dict(request['smartmob.access_log'])
+        if executor is not None:
+            extra['io_queue'] = executor.queued
+        if admission is not None and admission.limited:
+            extra['upload_queue'] = admission.queued
+            extra['upload_rejects'] = admission.rejected
+        if cache is not None:
+            extra['cache_hits'] = cache.hits
+            extra['cache_misses'] = cache.misses
+            extra['cache_evictions'] = cache.evictions
+            extra['cache_size'] = cache.size
+        timer = request.get('smartmob.timer')
+        if timer is not None:
+            extra['spans'] = timer.spans
+        event_log.info(
+            'http.access',
+            path=request.path,
+            outcome=outcome,
+            duration=(clock()-ref),
+            request=request.get('x-request-id', '?'),
+            **extra,
+            **{'@timestamp': arrival_time}
+        )
 
     async def access_log(request):
         ref = clock()
+        # Handlers can add their own fields to the access log entry.
+        request['smartmob.access_log'] = {}
+        if sample_rate and random.random() < sample_rate:
+            request['smartmob.timer'] = RequestTimer(clock)
         try:
             response = await handler(request)
-            event_log.info(
-                'http.access',
-                path=request.path,
-                outcome=response.status,
-                duration=(clock()-ref),
-                request=request.get('x-request-id', '?'),
-                **{'@timestamp': arrival_time},
-            )
+            log(request, response.status, ref)
             return response
         except aiohttp.web.HTTPException as error:
-            event_log.info(
-                'http.access',
-                path=request.path,
-                outcome=error.status,
-                duration=(clock()-ref),
-                request=request.get('x-request-id', '?'),
-                **{'@timestamp': arrival_time},
-            )
+            log(request, error.status, ref)
             raise
         except Exception:
-            event_log.info(
-                'http.access',
-                path=request.path,
-                outcome=500,
-                duration=(clock()-ref),
-                request=request.get('x-request-id', '?'),
-                **{'@timestamp': arrival_time},
-            )
+            log(request, 500, ref)
             raise
 
     return access_log
 
 
+def _format_number(value):
+    if value == math.inf:
+        return '+Inf'
+    return repr(value)
+
+
+def _escape_label(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace(
+        '\n', '\\n',
+    )
+
+
+class Counter:
+    """Monotonic counter, split by the values of its labels.
+
+    Label values are passed as a tuple, in the order of ``labels``.
+    """
+
+    kind = 'counter'
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._values = {}
+        if not self.labels:
+            self._values[()] = 0
+
+    def inc(self, amount=1, labels=()):
+        self._values[labels] = self._values.get(labels, 0) + amount
+
+    def samples(self):
+        for labels, value in sorted(self._values.items()):
+            yield self.name, list(zip(self.labels, labels)), value
+
+
+class Gauge(Counter):
+    """Value that goes up and down, split by the values of its labels."""
+
+    kind = 'gauge'
+
+    def dec(self, amount=1, labels=()):
+        self.inc(-amount, labels)
+
+    def set(self, value, labels=()):
+        self._values[labels] = value
+
+
+class Histogram:
+    """Distribution of observed values over fixed buckets.
+
+    Each observation costs a binary search over the bucket bounds.  Buckets
+    are only made cumulative when rendered.
+    """
+
+    kind = 'histogram'
+
+    def __init__(self, name, help, buckets, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.buckets = tuple(sorted(buckets))
+        self._counts = {}
+        self._sums = {}
+        if not self.labels:
+            self._counts[()] = [0] * (len(self.buckets) + 1)
+            self._sums[()] = 0
+
+    def observe(self, value, labels=()):
+        counts = self._counts.get(labels)
+        if counts is None:
+            counts = self._counts[labels] = [0] * (len(self.buckets) + 1)
+            self._sums[labels] = 0
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        self._sums[labels] += value
+
+    def samples(self):
+        for labels, counts in sorted(self._counts.items()):
+            pairs = list(zip(self.labels, labels))
+            total = 0
+            for bound, count in zip(self.buckets + (math.inf,), counts):
+                total += count
+                yield self.name + '_bucket', pairs + [
+                    ('le', _format_number(bound)),
+                ], total
+            yield self.name + '_sum', pairs, self._sums[labels]
+            yield self.name + '_count', pairs, total
+
+
+class MetricsRegistry:
+    """Collection of metrics, rendered in the Prometheus text format.
+
+    Metrics are updated on the event loop, so they don't need locks.
+
+    See: https://prometheus.io/docs/instrumenting/exposition_formats/
+    """
+
+    def __init__(self):
+        self._metrics = []
+        self._collectors = []
+
+    def add(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def collect(self, func):
+        """Call ``func()`` before each rendering, to sample metrics."""
+        self._collectors.append(func)
+
+    def render(self):
+        for func in self._collectors:
+            func()
+        lines = []
+        for metric in self._metrics:
+            lines.append('# HELP %s %s' % (metric.name, metric.help))
+            lines.append('# TYPE %s %s' % (metric.name, metric.kind))
+            for name, pairs, value in metric.samples():
+                if pairs:
+                    name += '{%s}' % ','.join(
+                        '%s="%s"' % (label, _escape_label(value))
+                        for label, value in pairs
+                    )
+                lines.append('%s %s' % (name, _format_number(value)))
+        return '\n'.join(lines) + '\n'
+
+
+DURATION_BUCKETS = (
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+    10.0,
+)
+"""Bounds (in seconds) of the request duration histogram buckets."""
+
+SIZE_BUCKETS = tuple(4 ** i * 1024 for i in range(11))
+"""Bounds (in bytes, from 1 KiB to 1 GiB) of the upload size buckets."""
+
+
+class ServerMetrics(MetricsRegistry):
+    """Metrics collected by ``metrics_middleware()``."""
+
+    def __init__(self):
+        super().__init__()
+        self.requests_in_flight = self.add(Gauge(
+            'http_requests_in_flight', "Requests being handled.",
+        ))
+        self.request_duration = self.add(Histogram(
+            'http_request_duration_seconds', "Time spent handling requests.",
+            DURATION_BUCKETS, labels=('method', 'status'),
+        ))
+        self.request_bytes = self.add(Counter(
+            'http_request_bytes_total', "Bytes received in request bodies.",
+            labels=('method',),
+        ))
+        self.response_bytes = self.add(Counter(
+            'http_response_bytes_total', "Bytes sent in response bodies.",
+            labels=('method',),
+        ))
+        self.upload_size = self.add(Histogram(
+            'upload_size_bytes', "Size of uploaded files.", SIZE_BUCKETS,
+        ))
+        self.replication_lag = self.add(Gauge(
+            'replication_lag_seconds',
+            "Age of the oldest file waiting to be copied to each peer.",
+            labels=('peer',),
+        ))
+        self.replication_queue = self.add(Gauge(
+            'replication_queue_files',
+            "Number of files waiting to be copied to each peer.",
+            labels=('peer',),
+        ))
+        self.replication_copies = self.add(Counter(
+            'replication_copies_total',
+            "Attempts to copy files to peers, by outcome.",
+            labels=('peer', 'outcome'),
+        ))
+
+
+async def metrics_middleware(app, handler):
+    """Measure each request in ``ServerMetrics``, if enabled."""
+
+    metrics = app.get('smartmob.metrics')
+    if metrics is None:
+        return handler
+    clock = app.get('smartmob.clock') or timeit.default_timer
+
+    async def measure(request):
+        metrics.requests_in_flight.inc()
+        ref = clock()
+        response = None
+        try:
+            response = await handler(request)
+            return response
+        except aiohttp.web.HTTPException as error:
+            response = error
+            raise
+        finally:
+            duration = clock() - ref
+            metrics.requests_in_flight.dec()
+            method = (request.method,)
+            status = '500'
+            if response is not None:
+                status = str(response.status)
+                if request.method != 'HEAD':
+                    # Streamed responses record their size themselves.
+                    metrics.response_bytes.inc(request.get(
+                        'smartmob.response_size', response.content_length,
+                    ) or 0, method)
+            metrics.request_duration.observe(
+                duration, (request.method, status),
+            )
+            metrics.request_bytes.inc(
+                getattr(request.content, 'total_bytes', 0), method,
+            )
+            size = request.get('smartmob.upload_size')
+            if size is not None:
+                metrics.upload_size.observe(size)
+
+    return measure
+
+
+async def render_metrics(request):
+    """Serve the contents of the ``MetricsRegistry``."""
+    return aiohttp.web.Response(
+        body=request.app['smartmob.metrics'].render().encode('utf-8'),
+        headers={'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'},
+    )
+
+
 class HTTPServer:
     """Run an aiohttp application as an asynchronous context manager."""
 
-    def __init__(self, app, host='0.0.0.0', port=80, loop=None):
+    def __init__(self, app, host='0.0.0.0', port=80, loop=None, sock=None):
         self._app = app
         self._loop = loop or asyncio.get_event_loop()
         self._handler = app.make_handler()
         self._server = None
         self._host = host
         self._port = port
+        self._sock = sock
 
     async def __aenter__(self):
         assert not self._server
-        self._server = await self._loop.create_server(
-            self._handler, self._host, self._port,
-        )
+        if self._sock:
+            self._server = await self._loop.create_server(
+                self._handler, sock=self._sock,
+            )
+        else:
+            self._server = await self._loop.create_server(
+                self._handler, self._host, self._port,
+            )
 
     async def __aexit__(self, *args):
         assert self._server
@@ -246,67 +1188,4333 @@ class HTTPServer:
         await self._handler.finish_connections(1.0)
         await self._app.cleanup()
         self._server = None
+        # Don't hold on to the access log of the last requests.
+        flush = getattr(self._app.get('smartmob.logger_factory'), 'flush',
+                        None)
+        if flush:
+            flush()
 
 
-async def upload(request):
-    """Naive file upload."""
-    storage = request.app['smartmob.storage']
-    path = os.path.join(storage, request.match_info['path'])
-    data = await request.read()
-    with open(path, 'wb') as stream:
-        stream.write(data)
-    return aiohttp.web.Response(status=201, headers={
-        'x-request-id': request.headers.get('x-request-id', '?'),
-    })
+@contextlib.contextmanager
+def handle_sigterm(f, loop=None):
+    """Context manager that fulfills a future when SIGTERM is received.
 
+    Companion to ``aiotk.handle_ctrlc()`` so that service managers can stop
+    the server the same way an interactive user would.
+    """
 
-async def main(argv, loop=None):
-    """Run the HTTP file server."""
+    loop = loop or asyncio.get_event_loop()
 
-    arguments = cli.parse_args(argv)
+    def handler():
+        if not f.done():
+            f.set_result(None)
 
-    # Apply defaults.
-    logging_endpoint = arguments.logging_endpoint
-    if not logging_endpoint:
-        logging_endpoint = os.environ.get('SMARTMOB_LOGGING_ENDPOINT')
-    if not logging_endpoint:
-        logging_endpoint = 'file:///dev/stdout'
+    loop.add_signal_handler(signal.SIGTERM, handler)
+    try:
+        yield
+    finally:
+        loop.remove_signal_handler(signal.SIGTERM)
 
-    # Send structured logs to requested destination.
-    configure_logging(
-        log_format='iso',
-        utc=True,
-        endpoint=logging_endpoint,
-    )
-    event_log = structlog.get_logger()
 
-    # Pick the event loop.
-    loop = loop or asyncio.get_event_loop()
+PROFILE_SIGNAL = signal.SIGUSR1
+"""Signal that starts a ``Profiler``."""
 
-    # Prepare a web application.
-    app = aiohttp.web.Application(
-        loop=loop,
-        middlewares=[
-            inject_request_id,
-            access_log_middleware,
-        ],
+PROFILE_INTERVAL = 0.005
+"""Seconds between two samples of the event loop's stack."""
+
+PROFILE_MAX_SECONDS = 600.0
+"""Longest profile that can be requested through ``start_profile()``."""
+
+PROFILE_TOKEN_HEADER = 'X-Smartmob-Token'
+"""Header holding the ``--profile-token`` (see ``start_profile()``)."""
+
+
+def token_matches(request, header, token):
+    """Compare a request header to a secret token, in constant time."""
+    return hmac.compare_digest(
+        request.headers.get(header, '').encode('utf-8'),
+        token.encode('utf-8'),
     )
-    app.on_response_prepare.append(echo_request_id)
 
-    # Define routes.
-    app.router.add_static('/', arguments.storage)
-    app.router.add_route('PUT', '/{path:.+}', upload)
 
-    # Inject context.
-    app['smartmob.event_log'] = event_log
-    app['smartmob.clock'] = timeit.default_timer
-    app['smartmob.storage'] = arguments.storage
+class StackSampler(threading.Thread):
+    """Count the stacks seen in another thread, sampled at an interval.
 
-    # Serve requests.
-    done = asyncio.Future(loop=loop)
-    with aiotk.handle_ctrlc(done, loop=loop):
-        async with HTTPServer(app, arguments.host, arguments.port):
-            await done
+    Stacks are keyed in the "collapsed" format of flame graph tools: frames
+    from the outermost to the innermost, separated by semicolons.
+    """
 
-    # Shut down.
-    event_log.info('stop')
+    def __init__(self, thread_id, interval):
+        super().__init__(daemon=True)
+        self._thread_id = thread_id
+        self._interval = interval
+        self._done = threading.Event()
+        self.stacks = collections.Counter()
+
+    def run(self):
+        while not self._done.wait(self._interval):
+            frame = sys._current_frames().get(self._thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append('%s (%s:%d)' % (
+                    code.co_name, code.co_filename, code.co_firstlineno,
+                ))
+                frame = frame.f_back
+            self.stacks[';'.join(reversed(stack))] += 1
+
+    def stop(self):
+        self._done.set()
+
+
+def write_collapsed(path, stacks):
+    """Write stack counts from a ``StackSampler`` for flame graph tools."""
+    with open(path, 'w') as stream:
+        for stack, count in sorted(stacks.items()):
+            stream.write('%s %d\n' % (stack, count))
+
+
+class Profiler:
+    """Profile the event loop on demand, without interrupting service.
+
+    Each profile runs for a number of seconds while requests are served as
+    usual, then its results are written to a new file in ``directory``:
+
+    - ``collapsed``: stacks of the event loop's thread, sampled every
+      ``PROFILE_INTERVAL`` seconds from another thread and counted in the
+      input format of flame graph tools.  The overhead is small and doesn't
+      depend on the load;
+    - ``pstats``: ``cProfile`` statistics of all calls made by the event
+      loop's thread, for ``pstats`` and similar tools.  Every call is
+      slower while it runs.
+
+    Blocking calls made in the ``IOExecutor`` aren't profiled.  Profiles are
+    started by ``PROFILE_SIGNAL`` (see ``trigger()``) or through
+    ``start_profile()``, one at a time.
+    """
+
+    def __init__(self, directory, executor, seconds=30.0, format='collapsed',
+                 event_log=None, loop=None):
+        self._loop = loop or asyncio.get_event_loop()
+        # NOTE: this must run in the event loop's thread.
+        self._thread_id = threading.get_ident()
+        self._executor = executor
+        self._event_log = event_log or structlog.get_logger()
+        self._task = None
+        self.directory = directory
+        self.seconds = seconds
+        self.format = format
+
+    @property
+    def running(self):
+        return self._task is not None and not self._task.done()
+
+    def start(self, seconds=None):
+        """Profile for ``seconds`` (``self.seconds`` by default).
+
+        Returns the path of the file that will hold the results.  Raises
+        ``RuntimeError`` while a profile is running.
+        """
+        if self.running:
+            raise RuntimeError('A profile is already running.')
+        path = os.path.join(self.directory, 'profile-%d-%s%s' % (
+            os.getpid(),
+            datetime.now(timezone.utc).strftime('%Y%m%dT%H%M%S%fZ'),
+            PROFILE_FORMATS[self.format],
+        ))
+        self._task = asyncio.ensure_future(
+            self._run(path, seconds or self.seconds), loop=self._loop,
+        )
+        return path
+
+    def trigger(self):
+        """Signal handler: start a profile, unless one is running."""
+        if not self.running:
+            self.start()
+
+    async def close(self):
+        """Abort the profile that is running, if any."""
+        if self.running:
+            self._task.cancel()
+            await asyncio.wait([self._task], loop=self._loop)
+
+    async def _run(self, path, seconds):
+        self._event_log.info('profile.start', path=path, seconds=seconds,
+                             format=self.format)
+        try:
+            if self.format == 'pstats':
+                profile = cProfile.Profile()
+                profile.enable()
+                try:
+                    await asyncio.sleep(seconds, loop=self._loop)
+                finally:
+                    profile.disable()
+                write = functools.partial(profile.dump_stats, path)
+            else:
+                sampler = StackSampler(self._thread_id, PROFILE_INTERVAL)
+                sampler.start()
+                try:
+                    await asyncio.sleep(seconds, loop=self._loop)
+                finally:
+                    sampler.stop()
+                await self._executor.run(sampler.join)
+                write = functools.partial(
+                    write_collapsed, path, sampler.stacks,
+                )
+            await self._executor.run(os.makedirs, self.directory,
+                                     exist_ok=True)
+            await self._executor.run(write)
+        except asyncio.CancelledError:
+            raise
+        except Exception as error:
+            self._event_log.error('profile.failed', path=path,
+                                  error=str(error))
+        else:
+            self._event_log.info('profile.done', path=path)
+
+
+async def start_profile(request):
+    """Start a ``Profiler`` from the metrics port.
+
+    ``POST /profile?seconds=<n>`` answers right away (202) with the path of
+    the file that will hold the results, or a 409 while a profile is
+    running.  The metrics port only listens on loopback by default (see
+    ``--metrics-host``); with ``--profile-token``, requests that don't send
+    the token in ``PROFILE_TOKEN_HEADER`` are also refused (403).
+    """
+    token = request.app.get('smartmob.profile_token')
+    if token is not None and \
+       not token_matches(request, PROFILE_TOKEN_HEADER, token):
+        raise aiohttp.web.HTTPForbidden()
+    profiler = request.app['smartmob.profiler']
+    try:
+        seconds = float(request.GET.get('seconds', profiler.seconds))
+    except ValueError:
+        raise aiohttp.web.HTTPBadRequest()
+    if not (0.0 < seconds <= PROFILE_MAX_SECONDS):
+        raise aiohttp.web.HTTPBadRequest()
+    try:
+        path = profiler.start(seconds)
+    except RuntimeError as error:
+        raise aiohttp.web.HTTPConflict(text=str(error))
+    return aiohttp.web.json_response({
+        'path': path,
+        'seconds': seconds,
+        'format': profiler.format,
+    }, status=202)
+
+
+def bind_socket(host, port, backlog=128):
+    """Create a listening TCP socket that can be shared by worker processes."""
+    family, kind, proto, _, address = socket.getaddrinfo(
+        host, port, type=socket.SOCK_STREAM, flags=socket.AI_PASSIVE,
+    )[0]
+    sock = socket.socket(family, kind, proto)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind(address)
+    sock.listen(backlog)
+    sock.set_inheritable(True)
+    return sock
+
+
+def forward_signal(workers, signum):
+    """Send a signal to worker processes that are still running."""
+    for worker in workers:
+        if worker.returncode is None:
+            worker.send_signal(signum)
+
+
+async def run_workers(argv, arguments, done, loop=None):
+    """Serve requests from a pool of worker processes.
+
+    The listening socket is bound once and inherited by each worker, which
+    runs its own event loop and application.  When ``done`` is fulfilled or
+    any worker exits, all remaining workers are sent SIGTERM and reaped.
+    """
+    loop = loop or asyncio.get_event_loop()
+    report = await loop.run_in_executor(
+        None, functools.partial(
+            prepare_storage, arguments.storage, arguments.dedup,
+            make_layout(arguments.layout, arguments.storage),
+            partial_ttl=arguments.partial_upload_ttl,
+        ),
+    )
+    if report:
+        structlog.get_logger().info('dedup.report', **report)
+    sock = bind_socket(arguments.host, arguments.port)
+    command = [sys.executable, '-m', 'smartmob_filestore'] + list(argv) + [
+        '--workers=1',
+        '--socket-fd=%d' % sock.fileno(),
+    ]
+    workers = []
+    try:
+        for i in range(arguments.workers):
+            options = []
+            if arguments.metrics_port is not None:
+                options.append('--metrics-port=%d' % (
+                    arguments.metrics_port + i,
+                ))
+            workers.append(await asyncio.create_subprocess_exec(
+                *(command + options), pass_fds=[sock.fileno()], loop=loop
+            ))
+        exits = [loop.create_task(worker.wait()) for worker in workers]
+        if arguments.profile_dir:
+            # Each worker profiles itself.
+            loop.add_signal_handler(PROFILE_SIGNAL, forward_signal,
+                                    workers, PROFILE_SIGNAL)
+        await asyncio.wait([done] + exits, loop=loop,
+                           return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        if arguments.profile_dir:
+            loop.remove_signal_handler(PROFILE_SIGNAL)
+        sock.close()
+        for worker in workers:
+            if worker.returncode is None:
+                worker.send_signal(signal.SIGTERM)
+        for worker in workers:
+            await worker.wait()
+
+
+class IOExecutor:
+    """Run blocking file system calls in a thread pool.
+
+    All file system access performed while serving requests goes through an
+    instance of this class so that slow disks never stall the event loop.
+    """
+
+    def __init__(self, threads, loop=None):
+        self._loop = loop or asyncio.get_event_loop()
+        self._threads = threads
+        self._pool = concurrent.futures.ThreadPoolExecutor(threads)
+        self._pending = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self._pool.shutdown(wait=True)
+
+    @property
+    def threads(self):
+        return self._threads
+
+    @property
+    def pending(self):
+        """Number of jobs submitted and not yet completed."""
+        return self._pending
+
+    @property
+    def queued(self):
+        """Number of jobs waiting for an available thread."""
+        return max(0, self._pending - self._threads)
+
+    async def run(self, func, *args, **kwds):
+        """Call ``func(*args, **kwds)`` in the thread pool and wait for it."""
+        self._pending += 1
+        try:
+            return await self._loop.run_in_executor(
+                self._pool, functools.partial(func, *args, **kwds),
+            )
+        finally:
+            self._pending -= 1
+
+
+def fsync_paths(paths):
+    """Flush files (or directories) to disk, one at a time."""
+    for path in paths:
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+
+class Durability:
+    """Make uploads durable before they are acknowledged.
+
+    Upload contents are flushed before they are renamed into place so that
+    a crash never replaces a file with partial contents, and directories
+    are flushed after the rename so that the new name survives.  Modes:
+
+    - ``none``: leave it to the OS (acknowledged uploads can be lost);
+    - ``fsync``: ``fsync()`` each file and directory;
+    - ``group``: uploads that need a flush within ``window`` seconds of
+      each other share one ``os.sync()``, which costs one device flush for
+      the whole batch (but also flushes other file systems).
+    """
+
+    def __init__(self, mode, executor, window=0.0, loop=None):
+        if mode not in DURABILITY_MODES:
+            raise ValueError('Invalid durability mode "%s".' % mode)
+        self._mode = mode
+        self._executor = executor
+        self._window = window
+        self._loop = loop or asyncio.get_event_loop()
+        self._batch = None
+        self.flushes = 0
+
+    @property
+    def mode(self):
+        return self._mode
+
+    async def sync_files(self, paths):
+        """Flush the contents of files that are about to be renamed."""
+        if self._mode == 'fsync':
+            await self._executor.run(fsync_paths, paths)
+        elif self._mode == 'group':
+            await self._join()
+
+    async def sync_dirs(self, paths):
+        """Flush the directories of files that were renamed into place.
+
+        ``paths`` may also list the directories created for them (see
+        ``install()``), whose parents are flushed top-down.
+        """
+        if self._mode == 'fsync':
+            await self._executor.run(fsync_paths, sorted({
+                os.path.dirname(path) or os.curdir for path in paths
+            }))
+        elif self._mode == 'group':
+            await self._join()
+
+    async def _join(self):
+        if self._batch is None:
+            self._batch = asyncio.Future(loop=self._loop)
+            self._loop.call_later(self._window, self._flush)
+        await asyncio.shield(self._batch, loop=self._loop)
+
+    def _flush(self):
+        batch, self._batch = self._batch, None
+        self.flushes += 1
+        task = asyncio.ensure_future(
+            self._executor.run(os.sync), loop=self._loop,
+        )
+
+        def done(task):
+            if task.exception():
+                batch.set_exception(task.exception())
+            else:
+                batch.set_result(None)
+
+        task.add_done_callback(done)
+
+
+class Holding:
+    """Async context manager for a resource held by ``acquire(*args)``.
+
+    The resource is given back with ``release(*args)``.
+    """
+
+    def __init__(self, acquire, release, *args):
+        self._acquire = acquire
+        self._release = release
+        self._args = args
+
+    async def __aenter__(self):
+        await self._acquire(*self._args)
+
+    async def __aexit__(self, *args):
+        self._release(*self._args)
+
+
+class AdmissionControl:
+    """Limit the number and total size of concurrent uploads.
+
+    Uploads over the limits wait for their turn, in order of arrival, for up
+    to ``timeout`` seconds.  After that (or right away if ``timeout`` is 0),
+    they are rejected with a 503 and a ``Retry-After`` header.  Sizes come
+    from the ``Content-Length`` header, so chunked uploads only count
+    towards the number of uploads.  An upload larger than ``max_bytes`` is
+    admitted when no other upload is in progress.  Limits of 0 are ignored.
+    """
+
+    def __init__(self, max_uploads, max_bytes, timeout, loop=None):
+        self._loop = loop or asyncio.get_event_loop()
+        self._max_uploads = max_uploads
+        self._max_bytes = max_bytes
+        self._timeout = timeout
+        self._waiters = collections.deque()
+        self.uploads = 0
+        self.bytes = 0
+        self.rejected = 0
+
+    @property
+    def limited(self):
+        return bool(self._max_uploads or self._max_bytes)
+
+    @property
+    def queued(self):
+        """Number of uploads waiting for their turn."""
+        return len(self._waiters)
+
+    def admit(self, size):
+        """Async context manager holding a place for an upload."""
+        return Holding(self.acquire, self.release, size)
+
+    def _fits(self, size):
+        if self._max_uploads and self.uploads >= self._max_uploads:
+            return False
+        if self._max_bytes and self.uploads and \
+           self.bytes + size > self._max_bytes:
+            return False
+        return True
+
+    def _take(self, size):
+        self.uploads += 1
+        self.bytes += size
+
+    async def acquire(self, size):
+        if not self._waiters and self._fits(size):
+            self._take(size)
+            return
+        if self._timeout <= 0:
+            self._reject()
+        waiter = asyncio.Future(loop=self._loop)
+        entry = (waiter, size)
+        self._waiters.append(entry)
+        try:
+            await asyncio.wait_for(waiter, self._timeout, loop=self._loop)
+        except asyncio.TimeoutError:
+            self._waiters.remove(entry)
+            self._wake()
+            self._reject()
+        except asyncio.CancelledError:
+            # Give our place back if it was handed over in the mean time.
+            if waiter.cancelled():
+                self._waiters.remove(entry)
+                self._wake()
+            else:
+                self.release(size)
+            raise
+
+    def release(self, size):
+        self.uploads -= 1
+        self.bytes -= size
+        self._wake()
+
+    def _wake(self):
+        """Admit the waiters at the head of the queue that now fit."""
+        while self._waiters and self._fits(self._waiters[0][1]):
+            waiter, size = self._waiters.popleft()
+            self._take(size)
+            waiter.set_result(None)
+
+    def _reject(self):
+        self.rejected += 1
+        raise aiohttp.web.HTTPServiceUnavailable(headers={
+            'Retry-After': str(max(1, math.ceil(self._timeout))),
+        })
+
+
+class PathLocks:
+    """Serialize requests that write to the same path.
+
+    Locks only exist while they are held or waited for.
+    """
+
+    def __init__(self, loop=None):
+        self._loop = loop or asyncio.get_event_loop()
+        self._locks = {}
+
+    def __len__(self):
+        return len(self._locks)
+
+    def hold(self, path):
+        """Async context manager holding the lock for ``path``."""
+        return Holding(self.acquire, self.release, path)
+
+    async def acquire(self, path):
+        entry = self._locks.get(path)
+        if entry is None:
+            entry = self._locks[path] = [asyncio.Lock(loop=self._loop), 0]
+        entry[1] += 1
+        try:
+            await entry[0].acquire()
+        except BaseException:
+            self._unref(path, entry)
+            raise
+
+    def release(self, path):
+        entry = self._locks[path]
+        entry[0].release()
+        self._unref(path, entry)
+
+    def _unref(self, path, entry):
+        entry[1] -= 1
+        if entry[1] == 0:
+            del self._locks[path]
+
+
+STAGING_DIR = '.staging'
+"""Directory, in the storage root, holding incomplete uploads."""
+
+BLOBS_DIR = '.blobs'
+"""Directory, in the storage root, holding content-addressed files."""
+
+INDEX_DIR = '.index'
+"""Directory, in the storage root, holding the server's databases."""
+
+VARIANTS_DIR = '.variants'
+"""Directory, in the storage root, holding compressed copies of files."""
+
+OBJECTS_DIR = '.objects'
+"""Directory, in the storage root, holding files in the sharded layout."""
+
+PACKS_DIR = '.packs'
+"""Directory, in the storage root, holding pack files (see ``PackStore``)."""
+
+RESERVED_DIRS = (
+    STAGING_DIR, BLOBS_DIR, INDEX_DIR, VARIANTS_DIR, OBJECTS_DIR, PACKS_DIR,
+)
+"""Directories, in the storage root, that are not accessible over HTTP."""
+
+
+def resolve_path(storage, name):
+    """Map a relative path onto a file in the storage root.
+
+    Returns ``None`` for paths that try to escape the storage root or that
+    point inside one of the ``RESERVED_DIRS``.
+    """
+    storage = os.path.abspath(storage)
+    path = os.path.normpath(os.path.join(storage, name))
+    if os.path.commonpath([storage, path]) != storage:
+        return None
+    for reserved in RESERVED_DIRS:
+        reserved = os.path.join(storage, reserved)
+        if os.path.commonpath([reserved, path]) == reserved:
+            return None
+    return path
+
+
+def resolve_name(storage, name):
+    """Normalize a relative path, as checked by ``resolve_path()``.
+
+    Returns ``''`` for the storage root itself and ``None`` for rejected
+    paths.
+    """
+    path = resolve_path(storage, name)
+    if path is None:
+        return None
+    name = os.path.relpath(path, os.path.abspath(storage))
+    return '' if name == os.curdir else name
+
+
+class FlatLayout:
+    """Store files at their path, relative to the storage root.
+
+    Layouts map the names of files (their normalized path in the URL space,
+    see ``resolve_name()``) onto files in the storage root, and back.
+    """
+
+    name = 'flat'
+
+    def __init__(self, storage):
+        self.storage = storage
+        self.root = storage
+
+    def locate(self, name):
+        """Path to the file with a given (normalized) name."""
+        return os.path.join(os.path.abspath(self.storage), name)
+
+    def resolve(self, name):
+        """Path to the file with a given name, or ``None`` if invalid."""
+        return resolve_path(self.storage, name)
+
+    def key(self, path):
+        """Inverse of ``locate()``."""
+        return os.path.relpath(path, self.storage)
+
+    def isdir(self, name):
+        return os.path.isdir(self.locate(name))
+
+    def walk(self):
+        """Iterate over the paths of all stored files."""
+        return walk_storage(self.root)
+
+    def place(self, path, func, *args, created=None):
+        """Run ``func(*args)``, which creates the file at ``path``.
+
+        Missing parent directories are created first, and appended to
+        ``created`` (see ``install()``).
+        """
+        return install(path, func, *args, created=created)
+
+
+NAME_MAX = 255
+"""Length of the longest file name in the sharded layout."""
+
+
+class ShardedLayout(FlatLayout):
+    """Store files under hashed fan-out directories.
+
+    The file named ``a/b.txt`` is stored as ``.objects/xx/yy/a%2Fb.txt``,
+    where ``xxyy`` starts the SHA-256 digest of its name, so directories
+    stay small however many files are stored.  File names are quoted
+    rather than hashed so that the ``DigestIndex`` can still be rebuilt
+    from the storage root.  Names longer than ``NAME_MAX`` once quoted are
+    rejected.
+
+    Directories are implicit: they exist as long as they hold files.
+    """
+
+    name = 'sharded'
+
+    def __init__(self, storage):
+        super().__init__(storage)
+        self.root = os.path.join(storage, OBJECTS_DIR)
+
+    def locate(self, name):
+        shard = hashlib.sha256(name.encode('utf-8')).hexdigest()
+        return os.path.join(
+            os.path.abspath(self.root), shard[:2], shard[2:4],
+            quote(name, safe=''),
+        )
+
+    def resolve(self, name):
+        name = resolve_name(self.storage, name)
+        if not name or len(quote(name, safe='')) > NAME_MAX:
+            return None
+        return self.locate(name)
+
+    def key(self, path):
+        return unquote(os.path.basename(path))
+
+    def isdir(self, name):
+        return name == ''
+
+
+def make_layout(name, storage):
+    """Build the layout of a storage root from its name (see ``LAYOUTS``)."""
+    return {'flat': FlatLayout, 'sharded': ShardedLayout}[name](storage)
+
+
+def check_layout(layout):
+    """Refuse to serve a storage root that holds files in another layout."""
+    for name in LAYOUTS:
+        if name != layout.name:
+            other = make_layout(name, layout.storage)
+            if next(iter(other.walk()), None) is not None:
+                raise ValueError(
+                    'Storage root "%s" holds files in the %s layout.' % (
+                        layout.storage, name,
+                    )
+                )
+
+
+def migrate_storage(storage, layout):
+    """Move all files in the storage root to ``layout``, in place.
+
+    Files are renamed, so links to blobs (see ``commit_blob()``) and the
+    ``DigestIndex`` remain valid, and directories left empty are removed.
+    Names are all checked before any file is moved.  Interrupted migrations
+    can be resumed.  The server must be stopped.  Returns the number of
+    files moved.
+    """
+    sources = [
+        make_layout(name, storage) for name in LAYOUTS if name != layout.name
+    ]
+    for source in sources:
+        for path in source.walk():
+            if layout.resolve(source.key(path)) is None:
+                raise ValueError('Can\'t store "%s" in the %s layout.' % (
+                    source.key(path), layout.name,
+                ))
+    count = 0
+    for source in sources:
+        for path in source.walk():
+            target = layout.locate(source.key(path))
+            install(target, os.rename, path, target)
+            count += 1
+        prune_dirs(source)
+    return count
+
+
+def prune_dirs(layout):
+    """Remove empty directories from a layout."""
+    paths = []
+    for root, dirs, _ in os.walk(layout.root):
+        if root == layout.storage:
+            dirs[:] = [name for name in dirs if name not in RESERVED_DIRS]
+        paths.extend(os.path.join(root, name) for name in dirs)
+    for path in reversed(paths):
+        with contextlib.suppress(OSError):
+            os.rmdir(path)
+
+
+def storage_path(request):
+    """Map the request's URL path onto a file in the storage root.
+
+    Raises ``HTTPNotFound`` for paths rejected by the layout.
+    """
+    path = request.app['smartmob.layout'].resolve(request.match_info['path'])
+    if path is None:
+        raise aiohttp.web.HTTPNotFound()
+    return path
+
+
+def storage_name(request):
+    """Name of the file targeted by the request (see ``FlatLayout``).
+
+    Raises ``HTTPNotFound`` for paths rejected by the layout.
+    """
+    return request.app['smartmob.layout'].key(storage_path(request))
+
+
+def staging_path(request, name):
+    """Path to a file in the staging area of the storage root."""
+    return os.path.join(request.app['smartmob.storage'], STAGING_DIR, name)
+
+
+PARTIAL_PREFIX = 'partial-'
+"""Prefix of partial files in the staging area (see ``upload_range()``)."""
+
+PARTIAL_TOTAL_SUFFIX = '.total'
+"""Suffix of the file recording the declared size of a partial file."""
+
+
+def read_partial_total(path):
+    """Declared size of a partial upload, or ``None`` if not recorded."""
+    try:
+        with open(path, 'r') as stream:
+            return int(stream.read())
+    except FileNotFoundError:
+        return None
+
+
+def write_partial_total(path, total):
+    """Record the declared size of a partial upload."""
+    with open(path, 'w') as stream:
+        stream.write(str(total))
+
+
+def discard_partial(path):
+    """Remove a partial upload and its declared size, if they exist."""
+    discard(path)
+    discard(path + PARTIAL_TOTAL_SUFFIX)
+
+
+UPLOAD_CHUNK_SIZE = 64 * 1024
+"""Number of bytes read from the request body at once during uploads."""
+
+DOWNLOAD_CHUNK_SIZE = 256 * 1024
+"""Number of bytes read from disk at once during downloads."""
+
+_CONTENT_RANGE = re.compile(r'^bytes (?:(\d+)-(\d+)|\*)/(\d+)$')
+_RANGE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+
+def parse_content_range(header):
+    """Parse a ``Content-Range`` request header.
+
+    Returns ``(start, end, total)`` where ``start`` and ``end`` are inclusive
+    offsets, or ``(None, None, total)`` for ``bytes */total``, which asks for
+    the status of a resumable upload.
+    """
+    match = _CONTENT_RANGE.match(header.strip())
+    if not match:
+        raise aiohttp.web.HTTPBadRequest()
+    start, end, total = match.groups()
+    total = int(total)
+    if start is None:
+        return None, None, total
+    start, end = int(start), int(end)
+    if end < start or end >= total:
+        raise aiohttp.web.HTTPBadRequest()
+    return start, end, total
+
+
+def parse_range(header, size):
+    """Parse the ``Range`` header of a GET request for a ``size`` byte file.
+
+    Returns inclusive ``(start, end)`` offsets or ``None`` when the header
+    should be ignored and the whole file sent.  Only single ranges are
+    honored, as allowed by RFC 7233.  Raises ``HTTPRequestRangeNotSatisfiable``
+    when the range selects no part of the file.
+    """
+    match = _RANGE.match(header.strip())
+    if not match or match.groups() == ('', ''):
+        return None
+    first, last = match.groups()
+    if first:
+        start, end = int(first), size - 1
+        if last:
+            if int(last) < start:
+                return None
+            end = min(int(last), end)
+    else:
+        suffix = int(last)
+        start, end = (max(0, size - suffix) if suffix else size), size - 1
+    if start >= size:
+        raise aiohttp.web.HTTPRequestRangeNotSatisfiable(headers={
+            'Content-Range': 'bytes */%d' % size,
+        })
+    return start, end
+
+
+def if_range_matches(request, info, etag):
+    """Check the ``If-Range`` precondition of a ranged GET request."""
+    header = request.headers.get('If-Range')
+    if header is None:
+        return True
+    if header.strip().startswith(('"', 'W/')):
+        return header.strip() == etag
+    timestamp = email.utils.parsedate_tz(header)
+    if timestamp is None:
+        return False
+    # NOTE: aiohttp rounds ``Last-Modified`` up to the next second.
+    return email.utils.mktime_tz(timestamp) == math.ceil(info.mtime)
+
+
+def blob_path(storage, digest):
+    """Path to the content-addressed copy of a file with a given digest."""
+    return os.path.join(storage, BLOBS_DIR, digest[:2], digest)
+
+
+def request_digest(request):
+    """SHA-256 digest (hex) from the request's ``Digest`` header, if any.
+
+    See: RFC 3230.
+    """
+    for item in request.headers.get('Digest', '').split(','):
+        algorithm, _, value = item.strip().partition('=')
+        if algorithm.lower() == 'sha-256':
+            try:
+                digest = base64.b64decode(value, validate=True)
+            except binascii.Error:
+                raise aiohttp.web.HTTPBadRequest()
+            return binascii.hexlify(digest).decode('ascii')
+    return None
+
+
+def hash_file(path):
+    """Compute the SHA-256 digest (hex) of a file."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as stream:
+        chunk = stream.read(DOWNLOAD_CHUNK_SIZE)
+        while chunk:
+            digest.update(chunk)
+            chunk = stream.read(DOWNLOAD_CHUNK_SIZE)
+    return digest.hexdigest()
+
+
+def commit_blob(temp, blob, path):
+    """Move a complete upload into place, sharing storage with identical files.
+
+    The first copy of some content becomes the blob and every path holding
+    the same content is a hard link to it.  Returns ``True`` when the content
+    was already stored (i.e. the upload was deduplicated).
+    """
+    os.makedirs(os.path.dirname(blob), exist_ok=True)
+    try:
+        os.link(temp, blob)
+    except FileExistsError:
+        os.unlink(temp)
+        link_blob(blob, temp, path)
+        return True
+    os.replace(temp, path)
+    return False
+
+
+def link_blob(blob, temp, path):
+    """Atomically place a hard link to an existing blob at ``path``."""
+    os.link(blob, temp)
+    os.replace(temp, path)
+    # NOTE: renaming does nothing when ``path`` already links to the blob.
+    discard(temp)
+
+
+def collect_blobs(storage):
+    """Remove unreferenced blobs and report on storage savings.
+
+    A blob that has no other hard link than its own entry is no longer used
+    by any path (it was overwritten or the upload failed mid-way).
+    """
+    report = {'blobs': 0, 'bytes_stored': 0, 'bytes_saved': 0}
+    for root, _, names in os.walk(os.path.join(storage, BLOBS_DIR)):
+        for name in names:
+            path = os.path.join(root, name)
+            info = os.stat(path)
+            if info.st_nlink < 2:
+                os.unlink(path)
+                continue
+            report['blobs'] += 1
+            report['bytes_stored'] += info.st_size
+            report['bytes_saved'] += info.st_size * (info.st_nlink - 2)
+    return report
+
+
+class DigestIndex:
+    """Persistent map of stored files to their SHA-256 digest.
+
+    Entries are keyed by name (see ``FlatLayout``) and remember the
+    identity of the file they describe (inode, size and modification time) so
+    that files changed behind the server's back are hashed again when looked
+    up.  Files stored before the index existed are hashed lazily, the first
+    time they are looked up.
+
+    Since entries are sorted by path, the index also serves paginated
+    listings.  ``scan()`` reconciles it with the storage root on startup.
+
+    The index is stored in SQLite so it can be shared by worker processes.
+    All methods block and should run in the ``IOExecutor``.
+    """
+
+    def __init__(self, storage, layout=None):
+        self._storage = storage
+        self._layout = layout or FlatLayout(storage)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(
+            os.path.join(storage, INDEX_DIR, 'digests.sqlite3'),
+            timeout=30.0, isolation_level=None, check_same_thread=False,
+        )
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute(
+            'CREATE TABLE IF NOT EXISTS digests ('
+            ' path TEXT PRIMARY KEY,'
+            ' inode INTEGER, size INTEGER, mtime INTEGER,'
+            ' digest TEXT'
+            ')'
+        )
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    def scan(self):
+        """Reconcile the index with the files in the storage root.
+
+        New and modified files are added (their digest is computed lazily)
+        and entries for files that no longer exist are removed.  Returns the
+        number of files in the storage root.
+        """
+        count = 0
+        with self._lock:
+            self._db.execute('BEGIN IMMEDIATE')
+            try:
+                self._db.execute(
+                    'CREATE TEMP TABLE IF NOT EXISTS seen'
+                    ' (path TEXT PRIMARY KEY)'
+                )
+                self._db.execute('DELETE FROM seen')
+                for path in self._layout.walk():
+                    info = os.stat(path)
+                    row = self._db.execute(
+                        'SELECT inode, size, mtime FROM digests'
+                        ' WHERE path = ?', (self._key(path),),
+                    ).fetchone()
+                    # Keep known digests for files that didn't change.
+                    if not row or tuple(row) != _identity(info):
+                        self._put(path, info, None)
+                    self._db.execute(
+                        'INSERT INTO seen VALUES (?)', (self._key(path),),
+                    )
+                    count += 1
+                self._db.execute(
+                    'DELETE FROM digests'
+                    ' WHERE path NOT IN (SELECT path FROM seen)'
+                )
+                self._db.execute('DELETE FROM seen')
+            except BaseException:
+                self._db.execute('ROLLBACK')
+                raise
+            self._db.execute('COMMIT')
+        return count
+
+    def list(self, prefix='', after='', limit=100):
+        """List files whose path starts with ``prefix``, sorted by path.
+
+        Returns at most ``limit`` ``(path, size, mtime_ns)`` tuples, starting
+        after the path ``after``.  Cost is proportional to ``limit``.
+        """
+        with self._lock:
+            return self._db.execute(
+                'SELECT path, size, mtime FROM digests'
+                ' WHERE path >= ? AND path < ? AND path > ?'
+                ' ORDER BY path LIMIT ?',
+                (prefix, prefix + '\U0010ffff', after, limit),
+            ).fetchall()
+
+    def digests(self):
+        """Set of the digests of all indexed files."""
+        with self._lock:
+            return {
+                row[0] for row in self._db.execute(
+                    'SELECT DISTINCT digest FROM digests'
+                    ' WHERE digest IS NOT NULL'
+                )
+            }
+
+    def _key(self, path):
+        return self._layout.key(path)
+
+    def _get(self, path, info):
+        row = self._db.execute(
+            'SELECT inode, size, mtime, digest FROM digests WHERE path = ?',
+            (self._key(path),),
+        ).fetchone()
+        if row and tuple(row[:3]) == _identity(info):
+            return row[3]
+        return None
+
+    def _put(self, path, info, digest):
+        self._db.execute(
+            'INSERT OR REPLACE INTO digests VALUES (?, ?, ?, ?, ?)',
+            (self._key(path),) + _identity(info) + (digest,),
+        )
+
+    def lookup(self, path):
+        """Digest of the file at ``path``, or ``None`` if there is none."""
+        try:
+            info = os.stat(path)
+        except FileNotFoundError:
+            return None
+        with self._lock:
+            digest = self._get(path, info)
+        if digest is None:
+            digest = hash_file(path)
+            # Don't record anything if the file changed while we hashed it.
+            if _identity(os.stat(path)) != _identity(info):
+                return digest
+            with self._lock:
+                self._put(path, info, digest)
+        return digest
+
+    def commit(self, path, digest, check, func, *args):
+        """Update the file at ``path`` and record its new digest.
+
+        ``func(*args)`` must atomically place the new content at ``path``.
+        When ``check`` is set, it's called with the current digest first and
+        may raise to cancel the update.  Commits are serialized across
+        threads and processes so that ``check`` can't race other uploads.
+        """
+        with self._lock:
+            self._db.execute('BEGIN IMMEDIATE')
+            try:
+                if check:
+                    check(self._current(path))
+                result = func(*args)
+                self._put(path, os.stat(path), digest)
+            except BaseException:
+                self._db.execute('ROLLBACK')
+                raise
+            self._db.execute('COMMIT')
+        return result
+
+    def remove(self, path, check):
+        """Remove the file at ``path`` and its entry, like ``commit()``."""
+        with self._lock:
+            self._db.execute('BEGIN IMMEDIATE')
+            try:
+                if check:
+                    check(self._current(path))
+                os.unlink(path)
+                self._db.execute(
+                    'DELETE FROM digests WHERE path = ?', (self._key(path),),
+                )
+            except BaseException:
+                self._db.execute('ROLLBACK')
+                raise
+            self._db.execute('COMMIT')
+
+    def commit_all(self, commits):
+        """Like ``commit()`` for several files, all or nothing.
+
+        ``commits`` holds ``(path, digest, func, args)`` tuples.  Existing
+        files are kept as hard links in the staging area until all updates
+        succeed, so that they can be restored if one of them fails.  Returns
+        the results of each ``func(*args)``.
+        """
+        results = []
+        backups = []
+        with self._lock:
+            self._db.execute('BEGIN IMMEDIATE')
+            try:
+                for path, digest, func, args in commits:
+                    backups.append((path, self._backup(path)))
+                    results.append(func(*args))
+                    self._put(path, os.stat(path), digest)
+            except BaseException:
+                for path, backup in reversed(backups):
+                    if backup:
+                        os.replace(backup, path)
+                    else:
+                        discard(path)
+                self._db.execute('ROLLBACK')
+                raise
+            self._db.execute('COMMIT')
+        for _, backup in backups:
+            if backup:
+                os.unlink(backup)
+        return results
+
+    def _backup(self, path):
+        try:
+            info = os.lstat(path)
+        except FileNotFoundError:
+            return None
+        if stat.S_ISDIR(info.st_mode):
+            raise IsADirectoryError(errno.EISDIR, os.strerror(errno.EISDIR),
+                                    path)
+        backup = os.path.join(
+            self._storage, STAGING_DIR, 'backup-%s' % uuid.uuid4().hex,
+        )
+        os.link(path, backup)
+        return backup
+
+    def _current(self, path):
+        try:
+            info = os.stat(path)
+        except FileNotFoundError:
+            return None
+        digest = self._get(path, info)
+        if digest is None:
+            digest = hash_file(path)
+            self._put(path, info, digest)
+        return digest
+
+
+def walk_storage(storage):
+    """Iterate over the paths of all stored files, skipping reserved dirs."""
+    for root, dirs, names in os.walk(storage):
+        if root == storage:
+            dirs[:] = [name for name in dirs if name not in RESERVED_DIRS]
+        dirs.sort()
+        for name in sorted(names):
+            path = os.path.join(root, name)
+            if os.path.isfile(path):
+                yield path
+
+
+def make_reserved_dirs(storage):
+    """Create the server's directories in the storage root, if missing."""
+    for reserved in (STAGING_DIR, INDEX_DIR):
+        os.makedirs(os.path.join(storage, reserved), exist_ok=True)
+
+
+def check_packs(storage):
+    """Refuse to serve a storage root that holds pack files, without them."""
+    try:
+        names = os.listdir(os.path.join(storage, PACKS_DIR))
+    except FileNotFoundError:
+        return
+    for name in names:
+        if pack_segment_id(name) is not None:
+            raise ValueError(
+                'Storage root "%s" holds pack files (see --backend=pack).' % (
+                    storage,
+                )
+            )
+
+
+def clean_staging(storage, partial_ttl=None, now=None):
+    """Remove the files left in the staging area by a previous run.
+
+    Only partial uploads (see ``upload_range()``) outlive the requests that
+    create them, so they are kept for clients to resume, unless they were
+    not written to for more than ``partial_ttl`` seconds.  Everything else
+    (e.g. ``upload-*`` and ``archive-*`` files) is orphaned.
+    """
+    staging = os.path.join(storage, STAGING_DIR)
+    now = time.time() if now is None else now
+    for name in sorted(os.listdir(staging)):
+        path = os.path.join(staging, name)
+        if name.startswith(PARTIAL_PREFIX):
+            if partial_ttl is None:
+                continue
+            if name.endswith(PARTIAL_TOTAL_SUFFIX):
+                path = path[:-len(PARTIAL_TOTAL_SUFFIX)]
+            try:
+                mtime = os.stat(path).st_mtime
+            except FileNotFoundError:
+                mtime = 0.0
+            if now - mtime > partial_ttl:
+                discard_partial(path)
+        elif os.path.isfile(path):
+            discard(path)
+
+
+def prepare_storage(storage, dedup=False, layout=None, packs=False,
+                    partial_ttl=None):
+    """Create the server's directories and reconcile its indexes.
+
+    This runs once when the server starts (not once per worker process).
+    Unless ``packs`` is set, storage roots that hold pack files are refused.
+    Leftover files in the staging area are removed (see ``clean_staging()``).
+    Returns the deduplication report (see ``collect_blobs()``), if enabled.
+    """
+    layout = layout or FlatLayout(storage)
+    check_layout(layout)
+    if not packs:
+        check_packs(storage)
+    make_reserved_dirs(storage)
+    clean_staging(storage, partial_ttl)
+    index = DigestIndex(storage, layout)
+    try:
+        index.scan()
+        collect_variants(storage, index.digests())
+    finally:
+        index.close()
+    if dedup:
+        return collect_blobs(storage)
+    return None
+
+
+def _identity(info):
+    return (info.st_ino, info.st_size, info.st_mtime_ns)
+
+
+def make_etag(digest):
+    """Strong entity tag for a file with a given digest."""
+    return '"%s"' % digest
+
+
+def etag_matches(header, digest, weak=False):
+    """Check a digest against an ``If-Match`` or ``If-None-Match`` header.
+
+    See: RFC 7232, section 2.3.2.
+    """
+    if digest is None:
+        return False
+    if header.strip() == '*':
+        return True
+    etag = make_etag(digest)
+    for tag in header.split(','):
+        tag = tag.strip()
+        if weak and tag.startswith('W/'):
+            tag = tag[2:]
+        if tag == etag:
+            return True
+    return False
+
+
+def put_preconditions(request):
+    """Build a check for the ``If-Match`` and ``If-None-Match`` of a PUT.
+
+    Returns ``None`` when the request has no preconditions, else a function
+    of the target's current digest that raises ``HTTPPreconditionFailed``
+    when the upload must not proceed.
+    """
+    if_match = request.headers.get('If-Match')
+    if_none_match = request.headers.get('If-None-Match')
+    if if_match is None and if_none_match is None:
+        return None
+
+    def check(current):
+        if if_match is not None and not etag_matches(if_match, current):
+            raise aiohttp.web.HTTPPreconditionFailed()
+        if if_none_match is not None and etag_matches(if_none_match, current):
+            raise aiohttp.web.HTTPPreconditionFailed()
+
+    return check
+
+
+COMPRESSIBLE_TYPES = frozenset([
+    'application/javascript',
+    'application/json',
+    'application/xml',
+    'image/svg+xml',
+])
+"""Content types, other than ``text/*``, that are worth compressing."""
+
+VARIANT_ENCODINGS = ('gzip',)
+"""Content codings of the stored variants, in order of preference."""
+
+
+def compressible(path):
+    """Check if the file at ``path`` is worth compressing, by content type."""
+    content_type, encoding = mimetypes.guess_type(path)
+    if encoding or not content_type:
+        return False
+    return (
+        content_type.startswith('text/') or
+        content_type.endswith(('+json', '+xml')) or
+        content_type in COMPRESSIBLE_TYPES
+    )
+
+
+def variant_path(storage, digest, encoding):
+    """Path to the compressed copy of the file with a given digest."""
+    return os.path.join(
+        storage, VARIANTS_DIR, digest[:2], '%s.%s' % (digest, encoding),
+    )
+
+
+def compress_file(path, digest, variant, temp, min_size):
+    """Store a gzip copy of the file at ``path`` as ``variant``.
+
+    Nothing is stored when the file is smaller than ``min_size``, when it no
+    longer has the expected digest (it changed in the mean time) or when
+    compression doesn't make it smaller.  Returns the size of the variant,
+    or ``None`` when it wasn't stored.
+    """
+    if os.path.exists(variant):
+        return os.path.getsize(variant)
+    checksum = hashlib.sha256()
+    with open(path, 'rb') as source:
+        size = os.fstat(source.fileno()).st_size
+        if size < min_size:
+            return None
+        with open(temp, 'wb') as stream:
+            with gzip.GzipFile(fileobj=stream, mode='wb', mtime=0) as output:
+                chunk = source.read(DOWNLOAD_CHUNK_SIZE)
+                while chunk:
+                    checksum.update(chunk)
+                    output.write(chunk)
+                    chunk = source.read(DOWNLOAD_CHUNK_SIZE)
+            compressed = stream.tell()
+    if checksum.hexdigest() != digest or compressed >= size:
+        os.unlink(temp)
+        return None
+    os.makedirs(os.path.dirname(variant), exist_ok=True)
+    os.replace(temp, variant)
+    return compressed
+
+
+def collect_variants(storage, digests):
+    """Remove compressed copies of files that are no longer stored."""
+    for root, _, names in os.walk(os.path.join(storage, VARIANTS_DIR)):
+        for name in names:
+            if name.partition('.')[0] not in digests:
+                os.unlink(os.path.join(root, name))
+
+
+def negotiate_encoding(header, encodings):
+    """Pick the preferred content coding from an ``Accept-Encoding`` header.
+
+    Returns ``None`` when none of ``encodings`` is preferred over the
+    unencoded content.  See: RFC 7231, section 5.3.4.
+    """
+    weights = {}
+    for item in header.split(','):
+        coding, *params = item.split(';')
+        weight = 1.0
+        for param in params:
+            name, _, value = param.partition('=')
+            if name.strip().lower() == 'q':
+                try:
+                    weight = float(value)
+                except ValueError:
+                    weight = 0.0
+        weights[coding.strip().lower()] = weight
+    default = weights.get('*', 0.0)
+    best, best_weight = None, weights.get('identity', max(default, 1.0))
+    for encoding in encodings:
+        weight = weights.get(encoding, default)
+        if weight > 0.0 and weight >= best_weight:
+            best, best_weight = encoding, weight
+    return best
+
+
+def compress_later(request, name, digest):
+    """Store compressed copies of an uploaded file, in the background."""
+    min_size = request.app.get('smartmob.compress')
+    if min_size is None or not compressible(name):
+        return
+    path = request.app['smartmob.backend'].locate(name)
+    executor = request.app['smartmob.executor']
+    event_log = request.app['smartmob.event_log']
+    storage = request.app['smartmob.storage']
+    tasks = request.app['smartmob.background']
+    task = asyncio.ensure_future(executor.run(
+        compress_file, path, digest,
+        variant_path(storage, digest, 'gzip'),
+        staging_path(request, str(uuid.uuid4())),
+        min_size,
+    ), loop=request.app.loop)
+
+    def done(task):
+        tasks.discard(task)
+        if task.exception():
+            event_log.error(
+                'compress.failed', path=path, error=str(task.exception()),
+            )
+
+    tasks.add(task)
+    task.add_done_callback(done)
+
+
+def compact_later(request):
+    """Compact pack files in the background, when they waste enough space."""
+    backend = request.app['smartmob.backend']
+    if not isinstance(backend, PackBackend) or backend.compaction or \
+       not backend.packs.wasteful():
+        return
+    event_log = request.app['smartmob.event_log']
+    tasks = request.app['smartmob.background']
+    task = asyncio.ensure_future(
+        backend.executor.run(backend.packs.compact), loop=request.app.loop,
+    )
+
+    def done(task):
+        tasks.discard(task)
+        backend.compaction = None
+        if task.exception():
+            event_log.error('compact.failed', error=str(task.exception()))
+        else:
+            event_log.info('compact', reclaimed=task.result())
+
+    tasks.add(task)
+    backend.compaction = task
+    task.add_done_callback(done)
+
+
+FileInfo = collections.namedtuple('FileInfo', 'size mtime identity')
+"""Size, modification time (in seconds) and identity of a stored file.
+
+The identity changes whenever the file does.
+"""
+
+
+def file_info(info):
+    """``FileInfo`` of a file on disk, from its ``os.stat()`` result."""
+    return FileInfo(info.st_size, info.st_mtime, _identity(info))
+
+
+CacheEntry = collections.namedtuple('CacheEntry', 'info data digest')
+"""Contents and metadata of a cached file (see ``ContentCache``)."""
+
+
+def load_file(path):
+    """Read a (small) file into a ``CacheEntry``."""
+    with open(path, 'rb') as stream:
+        info = file_info(os.fstat(stream.fileno()))
+        data = stream.read(info.size)
+    return CacheEntry(info, data, hashlib.sha256(data).hexdigest())
+
+
+class ContentCache:
+    """In-memory LRU cache of small files, for use on the event loop.
+
+    The cache holds at most ``max_bytes`` of file contents and never holds
+    files larger than ``max_object``.  Uploads must ``invalidate()`` the
+    paths they overwrite.  ``token()`` guards against caching contents that
+    were read from disk before a concurrent invalidation.
+
+    Other processes (e.g. worker processes) don't invalidate this cache, so
+    ``validate`` tells the server to check that the file is unchanged before
+    using a cached copy.
+    """
+
+    def __init__(self, max_bytes, max_object, validate=False):
+        self._max_bytes = max_bytes
+        self._max_object = max_object
+        self._validate = validate
+        self._entries = collections.OrderedDict()
+        self._size = 0
+        self._generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @property
+    def size(self):
+        """Number of bytes of file contents currently cached."""
+        return self._size
+
+    @property
+    def validate(self):
+        return self._validate
+
+    def admits(self, size):
+        """Check if a file of ``size`` bytes may be cached."""
+        return size <= min(self._max_object, self._max_bytes)
+
+    def get(self, path):
+        entry = self._entries.get(path)
+        if entry is None:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(path)
+        self.hits += 1
+        return entry
+
+    def token(self):
+        """Snapshot to pass to ``put()`` when reading a file from disk."""
+        return self._generation
+
+    def put(self, path, entry, token):
+        if token != self._generation or not self.admits(len(entry.data)):
+            return
+        self._remove(path)
+        self._entries[path] = entry
+        self._size += len(entry.data)
+        while self._size > self._max_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self._size -= len(evicted.data)
+            self.evictions += 1
+
+    def invalidate(self, path):
+        self._generation += 1
+        self._remove(path)
+
+    def _remove(self, path):
+        entry = self._entries.pop(path, None)
+        if entry is not None:
+            self._size -= len(entry.data)
+
+
+def discard(path):
+    """Remove a file, if it exists."""
+    with contextlib.suppress(FileNotFoundError):
+        os.unlink(path)
+
+
+def write_and_hash(stream, digest, chunk):
+    stream.write(chunk)
+    digest.update(chunk)
+
+
+async def defer_continue(request):
+    """Expect handler that lets the request handler send "100 Continue".
+
+    This lets ``upload()`` answer right away, without receiving the body,
+    when it already has the content.  See ``send_continue()``.
+    """
+    expect = request.headers['Expect']
+    if expect.lower() != '100-continue':
+        raise aiohttp.web.HTTPExpectationFailed(
+            text='Unknown Expect: %s' % expect,
+        )
+
+
+def send_continue(request):
+    """Ask the client to send the request body, if it's waiting for it."""
+    if request.version >= aiohttp.HttpVersion11 and \
+       request.headers.get('Expect', '').lower() == '100-continue':
+        request.transport.write(b'HTTP/1.1 100 Continue\r\n\r\n')
+
+
+def open_staged(path):
+    """Open a staged file for writing at arbitrary offsets, creating it."""
+    return open(os.open(path, os.O_WRONLY | os.O_CREAT, 0o666), 'wb')
+
+
+class LocalReader:
+    """Read stream over a file on disk (see ``LocalBackend.open()``)."""
+
+    def __init__(self, executor, stream):
+        self._executor = executor
+        self._stream = stream
+
+    async def seek(self, offset):
+        await self._executor.run(self._stream.seek, offset)
+
+    async def read(self, size):
+        return await self._executor.run(self._stream.read, size)
+
+    async def close(self):
+        await self._executor.run(self._stream.close)
+
+
+class LocalWriter:
+    """Write stream into the staging area (see ``LocalBackend.create()``)."""
+
+    def __init__(self, backend, path, temp, stream):
+        self._backend = backend
+        self._path = path
+        self._temp = temp
+        self._stream = stream
+        self._digest = hashlib.sha256()
+        self.size = 0
+
+    async def write(self, chunk):
+        await self._backend.executor.run(
+            write_and_hash, self._stream, self._digest, chunk,
+        )
+        self.size += len(chunk)
+
+    def hexdigest(self):
+        """SHA-256 digest (hex) of the data written so far."""
+        return self._digest.hexdigest()
+
+    async def commit(self, check, timer=NULL_TIMER):
+        """Move the file into place, unless ``check`` raises.
+
+        ``check`` is called with the digest of the file being replaced.
+        Returns ``True`` when the upload was deduplicated.  ``timer`` (a
+        ``RequestTimer``) measures the ``fsync`` and ``rename`` stages.
+        """
+        await self._backend.executor.run(self._stream.close)
+        return await self._backend.commit_file(
+            self._temp, self._path, self.hexdigest(), check, timer,
+        )
+
+    async def abort(self):
+        await self._backend.executor.run(self._stream.close)
+        await self._backend.executor.run(discard, self._temp)
+
+
+class LocalBackend:
+    """Store files on disk, in the storage root.
+
+    Backends store files by name (see ``FlatLayout``) and share ``stat()``,
+    ``digest()``, ``load()``, ``open()``, ``create()``, ``delete()`` and
+    ``list()`` operations, which the request handlers are built on.
+
+    Here, files are arranged by the layout and their digests are kept in
+    the ``DigestIndex``.  Uploads are written to the staging area and
+    atomically moved into place, deduplicated (see ``commit_blob()``) and
+    made durable (see ``Durability``) as configured.  Features that need
+    files on disk (e.g. resumable uploads and archives) are only available
+    with this backend.  Blocking calls run in the ``IOExecutor``.
+    """
+
+    name = 'local'
+
+    def __init__(self, storage, layout, index, executor, durability,
+                 dedup=False):
+        self.storage = storage
+        self.layout = layout
+        self.index = index
+        self.executor = executor
+        self.durability = durability
+        self.dedup = dedup
+
+    def locate(self, name):
+        return self.layout.locate(name)
+
+    async def stat(self, name):
+        """``FileInfo`` of the file with a given name.
+
+        Raises ``FileNotFoundError`` (or ``NotADirectoryError``) when there
+        is no such file and ``IsADirectoryError`` for directories.
+        """
+        info = await self.executor.run(os.stat, self.locate(name))
+        if stat.S_ISDIR(info.st_mode):
+            raise IsADirectoryError(errno.EISDIR, os.strerror(errno.EISDIR),
+                                    name)
+        if not stat.S_ISREG(info.st_mode):
+            raise FileNotFoundError(errno.ENOENT, os.strerror(errno.ENOENT),
+                                    name)
+        return file_info(info)
+
+    async def digest(self, name):
+        """Digest of the file with a given name, or ``None``."""
+        return await self.executor.run(self.index.lookup, self.locate(name))
+
+    async def load(self, name):
+        """Read a (small) file into a ``CacheEntry``."""
+        return await self.executor.run(load_file, self.locate(name))
+
+    async def open(self, name):
+        """Read stream over the file with a given name."""
+        return LocalReader(
+            self.executor, await self.executor.run(open, self.locate(name),
+                                                   'rb'),
+        )
+
+    async def create(self, name):
+        """Write stream that replaces the file with a given name on commit.
+
+        Streams must be either committed or aborted.
+        """
+        temp = os.path.join(
+            self.storage, STAGING_DIR, 'upload-%s' % uuid.uuid4().hex,
+        )
+        stream = await self.executor.run(open, temp, 'xb')
+        return LocalWriter(self, self.locate(name), temp, stream)
+
+    async def delete(self, name, check):
+        """Remove the file with a given name, unless ``check`` raises."""
+        path = self.locate(name)
+        await self.executor.run(self.index.remove, path, check)
+        await self.durability.sync_dirs([path])
+
+    async def list(self, prefix, after, limit):
+        """List files by name, like ``DigestIndex.list()``."""
+        return await self.executor.run(
+            self.index.list, prefix, after, limit,
+        )
+
+    async def variant(self, digest, encoding):
+        """Size of a compressed copy (see ``compress_file()``), or ``None``."""
+        try:
+            info = await self.executor.run(
+                os.stat, variant_path(self.storage, digest, encoding),
+            )
+        except FileNotFoundError:
+            return None
+        return info.st_size
+
+    async def open_variant(self, digest, encoding):
+        return LocalReader(self.executor, await self.executor.run(
+            open, variant_path(self.storage, digest, encoding), 'rb',
+        ))
+
+    async def link(self, name, digest, check):
+        """Store the blob with a given digest under a name.
+
+        Raises ``FileNotFoundError`` when there is no such blob.
+        """
+        path = self.locate(name)
+        temp = os.path.join(
+            self.storage, STAGING_DIR, 'upload-%s' % uuid.uuid4().hex,
+        )
+        await self.commit(
+            path, digest, check,
+            link_blob, blob_path(self.storage, digest), temp, path,
+        )
+        return True
+
+    async def commit_file(self, temp, path, digest, check,
+                          timer=NULL_TIMER):
+        """Move a complete upload into place and record its digest.
+
+        Returns ``True`` when the upload was deduplicated.
+        """
+        with timer.span('fsync'):
+            await self.durability.sync_files([temp])
+        if self.dedup:
+            return await self.commit(
+                path, digest, check,
+                commit_blob, temp, blob_path(self.storage, digest), path,
+                timer=timer,
+            )
+        await self.commit(path, digest, check, os.replace, temp, path,
+                          timer=timer)
+        return False
+
+    async def commit(self, path, digest, check, func, *args,
+                     timer=NULL_TIMER):
+        """Run ``DigestIndex.commit()`` and wait until the file is durable."""
+        created = []
+        with timer.span('rename'):
+            result = await self.executor.run(
+                self.index.commit, path, digest, check,
+                functools.partial(self.layout.place, created=created),
+                path, func, *args
+            )
+        with timer.span('fsync'):
+            await self.durability.sync_dirs([path] + created)
+        return result
+
+    async def commit_all(self, commits):
+        """Run ``DigestIndex.commit_all()``."""
+        return await self.executor.run(self.index.commit_all, commits)
+
+    async def add_to_archive(self, writer, name, arcname):
+        """Add the file with a given name to an ``ArchiveWriter``."""
+        await writer.add(self.locate(name), arcname)
+
+
+class MemoryReader:
+    """Read stream over a file in memory (see ``MemoryBackend.open()``)."""
+
+    def __init__(self, data):
+        self._stream = io.BytesIO(data)
+
+    async def seek(self, offset):
+        self._stream.seek(offset)
+
+    async def read(self, size):
+        return self._stream.read(size)
+
+    async def close(self):
+        self._stream.close()
+
+
+class MemoryWriter:
+    """Write stream into memory (see ``MemoryBackend.create()``)."""
+
+    def __init__(self, backend, name):
+        self._backend = backend
+        self._name = name
+        self._chunks = []
+        self._digest = hashlib.sha256()
+        self.size = 0
+
+    async def write(self, chunk):
+        self._chunks.append(chunk)
+        self._digest.update(chunk)
+        self.size += len(chunk)
+
+    def hexdigest(self):
+        return self._digest.hexdigest()
+
+    async def commit(self, check, timer=NULL_TIMER):
+        self._backend.store(
+            self._name, b''.join(self._chunks), self.hexdigest(), check,
+        )
+        return False
+
+    async def abort(self):
+        self._chunks = []
+
+
+class MemoryBackend:
+    """Store files in memory (see ``LocalBackend`` for the operations).
+
+    Contents are lost when the server stops.  This serves benchmarks of the
+    HTTP layer and tests, without any disk I/O.  Names are kept sorted, so
+    listings cost is proportional to the page size, like with the
+    ``DigestIndex``.
+    """
+
+    name = 'memory'
+
+    def __init__(self, clock=time.time):
+        self._clock = clock
+        self._files = {}
+        self._names = []
+        self._versions = itertools.count()
+
+    def _get(self, name):
+        entry = self._files.get(name)
+        if entry is None:
+            i = bisect.bisect_left(self._names, name + '/')
+            if i < len(self._names) and self._names[i].startswith(name + '/'):
+                raise IsADirectoryError(errno.EISDIR,
+                                        os.strerror(errno.EISDIR), name)
+            raise FileNotFoundError(errno.ENOENT, os.strerror(errno.ENOENT),
+                                    name)
+        return entry
+
+    async def stat(self, name):
+        return self._get(name).info
+
+    async def digest(self, name):
+        entry = self._files.get(name)
+        return entry and entry.digest
+
+    async def load(self, name):
+        return self._get(name)
+
+    async def open(self, name):
+        return MemoryReader(self._get(name).data)
+
+    async def create(self, name):
+        return MemoryWriter(self, name)
+
+    async def delete(self, name, check):
+        if check:
+            check(await self.digest(name))
+        self._get(name)
+        del self._files[name]
+        del self._names[bisect.bisect_left(self._names, name)]
+
+    async def list(self, prefix, after, limit):
+        rows = []
+        i = max(bisect.bisect_left(self._names, prefix),
+                bisect.bisect_right(self._names, after))
+        for name in self._names[i:i + limit]:
+            if name >= prefix + '\U0010ffff':
+                break
+            info = self._files[name].info
+            rows.append((name, info.size, int(info.mtime * 1e9)))
+        return rows
+
+    def store(self, name, data, digest, check):
+        """Replace the file with a given name, unless ``check`` raises."""
+        entry = self._files.get(name)
+        if check:
+            check(entry and entry.digest)
+        if entry is None:
+            bisect.insort(self._names, name)
+        self._files[name] = CacheEntry(
+            FileInfo(len(data), self._clock(), next(self._versions)),
+            data, digest,
+        )
+
+
+PACK_RECORD = struct.Struct('>4sBHIdQI32s')
+"""Header of pack records: magic, kind, name and data sizes, modification
+time, sequence number, CRC-32 and digest (see ``PackStore``)."""
+
+PACK_MAGIC = b'SMPK'
+"""First bytes of pack records."""
+
+PACK_PUT, PACK_DELETE = 0, 1
+"""Kinds of pack records."""
+
+PACK_SEGMENT = 'segment-%08d.pack'
+"""Name of pack files, from their number."""
+
+PACK_COMPACT_RATIO = 0.5
+"""Fraction of pack files that may be wasted before compaction."""
+
+PackEntry = collections.namedtuple(
+    'PackEntry', 'segment offset size mtime digest seq',
+)
+"""Location (of the contents) and metadata of a packed file."""
+
+
+def pack_segment_id(name):
+    """Number of the pack file with a given name, or ``None``."""
+    match = re.match(r'^segment-(\d{8})\.pack$', name)
+    return match and int(match.group(1))
+
+
+def pack_record(kind, name, data, mtime, seq, digest):
+    """Pack record for a file (``PACK_PUT``) or its removal."""
+    name = name.encode('utf-8')
+    fields = [
+        PACK_MAGIC, kind, len(name), len(data), mtime, seq, 0,
+        binascii.unhexlify(digest) if digest else b'\0' * 32,
+    ]
+    header = PACK_RECORD.pack(*fields)
+    fields[6] = zlib.crc32(data, zlib.crc32(name, zlib.crc32(header)))
+    return PACK_RECORD.pack(*fields) + name + data
+
+
+def pack_record_size(name, entry):
+    return PACK_RECORD.size + len(name.encode('utf-8')) + entry.size
+
+
+def pack_info(entry):
+    """``FileInfo`` of a packed file, from its ``PackEntry``."""
+    return FileInfo(entry.size, entry.mtime, ('pack', entry.seq))
+
+
+def write_all(fd, data):
+    """Write all of ``data`` to a file descriptor."""
+    data = memoryview(data)
+    while data:
+        data = data[os.write(fd, data):]
+
+
+class PackStore:
+    """Append-only pack files for small files, indexed in memory.
+
+    Files are appended to the current segment (a pack file) as records
+    holding a header, their name and their contents, and located through an
+    in-memory map of names to ``PackEntry`` so that reading one takes a
+    single ``os.pread()``.  Removals append a tombstone.  Segments are sealed
+    once they hold ``segment_size`` bytes.
+
+    Records carry a sequence number and a CRC-32, so the index can be
+    rebuilt from the segments: the latest record of each name wins and a
+    torn record ends its segment, which is truncated.  The index is saved
+    by ``save()`` and only records appended since are read on startup.
+    ``compact()`` copies files that are still current to new segments and
+    removes the others, reclaiming the space of overwritten and removed
+    files.
+
+    Blocking methods should run in the ``IOExecutor``, but ``get()``,
+    ``list()`` and ``wasteful()`` only use memory.
+    """
+
+    def __init__(self, path, segment_size=64 * 1024 ** 2):
+        self._path = path
+        self._segment_size = segment_size
+        # Appends are serialized by ``_write_lock``, then indexed under
+        # ``_lock``, which also guards file descriptors against compaction.
+        # Readers pin descriptors so that they can read without the lock.
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self._compact_lock = threading.Lock()
+        self._entries = {}
+        self._fds = {}
+        self._pins = collections.Counter()
+        self._retired = set()
+        self._sizes = {}
+        self._active = None
+        self._writer = None
+        os.makedirs(path, exist_ok=True)
+        ids = sorted(filter(None, map(pack_segment_id, os.listdir(path))))
+        self._next_id = (ids[-1] + 1) if ids else 1
+        self._seq = 0
+        hinted = self._load_hint(ids)
+        deleted = {}
+        for segment in ids:
+            self._replay(segment, hinted.get(segment, 0), deleted)
+            self._fds[segment] = os.open(self._segment(segment), os.O_RDONLY)
+        self._names = sorted(self._entries)
+        self._live = sum(
+            pack_record_size(name, entry)
+            for name, entry in self._entries.items()
+        )
+        if ids and self._sizes[ids[-1]] < segment_size:
+            self._active = ids[-1]
+            self._writer = os.open(
+                self._segment(self._active), os.O_WRONLY | os.O_APPEND,
+            )
+
+    def _segment(self, segment):
+        return os.path.join(self._path, PACK_SEGMENT % segment)
+
+    def _load_hint(self, ids):
+        """Load the index saved by ``save()``, if it's still valid.
+
+        Returns the size of each segment when the index was saved.
+        """
+        try:
+            with open(os.path.join(self._path, 'index'), 'rb') as stream:
+                _, seq, segments, entries = msgpack.unpackb(stream.read())
+        except FileNotFoundError:
+            return {}
+        for segment, size in segments:
+            # Segments were removed (compaction) or truncated since.
+            if segment not in ids or \
+               os.path.getsize(self._segment(segment)) < size:
+                return {}
+        self._seq = seq
+        for name, segment, offset, size, mtime, digest, seq in entries:
+            self._entries[name.decode('utf-8')] = PackEntry(
+                segment, offset, size, mtime,
+                binascii.hexlify(digest).decode('ascii'), seq,
+            )
+        return dict(segments)
+
+    def _replay(self, segment, offset, deleted):
+        """Index the records of a segment, starting at ``offset``.
+
+        ``deleted`` maps names to the sequence number of their latest
+        tombstone, across segments.  The segment is truncated after the last
+        valid record.
+        """
+        path = self._segment(segment)
+        end = os.path.getsize(path)
+        with open(path, 'rb') as stream:
+            stream.seek(offset)
+            while offset + PACK_RECORD.size <= end:
+                header = stream.read(PACK_RECORD.size)
+                fields = list(PACK_RECORD.unpack(header))
+                magic, kind, name_size, size, mtime, seq, crc, digest = fields
+                start = offset + PACK_RECORD.size + name_size
+                if magic != PACK_MAGIC or start + size > end:
+                    break
+                body = stream.read(name_size + size)
+                fields[6] = 0
+                if zlib.crc32(body, zlib.crc32(
+                    PACK_RECORD.pack(*fields),
+                )) != crc:
+                    break
+                offset = start + size
+                self._seq = max(self._seq, seq + 1)
+                name = body[:name_size].decode('utf-8')
+                current = self._entries.get(name)
+                if seq <= deleted.get(name, -1) or \
+                   (current is not None and seq <= current.seq):
+                    continue
+                if kind == PACK_DELETE:
+                    deleted[name] = seq
+                    self._entries.pop(name, None)
+                else:
+                    self._entries[name] = PackEntry(
+                        segment, start, size, mtime,
+                        binascii.hexlify(digest).decode('ascii'), seq,
+                    )
+        if offset < end:
+            os.truncate(path, offset)
+        self._sizes[segment] = offset
+
+    def save(self):
+        """Save the index, so that startup doesn't read all segments."""
+        with self._lock:
+            segments = sorted(self._sizes.items())
+            entries = list(self._entries.items())
+            seq = self._seq
+        path = os.path.join(self._path, 'index')
+        temp = '%s-%s' % (path, uuid.uuid4().hex)
+        with open(temp, 'wb') as stream:
+            stream.write(msgpack.packb([1, seq, segments, [
+                [
+                    name.encode('utf-8'), entry.segment, entry.offset,
+                    entry.size, entry.mtime, binascii.unhexlify(entry.digest),
+                    entry.seq,
+                ]
+                for name, entry in entries
+            ]]))
+            stream.flush()
+            os.fsync(stream.fileno())
+        os.replace(temp, path)
+
+    def close(self):
+        self.save()
+        with self._write_lock, self._lock:
+            self._seal()
+            for fd in self._fds.values():
+                self._release(fd)
+            self._fds.clear()
+
+    def get(self, name):
+        """``PackEntry`` of a packed file, or ``None``."""
+        return self._entries.get(name)
+
+    def list(self, prefix, after, limit):
+        """List packed files, like ``DigestIndex.list()``."""
+        rows = []
+        with self._lock:
+            i = max(bisect.bisect_left(self._names, prefix),
+                    bisect.bisect_right(self._names, after))
+            for name in self._names[i:i + limit]:
+                if name >= prefix + '\U0010ffff':
+                    break
+                entry = self._entries[name]
+                rows.append((name, entry.size, int(entry.mtime * 1e9)))
+        return rows
+
+    def read(self, name):
+        """Read a packed file into a ``CacheEntry``, or ``None``."""
+        with self._lock:
+            entry = self._entries.get(name)
+            if entry is None:
+                return None
+            fd = self._fds[entry.segment]
+            self._pins[fd] += 1
+        try:
+            data = os.pread(fd, entry.size, entry.offset)
+        finally:
+            with self._lock:
+                self._pins[fd] -= 1
+                if not self._pins[fd]:
+                    del self._pins[fd]
+                    if fd in self._retired:
+                        self._retired.remove(fd)
+                        os.close(fd)
+        return CacheEntry(pack_info(entry), data, entry.digest)
+
+    def put(self, name, data, digest):
+        """Store a file, replacing any previous version.
+
+        Returns the path of the segment it was written to and whether that
+        segment was just created (see ``Durability``).
+        """
+        with self._write_lock:
+            mtime, seq = time.time(), self._seq
+            self._seq += 1
+            record = pack_record(PACK_PUT, name, data, mtime, seq, digest)
+            path, created, offset = self._append(record)
+            with self._lock:
+                self._replace(name, PackEntry(
+                    self._active, offset + len(record) - len(data),
+                    len(data), mtime, digest, seq,
+                ))
+        return path, created
+
+    def delete(self, name):
+        """Remove a packed file, like ``put()``.
+
+        Raises ``FileNotFoundError`` when there is no such file.
+        """
+        with self._write_lock:
+            if name not in self._entries:
+                raise FileNotFoundError(
+                    errno.ENOENT, os.strerror(errno.ENOENT), name,
+                )
+            seq = self._seq
+            self._seq += 1
+            path, created, _ = self._append(pack_record(
+                PACK_DELETE, name, b'', time.time(), seq, None,
+            ))
+            with self._lock:
+                self._replace(name, None)
+        return path, created
+
+    def _append(self, record):
+        """Append a record to the current segment (under ``_write_lock``)."""
+        created = False
+        if self._active is None or \
+           self._sizes[self._active] >= self._segment_size:
+            self._seal()
+            with self._lock:
+                segment, self._next_id = self._next_id, self._next_id + 1
+            path = self._segment(segment)
+            self._writer = os.open(
+                path, os.O_WRONLY | os.O_CREAT | os.O_EXCL | os.O_APPEND,
+                0o666,
+            )
+            with self._lock:
+                self._fds[segment] = os.open(path, os.O_RDONLY)
+                self._sizes[segment] = 0
+            self._active, created = segment, True
+        offset = self._sizes[self._active]
+        write_all(self._writer, record)
+        with self._lock:
+            self._sizes[self._active] += len(record)
+        return self._segment(self._active), created, offset
+
+    def _seal(self):
+        if self._writer is not None:
+            os.close(self._writer)
+        self._active = self._writer = None
+
+    def _release(self, fd):
+        """Close a segment after pending reads (under ``_lock``)."""
+        if self._pins[fd]:
+            self._retired.add(fd)
+        else:
+            os.close(fd)
+
+    def _replace(self, name, entry):
+        """Update the index (under ``_lock``)."""
+        current = self._entries.pop(name, None)
+        if current is None:
+            bisect.insort(self._names, name)
+        else:
+            self._live -= pack_record_size(name, current)
+        if entry is None:
+            del self._names[bisect.bisect_left(self._names, name)]
+        else:
+            self._entries[name] = entry
+            self._live += pack_record_size(name, entry)
+
+    def wasteful(self):
+        """Check if enough space is wasted for ``compact()`` to pay off."""
+        total = sum(self._sizes.values())
+        wasted = total - self._live
+        return wasted >= PACK_COMPACT_RATIO * max(total, self._segment_size)
+
+    def compact(self):
+        """Copy current files to new segments and remove the old segments.
+
+        Files may be read, stored and removed in the mean time.  The new
+        segments are flushed to disk before the old ones are removed.
+        Returns the number of bytes reclaimed.
+        """
+        with self._compact_lock:
+            with self._write_lock:
+                self._seal()
+                with self._lock:
+                    sealed = dict(self._sizes)
+                    files = sorted(
+                        (entry.segment, entry.offset, name, entry)
+                        for name, entry in self._entries.items()
+                    )
+            copies, moves = self._copy(files)
+            with self._lock:
+                for segment, size in copies.items():
+                    self._fds[segment] = os.open(
+                        self._segment(segment), os.O_RDONLY,
+                    )
+                    self._sizes[segment] = size
+                for name, entry, copy in moves:
+                    # Skip files that were replaced while we copied them.
+                    if self._entries.get(name) is entry:
+                        self._entries[name] = copy
+                for segment in sealed:
+                    self._release(self._fds.pop(segment))
+                    del self._sizes[segment]
+            for segment in sealed:
+                os.unlink(self._segment(segment))
+            self.save()
+        return sum(sealed.values()) - sum(copies.values())
+
+    def _copy(self, files):
+        """Copy files to new segments, for ``compact()``.
+
+        Returns the size of each new segment and ``(name, entry, copy)``
+        tuples.
+        """
+        copies = {}
+        moves = []
+        fd = segment = None
+        try:
+            for _, _, name, entry in files:
+                with self._lock:
+                    if self._entries.get(name) is not entry:
+                        continue
+                    data = os.pread(self._fds[entry.segment], entry.size,
+                                    entry.offset)
+                if fd is None or copies[segment] >= self._segment_size:
+                    if fd is not None:
+                        os.fsync(fd)
+                        os.close(fd)
+                        fd = None
+                    with self._lock:
+                        segment, self._next_id = \
+                            self._next_id, self._next_id + 1
+                    copies[segment] = 0
+                    fd = os.open(
+                        self._segment(segment),
+                        os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666,
+                    )
+                record = pack_record(
+                    PACK_PUT, name, data, entry.mtime, entry.seq,
+                    entry.digest,
+                )
+                write_all(fd, record)
+                copies[segment] += len(record)
+                moves.append((name, entry, entry._replace(
+                    segment=segment, offset=copies[segment] - entry.size,
+                )))
+            if fd is not None:
+                os.fsync(fd)
+                os.close(fd)
+                fd = None
+            fsync_paths([self._path])
+        except BaseException:
+            if fd is not None:
+                os.close(fd)
+            for segment in copies:
+                discard(self._segment(segment))
+            raise
+        return copies, moves
+
+
+class PackWriter(MemoryWriter):
+    """Write stream for ``PackBackend.create()``.
+
+    Data is held in memory until it outgrows the pack threshold, after which
+    it's written to the staging area, like with the ``LocalBackend``.
+    """
+
+    def __init__(self, backend, name):
+        super().__init__(backend, name)
+        self._writer = None
+
+    async def write(self, chunk):
+        if self._writer is None and \
+           self.size + len(chunk) > self._backend.max_size:
+            self._writer = await LocalBackend.create(self._backend,
+                                                     self._name)
+            await self._writer.write(b''.join(self._chunks))
+            self._chunks = []
+        if self._writer is None:
+            await super().write(chunk)
+        else:
+            await self._writer.write(chunk)
+            self.size += len(chunk)
+
+    def hexdigest(self):
+        if self._writer is None:
+            return super().hexdigest()
+        return self._writer.hexdigest()
+
+    async def commit(self, check, timer=NULL_TIMER):
+        if self._writer is not None:
+            return await self._writer.commit(check, timer)
+        with timer.span('write'):
+            await self._backend.store(
+                self._name, b''.join(self._chunks), self.hexdigest(), check,
+            )
+        return False
+
+    async def abort(self):
+        if self._writer is not None:
+            await self._writer.abort()
+        await super().abort()
+
+
+class PackBackend(LocalBackend):
+    """Store small files in pack files and others like the ``LocalBackend``.
+
+    Uploads of up to ``max_size`` bytes are appended to the ``PackStore``,
+    which saves an inode and a block per file and serves them with a single
+    read.  Resumable uploads, archives and larger uploads are stored as
+    files.  Storing a file either way removes its other copy.  If the server
+    crashes in between, ``reconcile()`` keeps the latest copy on startup.
+    """
+
+    name = 'pack'
+
+    def __init__(self, storage, layout, index, executor, durability, packs,
+                 max_size, dedup=False):
+        super().__init__(storage, layout, index, executor, durability,
+                         dedup=dedup)
+        self.packs = packs
+        self.max_size = max_size
+        self.compaction = None
+
+    def reconcile(self):
+        """Remove the older copy of files that are also stored as files.
+
+        This blocks and runs once when the server starts, after the
+        ``DigestIndex`` is scanned.
+        """
+        after = ''
+        while True:
+            rows = self.index.list('', after, LIST_MAX_LIMIT)
+            for name, _, mtime in rows:
+                entry = self.packs.get(name)
+                if entry is None:
+                    continue
+                if mtime > entry.mtime * 1e9:
+                    self.packs.delete(name)
+                else:
+                    self.index.remove(self.locate(name), None)
+            if len(rows) < LIST_MAX_LIMIT:
+                return
+            after = rows[-1][0]
+
+    async def stat(self, name):
+        entry = self.packs.get(name)
+        if entry is None:
+            return await super().stat(name)
+        return pack_info(entry)
+
+    async def digest(self, name):
+        entry = self.packs.get(name)
+        if entry is None:
+            return await super().digest(name)
+        return entry.digest
+
+    async def _read(self, name):
+        if self.packs.get(name) is None:
+            return None
+        return await self.executor.run(self.packs.read, name)
+
+    async def load(self, name):
+        entry = await self._read(name)
+        if entry is None:
+            return await super().load(name)
+        return entry
+
+    async def open(self, name):
+        entry = await self._read(name)
+        if entry is None:
+            return await super().open(name)
+        return MemoryReader(entry.data)
+
+    async def create(self, name):
+        return PackWriter(self, name)
+
+    async def delete(self, name, check):
+        if self.packs.get(name) is None:
+            return await super().delete(name, check)
+        await self._sync(await self.executor.run(
+            self._delete, name, check,
+        ))
+
+    def _delete(self, name, check):
+        if check:
+            check(self.packs.get(name).digest)
+        return self.packs.delete(name)
+
+    async def list(self, prefix, after, limit):
+        packed = self.packs.list(prefix, after, limit)
+        names = {row[0] for row in packed}
+        rows = [
+            row for row in await super().list(prefix, after, limit)
+            if row[0] not in names
+        ]
+        return sorted(rows + packed)[:limit]
+
+    async def store(self, name, data, digest, check):
+        """Replace the file with a given name, unless ``check`` raises."""
+        await self._sync(await self.executor.run(
+            self._store, name, data, digest, check,
+        ))
+
+    def _store(self, name, data, digest, check):
+        path = self.locate(name)
+        entry = self.packs.get(name)
+        info = None
+        if entry is None:
+            with contextlib.suppress(FileNotFoundError, NotADirectoryError):
+                info = os.stat(path)
+            if info and stat.S_ISDIR(info.st_mode):
+                raise IsADirectoryError(
+                    errno.EISDIR, os.strerror(errno.EISDIR), name,
+                )
+        if check:
+            check(entry.digest if entry else self.index.lookup(path))
+        result = self.packs.put(name, data, digest)
+        if info is not None:
+            self.index.remove(path, None)
+        return result
+
+    async def _sync(self, result):
+        """Make an append to the ``PackStore`` durable."""
+        path, created = result
+        await self.durability.sync_files([path])
+        if created:
+            await self.durability.sync_dirs([path])
+
+    async def commit(self, path, digest, check, func, *args,
+                     timer=NULL_TIMER):
+        name = self.layout.key(path)
+        entry = self.packs.get(name)
+
+        # The packed copy is the current one.
+        def check_packed(current):
+            check(entry.digest)
+
+        result = await super().commit(
+            path, digest, check_packed if entry and check else check,
+            func, *args, timer=timer
+        )
+        if entry is not None:
+            await self._sync(await self.executor.run(self.packs.delete, name))
+        return result
+
+    async def commit_all(self, commits):
+        results = await super().commit_all(commits)
+        for path, _, _, _ in commits:
+            name = self.layout.key(path)
+            if self.packs.get(name) is not None:
+                await self._sync(await self.executor.run(
+                    self.packs.delete, name,
+                ))
+        return results
+
+    async def add_to_archive(self, writer, name, arcname):
+        entry = await self._read(name)
+        if entry is None:
+            return await super().add_to_archive(writer, name, arcname)
+        await writer.add_entry(entry, arcname)
+
+
+LOCAL_OPTIONS = (
+    ('dedup', False),
+    ('compress', False),
+    ('layout', 'flat'),
+    ('durability', 'none'),
+    ('workers', 1),
+    ('replicate_to', []),
+)
+"""Options, with their default, that only apply to the ``LocalBackend``."""
+
+PACK_OPTIONS = (
+    ('compress', False),
+    # The ``PackStore`` index lives in memory, so it can't be shared.
+    ('workers', 1),
+)
+"""Options, with their default, that don't apply to the ``PackBackend``."""
+
+
+def check_backend(arguments):
+    """Reject options that need files on disk when they aren't used."""
+    options = {
+        'local': (),
+        'memory': LOCAL_OPTIONS,
+        'pack': PACK_OPTIONS,
+    }[arguments.backend]
+    for option, default in options:
+        if getattr(arguments, option) != default:
+            raise ValueError('--%s requires the local backend.' % option)
+
+
+def check_replication(arguments):
+    """Reject replication options that can't be honored."""
+    if arguments.replicas > len(arguments.replicate_to):
+        raise ValueError('--replicas exceeds the number of peers.')
+    if arguments.replicate_to and not arguments.peer_token:
+        raise ValueError('--replicate-to requires --peer-token.')
+    # Each process would resume the jobs left over by the others.
+    if arguments.replicate_to and arguments.workers > 1:
+        raise ValueError('--replicate-to requires a single process.')
+
+
+def check_timing(arguments):
+    """Reject sample rates that aren't fractions and empty profiles."""
+    if not (0.0 <= arguments.timing_sample_rate <= 1.0):
+        raise ValueError('--timing-sample-rate must be between 0 and 1.')
+    if not (0.0 < arguments.profile_seconds <= PROFILE_MAX_SECONDS):
+        raise ValueError('--profile-seconds must be between 0 and %d.' % (
+            PROFILE_MAX_SECONDS,
+        ))
+
+
+def check_logging(endpoint, arguments):
+    """Reject log rotation when several processes write to the log file."""
+    # Each worker would rotate the file under the others' feet.
+    if arguments.workers > 1 and endpoint.startswith('file://'):
+        options = dict(parse_qsl(urlsplit(endpoint).query))
+        if options.get('max-bytes', '0') != '0':
+            raise ValueError('max-bytes requires a single process.')
+
+
+def check_cluster(arguments):
+    """Reject cluster options that can't be honored."""
+    members = {member.rstrip('/') for member in arguments.cluster_members}
+    if arguments.cluster_self is not None and \
+       arguments.cluster_self.rstrip('/') not in members:
+        raise ValueError('--cluster-self is not a --cluster-member.')
+    if members and arguments.cluster_self is None:
+        raise ValueError('--cluster-member requires --cluster-self.')
+    if members and not arguments.peer_token:
+        raise ValueError('--cluster-member requires --peer-token.')
+    if arguments.cluster_vnodes < 1:
+        raise ValueError('--cluster-vnodes must be positive.')
+
+
+def local_backend(request):
+    """The ``LocalBackend``, for features that need files on disk.
+
+    Raises ``HTTPNotImplemented`` with other backends.
+    """
+    backend = request.app['smartmob.backend']
+    if not isinstance(backend, LocalBackend):
+        raise aiohttp.web.HTTPNotImplemented()
+    return backend
+
+
+REPLICA_HEADER = 'X-Smartmob-Replica'
+"""Header marking requests sent by a ``Replicator``."""
+
+PEER_TOKEN_HEADER = 'X-Smartmob-Peer-Token'
+"""Header holding the ``--peer-token`` in requests between servers."""
+
+
+def from_peer(request, header):
+    """Check that a request carries ``header`` and comes from a peer.
+
+    Headers that mark requests between servers (``REPLICA_HEADER`` and
+    ``CLUSTER_HEADER``) change how requests are handled, so clients must
+    not be able to set them: they only count along with the ``--peer-token``.
+    """
+    token = request.app.get('smartmob.peer_token')
+    if not token or header not in request.headers:
+        return False
+    return token_matches(request, PEER_TOKEN_HEADER, token)
+
+
+REPLICATION_BACKOFF = (0.1, 30.0)
+"""First and longest delay (in seconds) between attempts to copy a file."""
+
+REPLICATION_REQUEST_TIMEOUT = 60.0
+"""Seconds a peer may take to answer one copy before it's retried."""
+
+ReplicationJob = collections.namedtuple(
+    'ReplicationJob', 'id peer name digest created',
+)
+"""File to copy to a peer (see ``ReplicationLog``).
+
+Removed files have no digest.
+"""
+
+
+class ReplicationLog:
+    """Persistent queue of files to copy to peers (see ``Replicator``).
+
+    Jobs survive restarts, so that files stored while a peer is unreachable
+    (or while the server is stopped) are eventually copied.  All methods
+    block and should run in the ``IOExecutor``.
+    """
+
+    def __init__(self, storage):
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(
+            os.path.join(storage, INDEX_DIR, 'replication.sqlite3'),
+            timeout=30.0, check_same_thread=False,
+        )
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute(
+            'CREATE TABLE IF NOT EXISTS jobs ('
+            ' id INTEGER PRIMARY KEY AUTOINCREMENT,'
+            ' peer TEXT, name TEXT, digest TEXT, created REAL'
+            ')'
+        )
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    def add(self, peers, files):
+        """Record jobs to copy ``(name, digest)`` pairs to each peer.
+
+        Returns the new ``ReplicationJob``s.
+        """
+        created = time.time()
+        jobs = []
+        with self._lock, self._db:
+            for peer in peers:
+                for name, digest in files:
+                    cursor = self._db.execute(
+                        'INSERT INTO jobs (peer, name, digest, created)'
+                        ' VALUES (?, ?, ?, ?)',
+                        (peer, name, digest, created),
+                    )
+                    jobs.append(ReplicationJob(
+                        cursor.lastrowid, peer, name, digest, created,
+                    ))
+        return jobs
+
+    def jobs(self):
+        """All pending jobs, in order."""
+        with self._lock:
+            return [ReplicationJob(*row) for row in self._db.execute(
+                'SELECT id, peer, name, digest, created FROM jobs'
+                ' ORDER BY id'
+            )]
+
+    def remove(self, job):
+        with self._lock, self._db:
+            self._db.execute('DELETE FROM jobs WHERE id = ?', (job.id,))
+
+
+@asyncio.coroutine
+def stream_body(stream):
+    """Request body for ``aiohttp`` clients, read from a backend stream."""
+    # NOTE: aiohttp sends the bytes yielded by generator-based coroutines.
+    chunk = yield from stream.read(UPLOAD_CHUNK_SIZE)
+    while chunk:
+        yield chunk
+        chunk = yield from stream.read(UPLOAD_CHUNK_SIZE)
+
+
+class Replicator:
+    """Copy stored and removed files to peer servers, in the background.
+
+    Each change is recorded in the ``ReplicationLog`` and queued for each
+    peer, where a task replays the changes in order through the HTTP API,
+    streaming file contents from the backend.  Failed attempts are retried
+    with exponential backoff (see ``REPLICATION_BACKOFF``), so peers catch
+    up once they're reachable again, and jobs left over when the server
+    stopped are resumed on startup.  Files that changed again in the mean
+    time are skipped: a later job copies their new content.  Requests carry
+    the ``REPLICA_HEADER`` and the peer ``token`` so that peers don't copy
+    them back.
+
+    Queues hold up to ``max_pending`` jobs: ``admit()`` rejects uploads
+    while a peer is that far behind.  ``wait()`` lets uploads wait until
+    ``replicas`` peers stored them, for up to ``timeout`` seconds.
+    """
+
+    def __init__(self, peers, backend, log, executor, replicas=0,
+                 max_pending=10000, timeout=30.0, token='', event_log=None,
+                 metrics=None, loop=None):
+        self._loop = loop or asyncio.get_event_loop()
+        self._peers = [peer.rstrip('/') + '/' for peer in peers]
+        self._token = token
+        self._backend = backend
+        self._log = log
+        self._executor = executor
+        self._replicas = replicas
+        self._max_pending = max_pending
+        self._timeout = timeout
+        self._event_log = event_log or structlog.get_logger()
+        self._metrics = metrics
+        self._queues = {peer: collections.deque() for peer in self._peers}
+        self._wakeups = {
+            peer: asyncio.Event(loop=self._loop) for peer in self._peers
+        }
+        self._acks = {}
+        self._session = None
+        self._tasks = []
+        if metrics is not None:
+            metrics.collect(self._sample)
+
+    def pending(self, peer):
+        """Number of jobs waiting for a peer."""
+        return len(self._queues[peer])
+
+    async def start(self):
+        """Resume jobs left over by previous runs and start copying."""
+        for job in await self._executor.run(self._log.jobs):
+            if job.peer in self._queues:
+                self._queues[job.peer].append(job)
+            else:
+                # The peer was removed from the configuration.
+                await self._executor.run(self._log.remove, job)
+        self._session = aiohttp.ClientSession(loop=self._loop)
+        self._tasks = [
+            asyncio.ensure_future(self._run(peer), loop=self._loop)
+            for peer in self._peers
+        ]
+
+    async def close(self):
+        """Stop copying.  Unfinished jobs are resumed on the next start."""
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, loop=self._loop,
+                             return_exceptions=True)
+        self._session.close()
+        await self._executor.run(self._log.close)
+
+    def admit(self):
+        """Reject an upload (503) while a peer is too far behind."""
+        for queue in self._queues.values():
+            if len(queue) >= self._max_pending:
+                raise aiohttp.web.HTTPServiceUnavailable(headers={
+                    'Retry-After': str(math.ceil(REPLICATION_BACKOFF[1])),
+                })
+
+    async def enqueue(self, files):
+        """Queue ``(name, digest)`` pairs for each peer.
+
+        The digest of removed files is ``None``.  Returns a future for each
+        peer, whose result holds ``True`` for each file it stored and
+        ``False`` for each file it rejected.
+        """
+        jobs = await self._executor.run(self._log.add, self._peers, files)
+        acks = {peer: [] for peer in self._peers}
+        for job in jobs:
+            self._acks[job.id] = ack = asyncio.Future(loop=self._loop)
+            acks[job.peer].append(ack)
+            self._queues[job.peer].append(job)
+            self._wakeups[job.peer].set()
+        return [
+            asyncio.gather(*acks[peer], loop=self._loop)
+            for peer in self._peers
+        ]
+
+    async def wait(self, acks):
+        """Wait until ``replicas`` peers stored all files (see ``enqueue()``).
+
+        Raises ``HTTPGatewayTimeout`` when they take longer than ``timeout``
+        seconds (copies still go on in the background) and
+        ``HTTPBadGateway`` when too many peers rejected the files.
+        """
+        needed = self._replicas
+        pending = set(acks)
+        deadline = self._loop.time() + self._timeout
+        while needed > 0:
+            if not pending:
+                raise aiohttp.web.HTTPBadGateway(
+                    text='Peers rejected the file.',
+                )
+            done, pending = await asyncio.wait(
+                pending, timeout=max(0.0, deadline - self._loop.time()),
+                loop=self._loop, return_when=asyncio.FIRST_COMPLETED,
+            )
+            if not done:
+                raise aiohttp.web.HTTPGatewayTimeout(
+                    text='Peers did not store the file in time.',
+                )
+            needed -= sum(1 for ack in done if all(ack.result()))
+
+    async def _run(self, peer):
+        queue = self._queues[peer]
+        wakeup = self._wakeups[peer]
+        delay, max_delay = REPLICATION_BACKOFF
+        while True:
+            if not queue:
+                wakeup.clear()
+                await wakeup.wait()
+                continue
+            job = queue[0]
+            try:
+                outcome = await self._copy(job)
+                await self._executor.run(self._log.remove, job)
+            except asyncio.CancelledError:
+                raise
+            except Exception as error:
+                # Keep the job and try again, rather than stop copying.
+                self._event_log.error(
+                    'replication.error', peer=job.peer, path=job.name,
+                    error=str(error) or type(error).__name__, delay=delay,
+                )
+                await asyncio.sleep(delay, loop=self._loop)
+                delay = min(2 * delay, max_delay)
+                continue
+            delay = REPLICATION_BACKOFF[0]
+            queue.popleft()
+            ack = self._acks.pop(job.id, None)
+            if ack is not None:
+                ack.set_result(outcome != 'failed')
+
+    async def _copy(self, job):
+        """Copy a file to its peer, retrying until it's stored or rejected.
+
+        Returns the outcome: ``copied``, ``skipped`` or ``failed``.
+        """
+        delay, max_delay = REPLICATION_BACKOFF
+        while True:
+            try:
+                outcome, status = await self._send(job)
+            except (aiohttp.errors.ClientError, OSError) as error:
+                outcome, status = None, str(error)
+            except asyncio.TimeoutError:
+                outcome, status = None, 'timeout'
+            self._count(job.peer, outcome or 'error')
+            if outcome is not None:
+                if outcome == 'failed':
+                    self._event_log.error(
+                        'replication.failed', peer=job.peer, path=job.name,
+                        status=status,
+                    )
+                return outcome
+            self._event_log.warning(
+                'replication.retry', peer=job.peer, path=job.name,
+                error=status, delay=delay,
+            )
+            await asyncio.sleep(delay, loop=self._loop)
+            delay = min(2 * delay, max_delay)
+
+    async def _send(self, job):
+        """Make one attempt at copying a file to its peer.
+
+        Returns the outcome (``None`` to retry) and the response status.
+        """
+        backend = self._backend
+        if await backend.digest(job.name) != job.digest:
+            return 'skipped', None
+        url = job.peer + quote(job.name)
+        headers = {REPLICA_HEADER: '1', PEER_TOKEN_HEADER: self._token}
+        if job.digest is None:
+            expected = (204, 404)
+            async with self._session.delete(
+                url, headers=headers, timeout=REPLICATION_REQUEST_TIMEOUT,
+            ) as response:
+                status = response.status
+        else:
+            expected = (201,)
+            info = await backend.stat(job.name)
+            stream = await backend.open(job.name)
+            headers['Content-Length'] = str(info.size)
+            headers['Digest'] = 'SHA-256=%s' % base64.b64encode(
+                binascii.unhexlify(job.digest),
+            ).decode('ascii')
+            try:
+                async with self._session.put(
+                    url, data=stream_body(stream), headers=headers,
+                    timeout=REPLICATION_REQUEST_TIMEOUT,
+                ) as response:
+                    status = response.status
+            finally:
+                await stream.close()
+        if status in expected:
+            return 'copied', status
+        # The file may have changed while we sent it.
+        if await backend.digest(job.name) != job.digest:
+            return 'skipped', status
+        if 400 <= status < 500 and status not in (408, 429):
+            return 'failed', status
+        return None, status
+
+    def _count(self, peer, outcome):
+        if self._metrics is not None:
+            self._metrics.replication_copies.inc(labels=(peer, outcome))
+
+    def _sample(self):
+        now = time.time()
+        for peer, queue in self._queues.items():
+            self._metrics.replication_queue.set(len(queue), (peer,))
+            self._metrics.replication_lag.set(
+                (now - queue[0].created) if queue else 0.0, (peer,),
+            )
+
+
+def admit_replica(request):
+    """Reject uploads while peers lag too far behind (see ``Replicator``)."""
+    replicator = request.app.get('smartmob.replicator')
+    if replicator is not None and not from_peer(request, REPLICA_HEADER):
+        replicator.admit()
+
+
+async def replicate(request, files):
+    """Copy stored (or removed) files to peers, see ``Replicator``.
+
+    ``files`` holds ``(name, digest)`` pairs (the digest of removed files is
+    ``None``).  Waits for acknowledgements from ``--replicas`` peers.
+    Changes copied from another server aren't copied further.
+    """
+    replicator = request.app.get('smartmob.replicator')
+    if replicator is None or from_peer(request, REPLICA_HEADER):
+        return
+    await replicator.wait(await replicator.enqueue(files))
+
+
+CLUSTER_HEADER = 'X-Smartmob-Forwarded'
+"""Header marking requests routed to their owner (see ``Cluster``)."""
+
+CLUSTER_PROXY_TIMEOUT = 60.0
+"""Seconds a member may take to answer a proxied request (see ``Cluster``)."""
+
+HOP_HEADERS = frozenset((
+    'accept-encoding',
+    'connection',
+    'expect',
+    'host',
+    'keep-alive',
+    'proxy-authenticate',
+    'proxy-authorization',
+    'te',
+    'trailer',
+    'transfer-encoding',
+    'upgrade',
+))
+"""Headers that aren't copied to and from proxied requests."""
+
+PEER_HEADERS = frozenset(
+    header.lower()
+    for header in (REPLICA_HEADER, CLUSTER_HEADER, PEER_TOKEN_HEADER)
+)
+"""Headers of requests between servers, which clients can't forward."""
+
+
+def ring_hash(key):
+    """Position of a key on the ``HashRing``."""
+    return int.from_bytes(
+        hashlib.sha1(key.encode('utf-8')).digest()[:8], 'big',
+    )
+
+
+class HashRing:
+    """Consistent hashing of file names to cluster members.
+
+    Each member owns ``vnodes`` points on the ring, and each name belongs
+    to the member owning the next point after the name's hash.  Adding or
+    removing a member only moves the names between its points and the
+    previous ones: about ``1/N`` of the names, all of them to (or from) the
+    member that changed.  Virtual nodes spread each member's share so that
+    members own a similar number of files.  All members must be configured
+    with the same member list and ``vnodes`` to agree on owners.
+    """
+
+    def __init__(self, members, vnodes):
+        points = sorted(
+            (ring_hash('%s#%d' % (member, i)), member)
+            for member in set(members) for i in range(vnodes)
+        )
+        self._hashes = [point for point, _ in points]
+        self._members = [member for _, member in points]
+
+    def owner(self, name):
+        """Member that stores the file with a given name."""
+        i = bisect.bisect(self._hashes, ring_hash(name))
+        return self._members[i % len(self._members)]
+
+
+class Cluster:
+    """Route requests for files to the cluster member that owns them.
+
+    Members are identified by their base URL, one of which is ``url``.
+    Requests for files owned by other members are answered with a 307
+    redirect to the owner or, with the ``proxy`` routing, forwarded to the
+    owner, streaming both bodies.  Forwarded requests carry the
+    ``CLUSTER_HEADER`` and the peer ``token`` so that they are always
+    handled by the member that receives them, even while members disagree
+    on the member list.
+
+    Proxied requests ask for uncompressed content, since the client of this
+    version of ``aiohttp`` can't pass compressed bodies through.
+
+    Listings and archives only cover the files of the member that serves
+    them, and archive uploads are rejected because their files may belong to
+    several members.  See ``smartmob_filestore.rebalance`` to move files to
+    their owner when members are added or removed.
+    """
+
+    def __init__(self, members, url, vnodes, routing='redirect', token='',
+                 loop=None):
+        self._loop = loop or asyncio.get_event_loop()
+        self.url = url.rstrip('/') + '/'
+        self._token = token
+        self.ring = HashRing(
+            [member.rstrip('/') + '/' for member in members], vnodes,
+        )
+        self.routing = routing
+        self._session = aiohttp.ClientSession(loop=self._loop)
+
+    def close(self):
+        self._session.close()
+
+    async def route(self, request, handler):
+        """Handle a request here or send it to the owner of its file."""
+        if from_peer(request, CLUSTER_HEADER) or \
+           from_peer(request, REPLICA_HEADER):
+            return await handler(request)
+        if request.method == 'POST':
+            raise aiohttp.web.HTTPBadRequest(
+                text='Archive uploads are not supported in cluster mode.',
+            )
+        if not request.match_info.get('path') or 'archive' in request.GET:
+            return await handler(request)
+        owner = self.ring.owner(storage_name(request))
+        if owner == self.url:
+            return await handler(request)
+        url = owner[:-1] + request.raw_path
+        if self.routing == 'redirect':
+            raise aiohttp.web.HTTPTemporaryRedirect(url)
+        return await self.proxy(request, url)
+
+    async def proxy(self, request, url):
+        """Forward a request to another member and stream its response.
+
+        Members that don't answer within ``CLUSTER_PROXY_TIMEOUT`` seconds
+        fail the request with a 504, and unreachable ones with a 502.
+        """
+        headers = {
+            name: value for name, value in request.headers.items()
+            if name.lower() not in HOP_HEADERS and
+            name.lower() not in PEER_HEADERS
+        }
+        headers[CLUSTER_HEADER] = self.url
+        headers[PEER_TOKEN_HEADER] = self._token
+        headers['Accept-Encoding'] = 'identity'
+        body = None
+        if request.method == 'PUT':
+            send_continue(request)
+            body = request.content
+        try:
+            async with self._session.request(
+                request.method, url, headers=headers, data=body,
+                allow_redirects=False, timeout=CLUSTER_PROXY_TIMEOUT,
+            ) as upstream:
+                response = aiohttp.web.StreamResponse(
+                    status=upstream.status, headers={
+                        name: value
+                        for name, value in upstream.headers.items()
+                        if name.lower() not in HOP_HEADERS
+                    },
+                )
+                await response.prepare(request)
+                if request.method != 'HEAD':
+                    chunk = await upstream.content.read(DOWNLOAD_CHUNK_SIZE)
+                    while chunk:
+                        response.write(chunk)
+                        await response.drain()
+                        chunk = await upstream.content.read(
+                            DOWNLOAD_CHUNK_SIZE,
+                        )
+                await response.write_eof()
+        except (aiohttp.errors.ClientError, OSError):
+            raise aiohttp.web.HTTPBadGateway(
+                text='Cluster member %s is unavailable.' % url,
+            )
+        except asyncio.TimeoutError:
+            raise aiohttp.web.HTTPGatewayTimeout(
+                text='Cluster member %s did not answer in time.' % url,
+            )
+        return response
+
+
+async def cluster_middleware(app, handler):
+    """Route requests through the ``Cluster``, if enabled."""
+
+    cluster = app.get('smartmob.cluster')
+    if cluster is None:
+        return handler
+
+    async def route(request):
+        return await cluster.route(request, handler)
+
+    return route
+
+
+async def upload(request):
+    """Streaming file upload.
+
+    The request body is written to the backend, one chunk at a time, and
+    committed once complete.  With the ``LocalBackend``, it's copied into a
+    temporary file in the staging area and then atomically renamed into
+    place.  Memory usage is bounded by ``UPLOAD_CHUNK_SIZE`` and readers
+    never see partial files.  The body is checked against the ``Digest``
+    header, if any.
+
+    With deduplication enabled, identical files share the same storage (see
+    ``commit_blob()``).  Clients that announce the digest and wait for
+    "100 Continue" don't even need to send content the server already has.
+
+    Requests with a ``Content-Range`` header are handled by
+    ``upload_range()``, others by ``upload_file()``.
+
+    Uploads go through ``AdmissionControl`` and uploads to the same path
+    are handled one at a time.  Sampled requests measure the ``lock`` and
+    ``admission`` waits, then the ``recv``, ``write``, ``fsync`` and
+    ``rename`` stages (see ``RequestTimer``).
+    """
+    name = storage_name(request)
+    admit_replica(request)
+    timer = request_timer(request)
+    ref = timer.now()
+    async with request.app['smartmob.locks'].hold(name):
+        timer.record('lock', ref)
+        ref = timer.now()
+        async with request.app['smartmob.admission'].admit(
+            request.content_length or 0,
+        ):
+            timer.record('admission', ref)
+            content_range = request.headers.get('Content-Range')
+            if content_range is not None:
+                return await upload_range(request, name, content_range)
+            return await upload_file(request, name)
+
+
+async def upload_file(request, name):
+    """Upload a whole file at once (see ``upload()``)."""
+    backend = request.app['smartmob.backend']
+    dedup = request.app.get('smartmob.dedup', False)
+    expected_digest = request_digest(request)
+    timer = request_timer(request)
+
+    # Fail early, before receiving the body.
+    check = put_preconditions(request)
+    if check:
+        check(await backend.digest(name))
+
+    # Skip the transfer if we already have the content.
+    if dedup and expected_digest and \
+       request.headers.get('Expect', '').lower() == '100-continue':
+        try:
+            with path_conflict(name):
+                await commit(request, name, expected_digest, backend.link(
+                    name, expected_digest, check,
+                ))
+        except FileNotFoundError:
+            pass
+        else:
+            return created(request, expected_digest)
+
+    send_continue(request)
+    writer = await backend.create(name)
+    try:
+        with timer.span('recv'):
+            chunk = await request.content.read(UPLOAD_CHUNK_SIZE)
+        while chunk:
+            with timer.span('write'):
+                await writer.write(chunk)
+            with timer.span('recv'):
+                chunk = await request.content.read(UPLOAD_CHUNK_SIZE)
+        digest = writer.hexdigest()
+        if expected_digest and digest != expected_digest:
+            raise aiohttp.web.HTTPBadRequest(text='Digest mismatch.')
+        with path_conflict(name):
+            await commit(request, name, digest, writer.commit(check, timer))
+    except Exception:
+        await writer.abort()
+        raise
+    request['smartmob.upload_size'] = writer.size
+    return created(request, digest)
+
+
+async def commit(request, name, digest, operation):
+    """Wait for a backend ``operation`` that replaces a file.
+
+    Cached copies are invalidated and compressed copies of the new content
+    are stored in the background.  ``operation`` returns ``True`` when the
+    upload was deduplicated.
+    """
+    cache = request.app.get('smartmob.cache')
+    try:
+        dedup = await operation
+    finally:
+        if cache is not None:
+            cache.invalidate(name)
+    if request.app.get('smartmob.dedup', False):
+        request['smartmob.access_log']['dedup'] = dedup
+    compress_later(request, name, digest)
+    compact_later(request)
+    await replicate(request, [(name, digest)])
+
+
+@contextlib.contextmanager
+def path_conflict(name):
+    """Reject uploads whose file collides with a directory (or vice versa).
+
+    Raises ``HTTPConflict``, like ``commit_archive()``.
+    """
+    try:
+        yield
+    except (FileExistsError, IsADirectoryError, NotADirectoryError):
+        raise aiohttp.web.HTTPConflict(
+            text='Conflicting path: "%s".' % name,
+        )
+
+
+def created(request, digest):
+    """Response for a successful upload."""
+    return aiohttp.web.Response(status=201, headers={
+        'x-request-id': request.headers.get('x-request-id', '?'),
+        'ETag': make_etag(digest),
+    })
+
+
+async def upload_range(request, name, content_range):
+    """Resumable file upload.
+
+    Each request carries one ``Content-Range`` of the file, which is written
+    into a partial file in the staging area.  Chunks must start at or before
+    the end of the data received so far.  While the file is incomplete, the
+    response is a 202 with a ``Range`` header stating which bytes were
+    received.  ``Content-Range: bytes */<total>`` queries that status without
+    sending data, so clients can resume after losing a connection.  The file
+    is renamed into place (201) once the last byte is received (right away
+    for ``bytes */0``: empty files have no chunks).
+
+    The total size declared by the first chunk is recorded next to the
+    partial file, and requests that declare another total are rejected with
+    a 400.  Partial files are kept across restarts, until they expire (see
+    ``--partial-upload-ttl``).
+
+    Preconditions (``If-Match`` and ``If-None-Match``) are checked for each
+    request and once more when the file is complete.  The partial file is
+    discarded as soon as they fail, or when the complete file collides with
+    a directory (409).  Requires the ``LocalBackend``.
+    """
+    backend = local_backend(request)
+    executor = request.app['smartmob.executor']
+    timer = request_timer(request)
+    path = backend.locate(name)
+    start, end, total = parse_content_range(content_range)
+    digest = hashlib.sha1(path.encode('utf-8')).hexdigest()
+    partial = staging_path(request, PARTIAL_PREFIX + digest)
+    check = put_preconditions(request)
+    if check:
+        try:
+            check(await backend.digest(name))
+        except aiohttp.web.HTTPPreconditionFailed:
+            await executor.run(discard_partial, partial)
+            raise
+    declared = await executor.run(
+        read_partial_total, partial + PARTIAL_TOTAL_SUFFIX,
+    )
+    if declared is not None and declared != total:
+        raise aiohttp.web.HTTPBadRequest(text='Total size mismatch.')
+    try:
+        size = (await executor.run(os.stat, partial)).st_size
+    except FileNotFoundError:
+        size = 0
+    if size > total:
+        raise aiohttp.web.HTTPBadRequest(text='Total size mismatch.')
+
+    def incomplete(status, size):
+        headers = {}
+        if size:
+            headers['Range'] = 'bytes=0-%d' % (size - 1)
+        return status(headers=headers)
+
+    if start is not None:
+        if start > size:
+            raise incomplete(aiohttp.web.HTTPRequestRangeNotSatisfiable, size)
+
+        # Keep what we receive, even if the connection drops mid-way.
+        send_continue(request)
+        if declared is None:
+            await executor.run(
+                write_partial_total, partial + PARTIAL_TOTAL_SUFFIX, total,
+            )
+        expected = end - start + 1
+        stream = await executor.run(open_staged, partial)
+        try:
+            await executor.run(stream.seek, start)
+            while expected > 0:
+                with timer.span('recv'):
+                    chunk = await request.content.read(
+                        min(UPLOAD_CHUNK_SIZE, expected),
+                    )
+                if not chunk:
+                    break
+                with timer.span('write'):
+                    await executor.run(stream.write, chunk)
+                expected -= len(chunk)
+        finally:
+            await executor.run(stream.close)
+        size = max(size, end + 1 - expected)
+        if expected or (await request.content.read(1)):
+            raise aiohttp.web.HTTPBadRequest()
+
+    if size < total:
+        return incomplete(aiohttp.web.HTTPAccepted, size)
+    if not total:
+        # Empty files are complete without any chunk.
+        stream = await executor.run(open_staged, partial)
+        await executor.run(stream.close)
+    with timer.span('hash'):
+        digest = await executor.run(hash_file, partial)
+    try:
+        with path_conflict(name):
+            await commit(request, name, digest, backend.commit_file(
+                partial, path, digest, check, timer,
+            ))
+    except (aiohttp.web.HTTPPreconditionFailed, aiohttp.web.HTTPConflict):
+        await executor.run(discard_partial, partial)
+        raise
+    await executor.run(discard, partial + PARTIAL_TOTAL_SUFFIX)
+    request['smartmob.upload_size'] = total
+    return created(request, digest)
+
+
+ArchiveFile = collections.namedtuple('ArchiveFile', 'path temp digest size')
+"""File extracted from an uploaded archive (see ``extract_archive()``)."""
+
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+"""First bytes of zstd-compressed data."""
+
+
+class BodyReader(io.RawIOBase):
+    """Blocking file object over a request body, for use in another thread.
+
+    Each read waits for the event loop to receive the data, so libraries
+    that expect file objects (e.g. ``tarfile``) can process the body as it
+    arrives.  Reads that wait longer than ``timeout`` seconds raise
+    ``HTTPRequestTimeout``, so stalled clients don't hold the thread.
+    """
+
+    def __init__(self, content, loop, timeout=None):
+        super().__init__()
+        self._content = content
+        self._loop = loop
+        self._timeout = timeout
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        future = asyncio.run_coroutine_threadsafe(
+            self._content.read(len(buffer)), self._loop,
+        )
+        try:
+            chunk = future.result(self._timeout)
+        except concurrent.futures.TimeoutError:
+            future.cancel()
+            raise aiohttp.web.HTTPRequestTimeout(
+                text='Timed out waiting for the request body.',
+            )
+        buffer[:len(chunk)] = chunk
+        return len(chunk)
+
+
+def open_archive(stream):
+    """Open a tar archive for sequential reading.
+
+    ``tarfile`` detects gzip, bzip2 and xz compression.  zstd compression
+    requires the optional ``zstandard`` package.  ``stream`` must be an
+    ``io.BufferedReader``.
+    """
+    if stream.peek(len(ZSTD_MAGIC))[:len(ZSTD_MAGIC)] == ZSTD_MAGIC:
+        if zstandard is None:
+            raise aiohttp.web.HTTPUnsupportedMediaType(
+                text='zstd archives are not supported.',
+            )
+        stream = zstandard.ZstdDecompressor().stream_reader(stream)
+        return tarfile.open(fileobj=stream, mode='r|')
+    return tarfile.open(fileobj=stream, mode='r|*')
+
+
+def archive_member_path(layout, root, name):
+    """Path where an archive member is extracted, or ``None`` if unsafe."""
+    if os.path.isabs(name) or '..' in name.split('/'):
+        return None
+    return layout.resolve(os.path.join(root, name))
+
+
+def extract_archive(stream, layout, root):
+    """Extract the files of a tar archive under ``root``, into the staging area.
+
+    Files are hashed as they are extracted.  Returns ``ArchiveFile``s, in
+    archive order.  Members that have the same path as an earlier member
+    replace it.  Raises ``HTTPBadRequest`` for invalid archives, for members
+    that would land outside ``root`` or in reserved directories and for
+    members other than regular files and directories (e.g. links).
+    """
+    files = collections.OrderedDict()
+    temp = None
+    try:
+        try:
+            with open_archive(stream) as archive:
+                for member in archive:
+                    path = archive_member_path(layout, root, member.name)
+                    if path is None:
+                        raise aiohttp.web.HTTPBadRequest(
+                            text='Invalid path in archive: "%s".' % (
+                                member.name,
+                            ),
+                        )
+                    if member.isdir():
+                        continue
+                    if not member.isfile():
+                        raise aiohttp.web.HTTPBadRequest(
+                            text='Unsupported archive member: "%s".' % (
+                                member.name,
+                            ),
+                        )
+                    temp = os.path.join(
+                        layout.storage, STAGING_DIR,
+                        'archive-%s' % uuid.uuid4().hex,
+                    )
+                    digest = hashlib.sha256()
+                    source = archive.extractfile(member)
+                    with open(temp, 'xb') as output:
+                        chunk = source.read(UPLOAD_CHUNK_SIZE)
+                        while chunk:
+                            write_and_hash(output, digest, chunk)
+                            chunk = source.read(UPLOAD_CHUNK_SIZE)
+                    previous = files.pop(path, None)
+                    if previous:
+                        os.unlink(previous.temp)
+                    files[path] = ArchiveFile(
+                        path, temp, digest.hexdigest(), member.size,
+                    )
+                    temp = None
+        except tarfile.TarError as error:
+            raise aiohttp.web.HTTPBadRequest(
+                text='Invalid archive: %s.' % error,
+            )
+    except BaseException:
+        if temp:
+            discard(temp)
+        for file in files.values():
+            discard(file.temp)
+        raise
+    return list(files.values())
+
+
+def make_parents(path):
+    """Create the missing parent directories of ``path``.
+
+    Returns the directories that were created, top-down.
+    """
+    missing = []
+    parent = os.path.dirname(path)
+    while parent and not os.path.isdir(parent):
+        missing.append(parent)
+        parent = os.path.dirname(parent)
+    created = []
+    for parent in reversed(missing):
+        try:
+            os.mkdir(parent)
+        except FileExistsError:
+            # Another upload may have created it in the mean time.
+            if os.path.isdir(parent):
+                continue
+            raise
+        created.append(parent)
+    return created
+
+
+def install(path, func, *args, created=None):
+    """Create the parent directories of ``path`` and run ``func(*args)``.
+
+    The directories that were created are appended to ``created``, so the
+    caller can make them durable (see ``Durability.sync_dirs()``).
+    """
+    parents = make_parents(path)
+    if created is not None:
+        created.extend(parents)
+    return func(*args)
+
+
+async def commit_archive(request, files):
+    """Move files extracted from an archive into place, all or nothing.
+
+    Raises ``HTTPConflict`` when a file collides with a directory (or the
+    other way around).
+    """
+    backend = request.app['smartmob.backend']
+    cache = request.app.get('smartmob.cache')
+    await backend.durability.sync_files([file.temp for file in files])
+    created = []
+    commits = []
+    for file in files:
+        if backend.dedup:
+            args = (
+                file.path, commit_blob,
+                file.temp, blob_path(backend.storage, file.digest), file.path,
+            )
+        else:
+            args = (file.path, os.replace, file.temp, file.path)
+        commits.append((
+            file.path, file.digest,
+            functools.partial(install, created=created), args,
+        ))
+    try:
+        await backend.commit_all(commits)
+    except (FileExistsError, IsADirectoryError, NotADirectoryError) as error:
+        raise aiohttp.web.HTTPConflict(text='Conflicting path: "%s".' % (
+            backend.layout.key(error.filename),
+        ))
+    finally:
+        if cache is not None:
+            for file in files:
+                cache.invalidate(backend.layout.key(file.path))
+    await backend.durability.sync_dirs(
+        [file.path for file in files] + created,
+    )
+    for file in files:
+        compress_later(request, backend.layout.key(file.path), file.digest)
+    compact_later(request)
+    await replicate(request, [
+        (backend.layout.key(file.path), file.digest) for file in files
+    ])
+
+
+async def upload_archive(request):
+    """Bulk upload of a tar archive.
+
+    ``POST /<dir>`` extracts the regular files of a tar archive (optionally
+    compressed, see ``open_archive()``) under ``<dir>``, creating directories
+    as needed.  The archive is extracted into the staging area as it's
+    received, so memory usage is bounded.  Files are committed once the
+    whole archive was received, in a single ``DigestIndex`` transaction: if
+    any file can't be placed, the others are restored.  Unsafe members fail
+    the whole upload (see ``extract_archive()``).
+
+    The response is a JSON manifest of the files, each with its ``path``
+    (relative to the storage root), ``size`` and ``digest``.  Archives go
+    through ``AdmissionControl`` like other uploads.  Requires the
+    ``LocalBackend``.
+
+    Archives are extracted by their own thread pool (``--archive-threads``)
+    because the extraction waits for the body: slow clients must not hold
+    the ``IOExecutor`` threads that serve other requests.  Uploads that
+    stall for ``--archive-read-timeout`` seconds fail with a 408.
+    """
+    executor = request.app['smartmob.executor']
+    layout = local_backend(request).layout
+    root = resolve_name(layout.storage, request.match_info['path'])
+    if root is None:
+        raise aiohttp.web.HTTPNotFound()
+    admit_replica(request)
+    stream = io.BufferedReader(BodyReader(
+        request.content, request.app.loop,
+        request.app.get('smartmob.archive_read_timeout'),
+    ), UPLOAD_CHUNK_SIZE)
+    async with request.app['smartmob.admission'].admit(
+        request.content_length or 0,
+    ):
+        files = await request.app['smartmob.archive_executor'].run(
+            extract_archive, stream, layout, root,
+        )
+        try:
+            await commit_archive(request, files)
+        except Exception:
+            for file in files:
+                await executor.run(discard, file.temp)
+            raise
+    request['smartmob.upload_size'] = sum(file.size for file in files)
+    request['smartmob.access_log']['files'] = len(files)
+    return aiohttp.web.json_response({
+        'files': [
+            {
+                'path': layout.key(file.path),
+                'size': file.size,
+                'digest': file.digest,
+            }
+            for file in files
+        ],
+    }, status=201)
+
+
+LIST_LIMIT = 100
+"""Default number of files per page of listings."""
+
+LIST_MAX_LIMIT = 1000
+"""Maximum number of files per page of listings."""
+
+
+async def listing(request):
+    """Paginated JSON listing of stored files.
+
+    ``GET /?list`` returns ``{"files": [...], "cursor": ...}`` where each
+    file has its ``path``, ``size`` and ``mtime``.  The ``prefix`` parameter
+    filters files by path, ``limit`` sets the page size and ``cursor`` (from
+    the previous page) selects the next page.  The last page has a ``null``
+    cursor.  Without the ``list`` parameter, the storage root isn't listed.
+    """
+    if 'archive' in request.GET:
+        return await download_archive(request)
+    if 'list' not in request.GET:
+        raise aiohttp.web.HTTPForbidden()
+    backend = request.app['smartmob.backend']
+    prefix = request.GET.get('prefix', '')
+    try:
+        limit = int(request.GET.get('limit', LIST_LIMIT))
+        after = base64.urlsafe_b64decode(
+            request.GET.get('cursor', '').encode('ascii'),
+        ).decode('utf-8')
+    except (ValueError, binascii.Error):
+        raise aiohttp.web.HTTPBadRequest()
+    if not (0 < limit <= LIST_MAX_LIMIT):
+        raise aiohttp.web.HTTPBadRequest()
+    rows = await backend.list(prefix, after, limit + 1)
+    cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        cursor = base64.urlsafe_b64encode(
+            rows[-1][0].encode('utf-8'),
+        ).decode('ascii')
+    return aiohttp.web.json_response({
+        'files': [
+            {
+                'path': path,
+                'size': size,
+                'mtime': datetime.fromtimestamp(
+                    mtime / 1e9, timezone.utc,
+                ).isoformat(),
+            }
+            for path, size, mtime in rows
+        ],
+        'cursor': cursor,
+    })
+
+
+async def download(request):
+    """Streaming file download.
+
+    Directories are not listed (403) and missing files yield a 404.  Single
+    byte ranges are supported through ``Range`` and ``If-Range``.  Responses
+    carry a strong ``ETag`` from the backend (the ``DigestIndex`` of the
+    ``LocalBackend``), so ``If-None-Match`` is answered without reading the
+    file (once it's indexed).
+
+    Small files are served from the ``ContentCache``, when enabled.
+
+    Compressed copies stored on upload are served instead of the file when
+    ``Accept-Encoding`` prefers them.  They have their own ``ETag``.
+
+    Requests with an ``archive`` parameter are handled by
+    ``download_archive()``.
+
+    Sampled requests measure the ``cache_lookup``, ``stat``, ``hash``,
+    ``open``, ``read`` and ``send`` stages (see ``RequestTimer``).  Files
+    loaded into the cache count under ``read``.
+    """
+    if 'archive' in request.GET:
+        return await download_archive(request)
+
+    backend = request.app['smartmob.backend']
+    cache = request.app.get('smartmob.cache')
+    name = storage_name(request)
+    timer = request_timer(request)
+
+    entry = None
+    with timer.span('cache_lookup'):
+        if cache is not None:
+            entry = cache.get(name)
+        if entry and cache.validate:
+            try:
+                info = await backend.stat(name)
+            except OSError:
+                info = None
+            if info is None or info.identity != entry.info.identity:
+                cache.invalidate(name)
+                entry = None
+
+    if entry is None:
+        with timer.span('stat'):
+            try:
+                info = await backend.stat(name)
+            except IsADirectoryError:
+                raise aiohttp.web.HTTPForbidden()
+            except (FileNotFoundError, NotADirectoryError):
+                raise aiohttp.web.HTTPNotFound()
+        if cache is not None and cache.admits(info.size):
+            token = cache.token()
+            with timer.span('read'):
+                entry = await backend.load(name)
+            cache.put(name, entry, token)
+    if entry is None:
+        with timer.span('hash'):
+            digest = await backend.digest(name)
+    else:
+        info, digest = entry.info, entry.digest
+
+    # Pick a compressed copy, if the client accepts one.
+    tag, size = digest, info.size
+    headers = {}
+    encoding = variant = None
+    if 'smartmob.compress' in request.app and compressible(name):
+        headers['Vary'] = 'Accept-Encoding'
+        encoding = negotiate_encoding(
+            request.headers.get('Accept-Encoding', ''), VARIANT_ENCODINGS,
+        )
+    if encoding:
+        size = await backend.variant(digest, encoding)
+        if size is None:
+            encoding, size = None, info.size
+        else:
+            variant, tag, entry = encoding, '%s-%s' % (digest, encoding), None
+    headers['ETag'] = etag = make_etag(tag)
+
+    if_none_match = request.headers.get('If-None-Match')
+    if if_none_match is not None:
+        if etag_matches(if_none_match, tag, weak=True):
+            raise aiohttp.web.HTTPNotModified(headers=headers)
+    else:
+        modified_since = request.if_modified_since
+        if modified_since and info.mtime <= modified_since.timestamp():
+            raise aiohttp.web.HTTPNotModified(headers=headers)
+
+    byte_range = None
+    if 'Range' in request.headers and if_range_matches(request, info, etag):
+        byte_range = parse_range(request.headers['Range'], size)
+
+    response = aiohttp.web.StreamResponse(headers=headers)
+    content_type, content_encoding = mimetypes.guess_type(name)
+    response.content_type = content_type or 'application/octet-stream'
+    encoding = encoding or content_encoding
+    if encoding:
+        response.headers['Content-Encoding'] = encoding
+    response.headers['Accept-Ranges'] = 'bytes'
+    response.last_modified = info.mtime
+    if byte_range:
+        start, end = byte_range
+        response.set_status(206)
+        response.headers['Content-Range'] = 'bytes %d-%d/%d' % (
+            start, end, size,
+        )
+    else:
+        start, end = 0, size - 1
+    response.content_length = remaining = end - start + 1
+
+    if entry is not None:
+        with timer.span('send'):
+            await response.prepare(request)
+            if request.method != 'HEAD':
+                response.write(entry.data[start:end + 1])
+        return response
+
+    with timer.span('open'):
+        if variant:
+            stream = await backend.open_variant(digest, variant)
+        else:
+            stream = await backend.open(name)
+    try:
+        with timer.span('send'):
+            await response.prepare(request)
+        if request.method != 'HEAD':
+            with timer.span('read'):
+                await stream.seek(start)
+                chunk = await stream.read(
+                    min(DOWNLOAD_CHUNK_SIZE, remaining),
+                )
+            while chunk:
+                remaining -= len(chunk)
+                with timer.span('send'):
+                    response.write(chunk)
+                    await response.drain()
+                with timer.span('read'):
+                    chunk = await stream.read(
+                        min(DOWNLOAD_CHUNK_SIZE, remaining),
+                    )
+    finally:
+        await stream.close()
+    return response
+
+
+async def delete(request):
+    """File removal.
+
+    Responds with a 204 once the file is removed and a 404 when there is
+    no such file.  Directories can't be removed (403).  ``If-Match`` and
+    ``If-None-Match`` are honored, as for uploads, and uploads to the same
+    path wait for the removal.
+    """
+    backend = request.app['smartmob.backend']
+    cache = request.app.get('smartmob.cache')
+    name = storage_name(request)
+    admit_replica(request)
+    async with request.app['smartmob.locks'].hold(name):
+        try:
+            await backend.delete(name, put_preconditions(request))
+        except IsADirectoryError:
+            raise aiohttp.web.HTTPForbidden()
+        except (FileNotFoundError, NotADirectoryError):
+            raise aiohttp.web.HTTPNotFound()
+        finally:
+            if cache is not None:
+                cache.invalidate(name)
+    compact_later(request)
+    await replicate(request, [(name, None)])
+    return aiohttp.web.Response(status=204)
+
+
+ARCHIVE_TYPES = {
+    '': ('application/x-tar', '.tar', False),
+    'tar': ('application/x-tar', '.tar', False),
+    'gz': ('application/gzip', '.tar.gz', True),
+}
+"""Content type, file extension and compression of archive downloads."""
+
+SENDFILE_MIN_SIZE = 64 * 1024
+"""Size of the smallest file sent with ``os.sendfile()`` in archives."""
+
+
+async def writable(sock, loop):
+    """Wait until a non-blocking socket can be written to."""
+    ready = asyncio.Future(loop=loop)
+    loop.add_writer(sock.fileno(), ready.set_result, None)
+    try:
+        await ready
+    finally:
+        loop.remove_writer(sock.fileno())
+
+
+async def sendfile(sock, stream, size, loop):
+    """Send ``size`` bytes of a file on a non-blocking socket.
+
+    Data goes straight from the page cache to the socket, without being
+    copied through user space.  Raises ``EOFError`` when the file is shorter
+    than ``size``.
+    """
+    offset = 0
+    while offset < size:
+        try:
+            sent = os.sendfile(
+                sock.fileno(), stream.fileno(), offset, size - offset,
+            )
+        except (BlockingIOError, InterruptedError):
+            await writable(sock, loop)
+        else:
+            if sent == 0:
+                raise EOFError('File truncated while sending.')
+            offset += sent
+
+
+def read_chunk(stream, size, compressor=None):
+    """Read up to ``size`` bytes from a file, compressing them if asked to.
+
+    Returns the number of bytes read and the data to send.  Raises
+    ``EOFError`` at the end of the file.
+    """
+    data = stream.read(size)
+    if not data:
+        raise EOFError('File truncated while sending.')
+    if compressor is not None:
+        return len(data), compressor.compress(data)
+    return len(data), data
+
+
+def tar_header(name, size, mtime, mode=0o644):
+    """Tar header block(s) for a regular file."""
+    member = tarfile.TarInfo(name)
+    member.size = size
+    member.mtime = int(mtime)
+    member.mode = mode
+    return member.tobuf(tarfile.PAX_FORMAT, 'utf-8', 'surrogateescape')
+
+
+class ArchiveWriter:
+    """Writes a tar archive to a prepared ``StreamResponse``.
+
+    The response must use chunked transfer encoding.  Uncompressed archives
+    send large files with ``sendfile()`` on a duplicate of the connection's
+    socket, in chunks that are framed by hand, after the transport's buffer
+    is drained.  Other files are copied in ``DOWNLOAD_CHUNK_SIZE`` chunks.
+    """
+
+    def __init__(self, request, response, compress):
+        self._executor = request.app['smartmob.executor']
+        self._loop = request.app.loop
+        self._response = response
+        self._transport = request.transport
+        self._compressor = None
+        self._socket = None
+        if compress:
+            self._compressor = zlib.compressobj(
+                6, zlib.DEFLATED, 16 + zlib.MAX_WBITS,
+            )
+        elif hasattr(os, 'sendfile'):  # pragma: no branch
+            sock = self._transport.get_extra_info('socket')
+            if sock is not None:
+                self._socket = sock.dup()
+                self._socket.setblocking(False)
+                # Make ``drain()`` wait until the buffer is empty.
+                self._transport.set_write_buffer_limits(high=0)
+        self._offset = 0
+        self.sent = 0
+
+    async def _write(self, data, size=None):
+        """Send archive data, of which ``size`` bytes are already encoded."""
+        if size is None:
+            self._offset += len(data)
+            if self._compressor is not None:
+                data = self._compressor.compress(data)
+        else:
+            self._offset += size
+        if data:
+            self._response.write(data)
+            self.sent += len(data)
+            await self._response.drain()
+
+    async def add(self, path, name):
+        """Add the file at ``path`` to the archive, as ``name``.
+
+        Files that were removed in the mean time are skipped.
+        """
+        try:
+            stream = await self._executor.run(open, path, 'rb')
+        except FileNotFoundError:
+            return
+        try:
+            info = await self._executor.run(os.fstat, stream.fileno())
+            await self._write(tar_header(
+                name, info.st_size, info.st_mtime, stat.S_IMODE(info.st_mode),
+            ))
+            size = info.st_size
+            if self._socket is not None and size >= SENDFILE_MIN_SIZE:
+                # Transport is empty after ``_write()``, send a chunk directly.
+                await self._loop.sock_sendall(self._socket, b'%x\r\n' % size)
+                await sendfile(self._socket, stream, size, self._loop)
+                await self._loop.sock_sendall(self._socket, b'\r\n')
+                self._offset += size
+                self.sent += size
+            else:
+                remaining = size
+                while remaining > 0:
+                    count, data = await self._executor.run(
+                        read_chunk, stream,
+                        min(DOWNLOAD_CHUNK_SIZE, remaining), self._compressor,
+                    )
+                    remaining -= count
+                    await self._write(data, count)
+            await self._write(b'\0' * (-size % tarfile.BLOCKSIZE))
+        finally:
+            await self._executor.run(stream.close)
+
+    async def add_entry(self, entry, name):
+        """Add a file read into a ``CacheEntry``, as ``name``."""
+        size = len(entry.data)
+        await self._write(tar_header(name, size, entry.info.mtime))
+        await self._write(entry.data + b'\0' * (-size % tarfile.BLOCKSIZE))
+
+    async def finish(self):
+        """Write the end-of-archive marker."""
+        # Two empty blocks, padded to a whole record.
+        size = 2 * tarfile.BLOCKSIZE
+        size += -(self._offset + size) % tarfile.RECORDSIZE
+        await self._write(b'\0' * size)
+        if self._compressor is not None:
+            await self._write(self._compressor.flush(), 0)
+
+    def close(self):
+        if self._socket is not None:
+            self._socket.close()
+            self._transport.set_write_buffer_limits()
+
+
+async def download_archive(request):
+    """Streaming tar archive of all files under a directory.
+
+    ``GET /<dir>?archive`` sends a tar archive of the files under ``<dir>``,
+    with paths relative to ``<dir>`` (the format accepted by
+    ``upload_archive()``).  ``archive=gz`` compresses it with gzip.  Files
+    are listed by the backend, one page at a time, and the archive
+    is generated on the fly with chunked transfer encoding, so memory usage
+    is bounded.  See ``ArchiveWriter``.  Requires the ``LocalBackend``.
+    """
+    backend = local_backend(request)
+    layout = backend.layout
+    try:
+        content_type, extension, compress = ARCHIVE_TYPES[
+            request.GET['archive']
+        ]
+    except KeyError:
+        raise aiohttp.web.HTTPBadRequest()
+    root = resolve_name(layout.storage, request.match_info.get('path', ''))
+    if root is None:
+        raise aiohttp.web.HTTPNotFound()
+    if root:
+        prefix, name = root + '/', os.path.basename(root)
+    else:
+        prefix, name = '', 'archive'
+    rows = await backend.list(prefix, '', LIST_MAX_LIMIT)
+    if not rows and not await backend.executor.run(layout.isdir, root):
+        raise aiohttp.web.HTTPNotFound()
+
+    response = aiohttp.web.StreamResponse(headers={
+        'Content-Disposition': 'attachment; filename="%s%s"' % (
+            name, extension,
+        ),
+    })
+    response.content_type = content_type
+    response.enable_chunked_encoding()
+    if request.method == 'HEAD':
+        # NOTE: aiohttp ends chunked responses even when there is no body,
+        #       so don't let the client reuse the connection.
+        response.force_close()
+        await response.prepare(request)
+        return response
+    await response.prepare(request)
+
+    writer = ArchiveWriter(request, response, compress)
+    try:
+        while True:
+            for path, _, _ in rows:
+                await backend.add_to_archive(
+                    writer, path, path[len(prefix):],
+                )
+            if len(rows) < LIST_MAX_LIMIT:
+                break
+            rows = await backend.list(prefix, rows[-1][0], LIST_MAX_LIMIT)
+        await writer.finish()
+    finally:
+        writer.close()
+        request['smartmob.response_size'] = writer.sent
+    return response
+
+
+async def main(argv, loop=None):
+    """Run the HTTP file server."""
+
+    arguments = cli.parse_args(argv)
+    check_backend(arguments)
+    check_replication(arguments)
+    check_cluster(arguments)
+    check_timing(arguments)
+
+    # Apply defaults.
+    logging_endpoint = arguments.logging_endpoint
+    if not logging_endpoint:
+        logging_endpoint = os.environ.get('SMARTMOB_LOGGING_ENDPOINT')
+    if not logging_endpoint:
+        logging_endpoint = 'file:///dev/stdout'
+    check_logging(logging_endpoint, arguments)
+
+    # Send structured logs to requested destination.
+    logger_factory = configure_logging(
+        log_format='iso',
+        utc=True,
+        endpoint=logging_endpoint,
+        fast=arguments.fast_logging,
+    )
+    event_log = structlog.get_logger()
+
+    # Pick the event loop.
+    loop = loop or asyncio.get_event_loop()
+
+    # Serve requests.
+    done = asyncio.Future(loop=loop)
+    with aiotk.handle_ctrlc(done, loop=loop):
+        with handle_sigterm(done, loop=loop):
+            if arguments.workers > 1:
+                await run_workers(argv, arguments, done, loop=loop)
+            else:
+                await run_server(arguments, event_log, done, loop=loop,
+                                 logger_factory=logger_factory)
+
+    # Shut down.
+    event_log.info('stop')
+    logger_factory.close()
+
+
+async def run_server(arguments, event_log, done, loop, logger_factory=None):
+    """Serve requests in this process until ``done`` is fulfilled."""
+
+    # Prepare a web application.
+    app = aiohttp.web.Application(
+        loop=loop,
+        middlewares=[
+            inject_request_id,
+            access_log_middleware,
+            metrics_middleware,
+            cluster_middleware,
+        ],
+    )
+    app.on_response_prepare.append(echo_request_id)
+
+    # Define routes.
+    app.router.add_route('GET', '/', listing)
+    app.router.add_route('GET', '/{path:.*}', download)
+    app.router.add_route('HEAD', '/{path:.*}', download)
+    app.router.add_route('PUT', '/{path:.+}', upload,
+                         expect_handler=defer_continue)
+    app.router.add_route('POST', '/{path:.*}', upload_archive)
+    app.router.add_route('DELETE', '/{path:.+}', delete)
+
+    # Inject context.
+    app['smartmob.event_log'] = event_log
+    app['smartmob.logger_factory'] = logger_factory
+    app['smartmob.clock'] = timeit.default_timer
+    app['smartmob.timing_sample_rate'] = arguments.timing_sample_rate
+    app['smartmob.archive_read_timeout'] = arguments.archive_read_timeout
+    app['smartmob.peer_token'] = arguments.peer_token
+    app['smartmob.storage'] = arguments.storage
+    app['smartmob.layout'] = layout = make_layout(
+        arguments.layout, arguments.storage,
+    )
+    app['smartmob.dedup'] = arguments.dedup
+    app['smartmob.background'] = set()
+    app['smartmob.locks'] = PathLocks(loop=loop)
+    app['smartmob.admission'] = AdmissionControl(
+        arguments.max_uploads,
+        arguments.max_upload_bytes,
+        arguments.upload_queue_timeout,
+        loop=loop,
+    )
+    if arguments.compress:
+        app['smartmob.compress'] = arguments.compress_min_size
+
+    # Serve metrics on a separate port, only on loopback unless requested.
+    metrics_app = None
+    if arguments.metrics_port is not None:
+        metrics_app = aiohttp.web.Application(loop=loop)
+        metrics_app.router.add_route('GET', '/metrics', render_metrics)
+        if arguments.profile_dir:
+            metrics_app.router.add_route('POST', '/profile', start_profile)
+            metrics_app['smartmob.profile_token'] = arguments.profile_token
+        metrics_app['smartmob.metrics'] = app['smartmob.metrics'] = \
+            ServerMetrics()
+    if arguments.cache_bytes > 0:
+        app['smartmob.cache'] = ContentCache(
+            arguments.cache_bytes, arguments.cache_max_object,
+            # Other workers can't invalidate our cache.
+            validate=(arguments.socket_fd is not None),
+        )
+
+    # Use the socket inherited from the parent process, if any.
+    sock = None
+    if arguments.socket_fd is not None:
+        sock = socket.socket(fileno=arguments.socket_fd)
+
+    # Serve requests.
+    with IOExecutor(arguments.io_threads, loop=loop) as executor, \
+            IOExecutor(arguments.archive_threads, loop=loop) as archives:
+        app['smartmob.archive_executor'] = archives
+        app['smartmob.executor'] = executor
+        index = packs = None
+        if arguments.backend == 'memory':
+            app['smartmob.backend'] = MemoryBackend()
+        else:
+            # Workers rely on the parent process to prepare the storage.
+            if arguments.socket_fd is None:
+                report = await executor.run(
+                    prepare_storage, arguments.storage, arguments.dedup,
+                    layout, arguments.backend == 'pack',
+                    arguments.partial_upload_ttl,
+                )
+                if report:
+                    event_log.info('dedup.report', **report)
+            else:
+                await executor.run(make_reserved_dirs, arguments.storage)
+            index = await executor.run(DigestIndex, arguments.storage, layout)
+            durability = Durability(arguments.durability, executor,
+                                    arguments.group_commit_window, loop=loop)
+            if arguments.backend == 'pack':
+                packs = await executor.run(
+                    PackStore, os.path.join(arguments.storage, PACKS_DIR),
+                    arguments.pack_segment_size,
+                )
+                app['smartmob.backend'] = PackBackend(
+                    arguments.storage, layout, index, executor, durability,
+                    packs, arguments.pack_max_size, dedup=arguments.dedup,
+                )
+                await executor.run(app['smartmob.backend'].reconcile)
+            else:
+                app['smartmob.backend'] = LocalBackend(
+                    arguments.storage, layout, index, executor, durability,
+                    dedup=arguments.dedup,
+                )
+        replicator = None
+        if arguments.replicate_to:
+            replicator = app['smartmob.replicator'] = Replicator(
+                arguments.replicate_to, app['smartmob.backend'],
+                await executor.run(ReplicationLog, arguments.storage),
+                executor,
+                replicas=arguments.replicas,
+                max_pending=arguments.replication_queue_size,
+                timeout=arguments.replication_timeout,
+                token=arguments.peer_token,
+                event_log=event_log,
+                metrics=app.get('smartmob.metrics'),
+                loop=loop,
+            )
+            await replicator.start()
+        profiler = None
+        if arguments.profile_dir:
+            profiler = Profiler(
+                arguments.profile_dir, executor,
+                seconds=arguments.profile_seconds,
+                format=arguments.profile_format,
+                event_log=event_log,
+                loop=loop,
+            )
+            if metrics_app is not None:
+                metrics_app['smartmob.profiler'] = profiler
+            loop.add_signal_handler(PROFILE_SIGNAL, profiler.trigger)
+        cluster = None
+        if arguments.cluster_members:
+            cluster = app['smartmob.cluster'] = Cluster(
+                arguments.cluster_members, arguments.cluster_self,
+                arguments.cluster_vnodes, arguments.cluster_routing,
+                token=arguments.peer_token,
+                loop=loop,
+            )
+        try:
+            async with HTTPServer(app, arguments.host, arguments.port,
+                                  loop=loop, sock=sock):
+                if metrics_app is None:
+                    await done
+                else:
+                    async with HTTPServer(metrics_app, arguments.metrics_host,
+                                          arguments.metrics_port, loop=loop):
+                        await done
+        finally:
+            # Let background jobs finish.
+            if app['smartmob.background']:
+                await asyncio.wait(app['smartmob.background'], loop=loop)
+            if replicator is not None:
+                await replicator.close()
+            if cluster is not None:
+                cluster.close()
+            if profiler is not None:
+                loop.remove_signal_handler(PROFILE_SIGNAL)
+                await profiler.close()
+            if packs is not None:
+                await executor.run(packs.close)
+            if index is not None:
+                await executor.run(index.close)
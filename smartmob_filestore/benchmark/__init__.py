@@ -0,0 +1,396 @@
+# -*- coding: utf-8 -*-
+
+"""Load testing and benchmarks for the HTTP file server.
+
+Each scenario (one file size at one concurrency level) drives a random mix
+of PUT and GET requests through ``concurrency`` clients and reports the
+throughput, latency percentiles and errors.  The report is printed as JSON
+and can be saved as a baseline for later runs to compare against.  Pass
+``-- --backend=memory`` to measure the HTTP layer alone, without disk I/O.
+
+``--log-rendering`` runs a microbenchmark of the structured logging pipeline
+instead, comparing the per-event cost of the standard and fast pipelines.
+"""
+
+
+import aiohttp
+import argparse
+import asyncio
+import json
+import os
+import random
+import resource
+import signal
+import socket
+import structlog
+import sys
+import tempfile
+import time
+import timeit
+
+from smartmob_filestore import configure_logging, main
+
+
+CHUNK_SIZE = 64 * 1024
+"""Number of bytes sent and received at once."""
+
+SIZE_UNITS = {'': 1, 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+"""Suffixes accepted in file sizes."""
+
+
+def parse_size(value):
+    """Parse a file size such as ``512``, ``1K``, ``64M`` or ``1G``."""
+    value = value.strip().upper()
+    unit = value[-1:] if value[-1:] in SIZE_UNITS else ''
+    try:
+        size = int(value[:len(value) - len(unit)]) * SIZE_UNITS[unit]
+    except ValueError:
+        raise argparse.ArgumentTypeError('Invalid size %r.' % value)
+    if size <= 0:
+        raise argparse.ArgumentTypeError('Invalid size %r.' % value)
+    return size
+
+
+def parse_list(parse):
+    """Build an argument type for comma-separated lists of values."""
+
+    def parse_items(value):
+        return [parse(item) for item in value.split(',')]
+
+    return parse_items
+
+
+def format_size(size):
+    """Inverse of ``parse_size()``."""
+    for unit in ('G', 'M', 'K'):
+        if size % SIZE_UNITS[unit] == 0:
+            return '%d%s' % (size // SIZE_UNITS[unit], unit)
+    return str(size)
+
+
+cli = argparse.ArgumentParser(
+    description="Benchmark the HTTP file server.",
+    epilog="Arguments after -- are passed to the server.",
+)
+cli.add_argument('--url', action='store', dest='url', default=None,
+                 help="Benchmark a running server instead of starting one.")
+cli.add_argument('--subprocess', action='store_true', dest='subprocess',
+                 default=False,
+                 help="Run the server in a child process.")
+cli.add_argument('--sizes', action='store', dest='sizes',
+                 type=parse_list(parse_size), default=[1024, 1024 ** 2],
+                 help="File sizes, from 1K to 1G (e.g. 1K,1M,1G).")
+cli.add_argument('--concurrency', action='store', dest='concurrency',
+                 type=parse_list(int), default=[1, 10, 100],
+                 help="Numbers of concurrent clients (e.g. 1,10,1000).")
+cli.add_argument('--requests', action='store', dest='requests',
+                 type=int, default=200,
+                 help="Number of requests in each scenario.")
+cli.add_argument('--put-ratio', action='store', dest='put_ratio',
+                 type=float, default=0.2,
+                 help="Fraction of the requests that are uploads.")
+cli.add_argument('--seed', action='store', dest='seed',
+                 type=int, default=0,
+                 help="Seed for the random mix of requests.")
+cli.add_argument('--output', action='store', dest='output', default=None,
+                 help="Save the JSON report to this file.")
+cli.add_argument('--baseline', action='store', dest='baseline', default=None,
+                 help="Compare against a report saved by a previous run.")
+cli.add_argument('--tolerance', action='store', dest='tolerance',
+                 type=float, default=0.1,
+                 help="Allowed slowdown before flagging a regression.")
+cli.add_argument('--log-rendering', action='store', dest='log_rendering',
+                 type=int, default=0,
+                 help="Only measure log rendering, over this many events.")
+cli.add_argument('server_args', nargs=argparse.REMAINDER,
+                 help=argparse.SUPPRESS)
+
+
+def percentile(values, fraction):
+    """Nearest-rank percentile of sorted ``values``."""
+    if not values:
+        return None
+    rank = max(int(round(fraction * len(values))), 1)
+    return values[min(rank, len(values)) - 1]
+
+
+def summarize(latencies):
+    """Latency percentiles, in seconds."""
+    latencies = sorted(latencies)
+    return {
+        'count': len(latencies),
+        'p50': percentile(latencies, 0.5),
+        'p99': percentile(latencies, 0.99),
+        'p999': percentile(latencies, 0.999),
+    }
+
+
+def peak_rss():
+    """Peak resident set size (in bytes) of this process and its children."""
+    usage = sum(
+        resource.getrusage(who).ru_maxrss
+        for who in (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN)
+    )
+    # NOTE: Linux reports kilobytes, macOS reports bytes.
+    if sys.platform == 'darwin':  # pragma: no cover
+        return usage
+    return usage * 1024
+
+
+def payload(size):
+    """Request body of ``size`` bytes, sent one chunk at a time."""
+    chunk = os.urandom(min(size, CHUNK_SIZE))
+    while size > 0:
+        yield chunk[:size]
+        size -= len(chunk)
+
+
+async def run_scenario(url, size, concurrency, requests, put_ratio, seed,
+                       loop):
+    """Drive ``requests`` PUT and GET requests through concurrent clients.
+
+    Each client works on its own file, which it uploads first.  GETs read
+    the response body in chunks so that large files aren't held in memory.
+    """
+    clock = timeit.default_timer
+    latencies = {'PUT': [], 'GET': []}
+    counts = {'requests': 0, 'errors': 0, 'bytes': 0}
+    ops = random.Random(seed)
+
+    async def client(session, path):
+        method = 'PUT'
+        while counts['requests'] < requests:
+            counts['requests'] += 1
+            ref = clock()
+            try:
+                if method == 'PUT':
+                    async with session.put(url + path, data=payload(size),
+                                           headers={
+                        'Content-Length': str(size),
+                    }) as response:
+                        await response.read()
+                else:
+                    async with session.get(url + path) as response:
+                        chunk = await response.content.read(CHUNK_SIZE)
+                        while chunk:
+                            chunk = await response.content.read(CHUNK_SIZE)
+            except aiohttp.errors.ClientError:
+                counts['errors'] += 1
+                continue
+            if response.status >= 400:
+                counts['errors'] += 1
+                continue
+            latencies[method].append(clock() - ref)
+            counts['bytes'] += size
+            method = 'PUT' if ops.random() < put_ratio else 'GET'
+
+    connector = aiohttp.TCPConnector(limit=concurrency, loop=loop)
+    session = aiohttp.ClientSession(connector=connector, loop=loop)
+    async with session:
+        ref = clock()
+        await asyncio.gather(*[
+            client(session, 'benchmark-%s-%d' % (format_size(size), i))
+            for i in range(concurrency)
+        ], loop=loop)
+        duration = clock() - ref
+
+    return {
+        'size': size,
+        'concurrency': concurrency,
+        'requests': counts['requests'],
+        'errors': counts['errors'],
+        'duration': duration,
+        'throughput': {
+            'requests': (counts['requests'] - counts['errors']) / duration,
+            'bytes': counts['bytes'] / duration,
+        },
+        'latency': {
+            'put': summarize(latencies['PUT']),
+            'get': summarize(latencies['GET']),
+        },
+    }
+
+
+def compare(report, baseline, tolerance):
+    """List scenarios that got slower than in ``baseline``.
+
+    Throughput may not drop, and p99 latencies may not grow, by more than
+    ``tolerance`` (a fraction).
+    """
+    previous = {
+        (scenario['size'], scenario['concurrency']): scenario
+        for scenario in baseline['scenarios']
+    }
+    regressions = []
+    for scenario in report['scenarios']:
+        key = (scenario['size'], scenario['concurrency'])
+        if key not in previous:
+            continue
+        before = previous[key]
+        checks = [(
+            'throughput',
+            before['throughput']['requests'],
+            scenario['throughput']['requests'],
+            -1,
+        )]
+        for method in ('put', 'get'):
+            checks.append((
+                '%s.p99' % method,
+                before['latency'][method]['p99'],
+                scenario['latency'][method]['p99'],
+                +1,
+            ))
+        for metric, old, new, sign in checks:
+            # Values are missing when scenarios don't have both methods.
+            if old and new is not None:
+                change = (new - old) / old
+                if change * sign > tolerance:
+                    regressions.append({
+                        'size': scenario['size'],
+                        'concurrency': scenario['concurrency'],
+                        'metric': metric,
+                        'baseline': old,
+                        'value': new,
+                        'change': change,
+                    })
+    return regressions
+
+
+def measure_rendering(events):
+    """Per-event cost (in seconds) of the standard and fast log pipelines.
+
+    Events look like access log entries and are written to ``/dev/null``.
+    """
+    clock = timeit.default_timer
+    results = {}
+    for pipeline, fast in (('standard', False), ('fast', True)):
+        logger_factory = configure_logging(
+            log_format='iso',
+            utc=True,
+            endpoint='file:///dev/null',
+            fast=fast,
+        )
+        log = structlog.get_logger()
+        try:
+            ref = clock()
+            for i in range(events):
+                log.info(
+                    'http.access',
+                    path='/benchmark-1K-%d' % i,
+                    outcome=200,
+                    duration=0.001,
+                    request='00000000-0000-0000-0000-000000000000',
+                    **{'@timestamp': time.time()}
+                )
+            results[pipeline] = (clock() - ref) / events
+        finally:
+            logger_factory.close()
+    results['speedup'] = results['standard'] / results['fast']
+    return results
+
+
+def free_port(host):
+    """Find a TCP port nobody listens on."""
+    with socket.socket() as sock:
+        sock.bind((host, 0))
+        return sock.getsockname()[1]
+
+
+async def wait_for_server(host, port, server, loop):
+    """Wait until the server accepts connections or ``server`` completes."""
+    while not server.done():
+        try:
+            _, writer = await asyncio.open_connection(host, port, loop=loop)
+        except OSError:
+            await asyncio.sleep(0.1, loop=loop)
+        else:
+            writer.close()
+            return
+
+
+async def start_server(arguments, storage, loop):
+    """Start the server on a local port and return its URL and a stopper."""
+    host = '127.0.0.1'
+    port = free_port(host)
+    argv = [
+        '--host=%s' % host,
+        '--port=%d' % port,
+        '--storage=%s' % storage,
+        '--logging-endpoint=file:///dev/null',
+    ] + arguments.server_args
+    if arguments.subprocess:
+        process = await asyncio.create_subprocess_exec(
+            sys.executable, '-m', 'smartmob_filestore', *argv, loop=loop
+        )
+        server = loop.create_task(process.wait())
+
+        async def stop():
+            if not server.done():
+                process.send_signal(signal.SIGTERM)
+            await server
+    else:
+        server = loop.create_task(main(argv, loop=loop))
+
+        async def stop():
+            if not server.done():
+                os.kill(os.getpid(), signal.SIGINT)
+            await server
+    await wait_for_server(host, port, server, loop)
+    if server.done():
+        await stop()
+        raise RuntimeError('Server exited before accepting connections.')
+    return 'http://%s:%d/' % (host, port), stop
+
+
+async def benchmark(argv, loop=None):
+    """Run the benchmark and print its report.
+
+    Returns the process exit status: 1 when regressions were found.
+    """
+    loop = loop or asyncio.get_event_loop()
+    arguments = cli.parse_args(argv)
+    if arguments.server_args[:1] == ['--']:
+        del arguments.server_args[0]
+    if arguments.log_rendering > 0:
+        report = {'log_rendering': measure_rendering(arguments.log_rendering)}
+        print(json.dumps(report, indent=2, sort_keys=True))
+        return 0
+    baseline = None
+    if arguments.baseline:
+        with open(arguments.baseline, 'r') as stream:
+            baseline = json.load(stream)
+
+    with tempfile.TemporaryDirectory() as storage:
+        if arguments.url:
+            server = 'external'
+            url, stop = arguments.url.rstrip('/') + '/', None
+        else:
+            server = 'subprocess' if arguments.subprocess else 'in-process'
+            url, stop = await start_server(arguments, storage, loop)
+        try:
+            scenarios = []
+            for size in arguments.sizes:
+                for concurrency in arguments.concurrency:
+                    scenarios.append(await run_scenario(
+                        url, size, concurrency, arguments.requests,
+                        arguments.put_ratio, arguments.seed, loop,
+                    ))
+        finally:
+            if stop:
+                await stop()
+
+    report = {
+        'server': server,
+        'server_args': arguments.server_args,
+        'scenarios': scenarios,
+        'peak_rss': peak_rss(),
+    }
+    if baseline is not None:
+        report['regressions'] = compare(
+            report, baseline, arguments.tolerance,
+        )
+    if arguments.output:
+        with open(arguments.output, 'w') as stream:
+            json.dump(report, stream, indent=2, sort_keys=True)
+    print(json.dumps(report, indent=2, sort_keys=True))
+    return 1 if report.get('regressions') else 0
@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+
+"""Convert a storage root to another layout, in place.
+
+Stop the server first, then start it with the new ``--layout`` option once
+the migration is complete.  Migrations that are interrupted can be resumed
+by running the same command again.  The report is printed as JSON.
+"""
+
+
+import argparse
+import json
+
+from smartmob_filestore import LAYOUTS, make_layout, migrate_storage
+
+
+cli = argparse.ArgumentParser(
+    description="Convert a storage root to another layout, in place.",
+)
+cli.add_argument('--storage', action='store', dest='storage',
+                 type=str, default='.')
+cli.add_argument('--layout', action='store', dest='layout',
+                 choices=LAYOUTS, required=True,
+                 help="Layout to convert the storage root to.")
+
+
+def migrate(argv):
+    """Run the migration and print its report.
+
+    Returns the process exit status: 1 when files can't be migrated.
+    """
+    arguments = cli.parse_args(argv)
+    layout = make_layout(arguments.layout, arguments.storage)
+    try:
+        files = migrate_storage(arguments.storage, layout)
+    except (OSError, ValueError) as error:
+        report = {'layout': layout.name, 'error': str(error)}
+        status = 1
+    else:
+        report = {'layout': layout.name, 'files': files}
+        status = 0
+    print(json.dumps(report, indent=2, sort_keys=True))
+    return status
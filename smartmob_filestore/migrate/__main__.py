@@ -0,0 +1,18 @@
+# -*- coding: utf-8 -*-
+
+
+import sys
+
+from smartmob_filestore.migrate import migrate
+
+
+# NOTE: coverage ignores this file, so keep its contents to a minimum.
+
+
+def entry_point():
+    return migrate(sys.argv[1:])
+
+
+# Required for `python -m smartmob_filestore.migrate ...`.
+if __name__ == '__main__':
+    sys.exit(entry_point())
@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+
+"""Move files to their owner after cluster members are added or removed.
+
+Restart the members with the new ``--cluster-member`` list, then run this
+with the same list (and ``--cluster-vnodes`` and ``--peer-token``).  Each
+member's files are listed and those that now belong to another member are
+copied there and removed from the old member.  Thanks to consistent
+hashing, only the files on the ring segments that changed hands are moved.
+Files that were uploaded to their new owner in the mean time are newer and
+are kept.  The report is printed as JSON.
+"""
+
+
+import aiohttp
+import argparse
+import asyncio
+import json
+
+from smartmob_filestore import (
+    CLUSTER_HEADER,
+    HashRing,
+    PEER_TOKEN_HEADER,
+)
+from urllib.parse import quote
+
+
+cli = argparse.ArgumentParser(
+    description="Move files to their owner in a cluster.",
+)
+cli.add_argument('--cluster-member', action='append',
+                 dest='cluster_members', required=True, metavar='URL',
+                 help="Base URL of a cluster member (repeat for each one).")
+cli.add_argument('--cluster-vnodes', action='store', dest='cluster_vnodes',
+                 type=int, default=64,
+                 help="Points of each member on the consistent hash ring.")
+cli.add_argument('--peer-token', action='store', dest='peer_token',
+                 default='',
+                 help="The --peer-token of the cluster members.")
+cli.add_argument('--dry-run', action='store_true', dest='dry_run',
+                 default=False,
+                 help="Only report the files that would be moved.")
+
+
+def peer_headers(token, headers=()):
+    """Headers that make members handle requests for any file themselves."""
+    headers = dict(headers)
+    headers[CLUSTER_HEADER] = 'rebalance'
+    headers[PEER_TOKEN_HEADER] = token
+    return headers
+
+
+async def list_files(session, member, token):
+    """Names of the files stored by a member, one page at a time."""
+    names = []
+    params = {'list': '', 'limit': '1000'}
+    while True:
+        async with session.get(member, params=params,
+                               headers=peer_headers(token)) as response:
+            if response.status != 200:
+                raise ValueError('Listing failed (%d).' % response.status)
+            page = await response.json()
+        names.extend(entry['path'] for entry in page['files'])
+        if page['cursor'] is None:
+            return names
+        params['cursor'] = page['cursor']
+
+
+async def move_file(session, name, source, target, token):
+    """Copy a file to its owner, then remove it from the previous member.
+
+    Returns the number of bytes copied.
+    """
+    async with session.get(source + quote(name), headers=peer_headers(
+        token, {'Accept-Encoding': 'identity'},
+    )) as response:
+        if response.status == 404:
+            return 0
+        if response.status != 200:
+            raise ValueError('Download failed (%d).' % response.status)
+        etag = response.headers['ETag']
+        size = int(response.headers['Content-Length'])
+        # Don't replace files uploaded to their new owner in the mean time.
+        headers = peer_headers(token, {
+            'Content-Length': str(size),
+            'If-None-Match': '*',
+        })
+        async with session.put(target + quote(name), data=response.content,
+                               headers=headers) as upload:
+            await upload.read()
+        # Uploads may end before they read the whole file.  Drop the
+        # connection rather than read the rest.
+        response.close()
+        if upload.status not in (201, 412):
+            raise ValueError('Upload failed (%d).' % upload.status)
+    # Keep files that changed while they were copied.
+    async with session.delete(source + quote(name), headers=peer_headers(
+        token, {'If-Match': etag},
+    )) as response:
+        if response.status not in (204, 404):
+            raise ValueError('Removal failed (%d).' % response.status)
+    return size if upload.status == 201 else 0
+
+
+async def rebalance(argv, loop=None):
+    """Move misplaced files and print a report.
+
+    Returns the process exit status: 1 when files couldn't be moved.
+    """
+    loop = loop or asyncio.get_event_loop()
+    arguments = cli.parse_args(argv)
+    members = [member.rstrip('/') + '/'
+               for member in arguments.cluster_members]
+    ring = HashRing(members, arguments.cluster_vnodes)
+    report = {'files': 0, 'moved': {}, 'bytes': 0, 'errors': []}
+    async with aiohttp.ClientSession(loop=loop) as session:
+        for source in members:
+            try:
+                names = await list_files(
+                    session, source, arguments.peer_token,
+                )
+            except (aiohttp.errors.ClientError, OSError, ValueError) as error:
+                report['errors'].append({
+                    'member': source, 'error': str(error),
+                })
+                continue
+            report['files'] += len(names)
+            for name in names:
+                target = ring.owner(name)
+                if target == source:
+                    continue
+                move = '%s -> %s' % (source, target)
+                report['moved'][move] = report['moved'].get(move, 0) + 1
+                if arguments.dry_run:
+                    continue
+                try:
+                    report['bytes'] += await move_file(
+                        session, name, source, target, arguments.peer_token,
+                    )
+                except (aiohttp.errors.ClientError, OSError,
+                        ValueError) as error:
+                    report['moved'][move] -= 1
+                    report['errors'].append({
+                        'member': source, 'path': name, 'error': str(error),
+                    })
+    print(json.dumps(report, indent=2, sort_keys=True))
+    return 1 if report['errors'] else 0
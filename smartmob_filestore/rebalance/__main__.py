@@ -0,0 +1,22 @@
+# -*- coding: utf-8 -*-
+
+
+import asyncio
+import sys
+
+from smartmob_filestore.rebalance import rebalance
+
+
+# NOTE: coverage ignores this file, so keep its contents to a minimum.
+
+
+def entry_point():
+    loop = asyncio.get_event_loop()
+    return loop.run_until_complete(
+        rebalance(sys.argv[1:], loop=loop)
+    )
+
+
+# Required for `python -m smartmob_filestore.rebalance ...`.
+if __name__ == '__main__':
+    sys.exit(entry_point())
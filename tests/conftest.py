@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 
 import aiotk
+import asyncio
 import msgpack
 import os
 import os.path
@@ -8,6 +9,7 @@ import pytest
 import testfixtures
 
 from smartmob_filestore import configure_logging
+from timeit import default_timer
 from unittest import mock
 
 
@@ -40,6 +42,9 @@ def logging():
 async def service_fluent_client(records, reader, writer):
     """TCP handler for mock FluentD server.
 
+    Forward mode messages are unpacked into one record per entry so that
+    tests see the same records regardless of the mode used by the client.
+
     See:
     - https://github.com/fluent/fluentd/wiki/Forward-Protocol-Specification-v0
     - https://pythonhosted.org/msgpack-python/api.html#msgpack.Unpacker
@@ -49,7 +54,10 @@ async def service_fluent_client(records, reader, writer):
     while data:
         unpacker.feed(data)
         for record in unpacker:
-            records.append(record)
+            if isinstance(record[1], list):
+                records.extend([record[0]] + entry for entry in record[1])
+            else:
+                records.append(record)
         data = await reader.read(1024)
 
 
@@ -75,6 +83,18 @@ def fluent_server(event_loop, unused_tcp_port_factory):
     event_loop.run_until_complete(server.wait_closed())
 
 
+@pytest.fixture(scope='function')
+def wait_for_records():
+    """Wait until the mock FluentD server received enough records."""
+
+    async def wait(records, count, timeout=5.0):
+        ref = default_timer()
+        while len(records) < count and (default_timer() - ref) < timeout:
+            await asyncio.sleep(0.05)
+
+    return wait
+
+
 @pytest.yield_fixture(scope='function')
 def save_env():
     with mock.patch('os.environ', {k: v for k, v in os.environ.items()}):
@@ -3,12 +3,82 @@
 
 import asyncio
 import aiohttp
+import aiohttp.web
+import base64
+import contextlib
+import errno
+import gzip
+import hashlib
+import io
+import itertools
+import json
 import os
+import pstats
 import pytest
 import signal
+import socket
+import structlog
+import tarfile
+import threading
 
-from smartmob_filestore import main
+from smartmob_filestore import (
+    AdmissionControl,
+    ArchiveWriter,
+    bind_socket,
+    blob_path,
+    CacheEntry,
+    check_packs,
+    clean_staging,
+    cli,
+    CLUSTER_HEADER,
+    collect_blobs,
+    collect_variants,
+    commit_blob,
+    compress_file,
+    compressible,
+    ContentCache,
+    DigestIndex,
+    DOWNLOAD_CHUNK_SIZE,
+    Durability,
+    etag_matches,
+    FlatLayout,
+    forward_signal,
+    fsync_paths,
+    handle_sigterm,
+    HashRing,
+    HTTPServer,
+    IOExecutor,
+    main,
+    make_parents,
+    MemoryBackend,
+    negotiate_encoding,
+    open_archive,
+    PACK_PUT,
+    pack_record,
+    PackStore,
+    parse_content_range,
+    parse_range,
+    PathLocks,
+    PEER_TOKEN_HEADER,
+    Profiler,
+    PROFILE_TOKEN_HEADER,
+    read_chunk,
+    REPLICA_HEADER,
+    RESERVED_DIRS,
+    ReplicationLog,
+    Replicator,
+    run_server,
+    sendfile,
+    SENDFILE_MIN_SIZE,
+    ServerMetrics,
+    ShardedLayout,
+    storage_path,
+    UPLOAD_CHUNK_SIZE,
+    variant_path,
+    ZSTD_MAGIC,
+)
 from timeit import default_timer
+from unittest import mock
 
 
 @pytest.mark.asyncio
@@ -54,3 +124,3545 @@ async def test_upload_and_download(event_loop, unused_tcp_port_factory,
 
     # Make sure we got what we uploaded.
     assert content == b'Hello, world!'
+
+
+async def start_server(event_loop, host, port, *args):
+    """Start the server in the background and wait until it's listening."""
+    task = event_loop.create_task(main([
+        '--host=%s' % host,
+        '--port=%d' % port,
+    ] + list(args), loop=event_loop))
+    ref = default_timer()
+    while True:
+        try:
+            _, writer = await asyncio.open_connection(
+                host, port, loop=event_loop,
+            )
+        except OSError:
+            assert (default_timer() - ref) < 5.0
+            await asyncio.sleep(0.1)
+        else:
+            writer.close()
+            return task
+
+
+async def stop_server(task, signum=signal.SIGINT):
+    """Stop a server started using ``start_server()``."""
+    os.kill(os.getpid(), signum)
+    await task
+
+
+@pytest.mark.asyncio
+async def test_upload_streaming(event_loop, unused_tcp_port, tempdir):
+    """Large uploads are streamed to disk and renamed into place."""
+
+    host = '127.0.0.1'
+    task = await start_server(event_loop, host, unused_tcp_port)
+    payload = os.urandom(3 * UPLOAD_CHUNK_SIZE + 17)
+    try:
+        async with aiohttp.ClientSession(loop=event_loop) as client:
+            url = 'http://%s:%d/%s' % (host, unused_tcp_port, 'big.bin')
+            async with client.put(url, data=payload) as response:
+                assert response.status == 201
+            async with client.get(url) as response:
+                assert response.status == 200
+                content = await response.read()
+    finally:
+        await stop_server(task)
+
+    # No temporary files are left behind.
+    assert content == payload
+    assert sorted(os.listdir('.')) == ['.index', '.staging', 'big.bin']
+    assert os.listdir('.staging') == []
+
+
+@pytest.mark.asyncio
+async def test_upload_failure_cleanup(event_loop, unused_tcp_port, tempdir):
+    """Temporary files are removed when an upload fails."""
+
+    host = '127.0.0.1'
+    task = await start_server(event_loop, host, unused_tcp_port)
+    try:
+        async with aiohttp.ClientSession(loop=event_loop) as client:
+            url = 'http://%s:%d/%s' % (host, unused_tcp_port, 'a.txt')
+            with mock.patch('smartmob_filestore.install') as install:
+                install.side_effect = PermissionError
+                async with client.put(url, data=b'Hello, world!') \
+                        as response:
+                    assert response.status == 500
+    finally:
+        await stop_server(task)
+
+    assert sorted(os.listdir('.')) == ['.index', '.staging']
+    assert os.listdir('.staging') == []
+
+
+@pytest.mark.asyncio
+async def test_io_executor_queue(event_loop):
+    """The I/O executor reports how many jobs are waiting for a thread."""
+
+    gate = threading.Event()
+    with IOExecutor(1, loop=event_loop) as executor:
+        assert executor.threads == 1
+        jobs = [
+            event_loop.create_task(executor.run(gate.wait)) for _ in range(3)
+        ]
+        await asyncio.sleep(0.1)
+        assert executor.pending == 3
+        assert executor.queued == 2
+        gate.set()
+        await asyncio.gather(*jobs, loop=event_loop)
+        assert executor.pending == 0
+        assert executor.queued == 0
+
+
+@pytest.mark.parametrize('layout', [FlatLayout, ShardedLayout])
+@pytest.mark.parametrize('path', [
+    '../etc/passwd',
+    'a/../../etc/passwd',
+    '/etc/passwd',
+])
+def test_storage_path_escape(path, layout):
+    request = mock.MagicMock()
+    request.app = {'smartmob.storage': '.', 'smartmob.layout': layout('.')}
+    request.match_info = {'path': path}
+    with pytest.raises(aiohttp.web.HTTPNotFound):
+        storage_path(request)
+
+
+@pytest.mark.asyncio
+async def test_download(event_loop, unused_tcp_port, tempdir):
+    """Downloads honor HEAD, caching and missing files."""
+
+    with open('hello.txt', 'wb') as stream:
+        stream.write(b'Hello, world!')
+    with open('hello.tar.gz', 'wb') as stream:
+        stream.write(b'...')
+    os.mkfifo('fifo')
+
+    host = '127.0.0.1'
+    task = await start_server(event_loop, host, unused_tcp_port)
+    try:
+        async with aiohttp.ClientSession(loop=event_loop) as client:
+            url = 'http://%s:%d/' % (host, unused_tcp_port)
+
+            async with client.head(url + 'hello.txt') as response:
+                assert response.status == 200
+                assert response.headers['Content-Length'] == '13'
+                assert response.headers['Content-Type'] == 'text/plain'
+                last_modified = response.headers['Last-Modified']
+
+            async with client.get(url + 'hello.txt', headers={
+                'If-Modified-Since': last_modified,
+            }) as response:
+                assert response.status == 304
+
+            async with client.head(url + 'hello.tar.gz') as response:
+                assert response.status == 200
+                assert response.headers['Content-Encoding'] == 'gzip'
+
+            for path in ('missing.txt', 'hello.txt/x', 'fifo'):
+                async with client.get(url + path) as response:
+                    assert response.status == 404
+    finally:
+        await stop_server(task)
+
+
+def unused_tcp_ports(host, count, exclude=()):
+    """Find a range of ``count`` consecutive ports nobody listens on."""
+    while True:
+        with contextlib.ExitStack() as stack:
+            first = stack.enter_context(bind_socket(host, 0))
+            port = first.getsockname()[1]
+            try:
+                for i in range(1, count):
+                    stack.enter_context(bind_socket(host, port + i))
+            except OSError:
+                continue
+        if not set(range(port, port + count)) & set(exclude):
+            return port
+
+
+@pytest.mark.asyncio
+async def test_workers(event_loop, unused_tcp_port, tempdir):
+    """Worker processes share the listening socket and stop on SIGTERM."""
+
+    host = '127.0.0.1'
+    metrics_port = unused_tcp_ports(host, 2, exclude=[unused_tcp_port])
+    task = await start_server(event_loop, host, unused_tcp_port,
+                              '--workers=2', '--dedup',
+                              '--metrics-port=%d' % metrics_port)
+    try:
+        async with aiohttp.ClientSession(loop=event_loop) as client:
+            url = 'http://%s:%d/%s' % (host, unused_tcp_port, 'hello.txt')
+            ref = default_timer()
+            while True:
+                try:
+                    async with client.put(url, data=b'Hello!') as response:
+                        assert response.status == 201
+                    break
+                except aiohttp.errors.ClientOSError:
+                    assert (default_timer() - ref) < 5.0
+                    await asyncio.sleep(0.1)
+            for _ in range(10):
+                async with client.get(url) as response:
+                    assert response.status == 200
+                    assert (await response.read()) == b'Hello!'
+
+            # Each worker has its own metrics.  Requests are measured after
+            # the response is sent, so the last one may take a moment.
+            ref = default_timer()
+            while True:
+                count = 0
+                for port in (metrics_port, metrics_port + 1):
+                    url = 'http://%s:%d/metrics' % (host, port)
+                    async with client.get(url) as response:
+                        assert response.status == 200
+                        for line in (await response.text()).splitlines():
+                            if line.startswith(
+                                'http_request_duration_seconds_count'
+                                '{method="GET",status="200"}'
+                            ):
+                                count += int(line.split()[1])
+                if count == 10:
+                    break
+                assert (default_timer() - ref) < 5.0
+                await asyncio.sleep(0.05)
+    finally:
+        await stop_server(task, signal.SIGTERM)
+
+
+@pytest.mark.asyncio
+async def test_workers_crash(event_loop, unused_tcp_port, tempdir):
+    """The server shuts down when a worker process exits unexpectedly."""
+
+    # Workers can't start an I/O executor without threads.
+    await asyncio.wait_for(main([
+        '--host=127.0.0.1',
+        '--port=%d' % unused_tcp_port,
+        '--workers=2',
+        '--io-threads=0',
+    ], loop=event_loop), timeout=10.0, loop=event_loop)
+
+
+@pytest.mark.asyncio
+async def test_inherited_socket(event_loop, unused_tcp_port, tempdir):
+    """A worker can serve requests on a socket bound by its parent."""
+
+    host = '127.0.0.1'
+    sock = bind_socket(host, unused_tcp_port)
+    task = await start_server(event_loop, host, unused_tcp_port,
+                              '--socket-fd=%d' % sock.fileno())
+    try:
+        async with aiohttp.ClientSession(loop=event_loop) as client:
+            url = 'http://%s:%d/' % (host, unused_tcp_port)
+            async with client.get(url) as response:
+                assert response.status == 403
+    finally:
+        await stop_server(task)
+
+
+@pytest.mark.asyncio
+async def test_handle_sigterm(event_loop):
+    """SIGTERM fulfills the future once, even if received many times."""
+
+    done = asyncio.Future(loop=event_loop)
+    with handle_sigterm(done, loop=event_loop):
+        os.kill(os.getpid(), signal.SIGTERM)
+        await done
+        os.kill(os.getpid(), signal.SIGTERM)
+        await asyncio.sleep(0.1)
+    assert done.result() is None
+
+
+@pytest.mark.parametrize('header,expected', [
+    ('bytes=0-4', (0, 4)),
+    ('bytes=5-', (5, 9)),
+    ('bytes=-3', (7, 9)),
+    ('bytes=-20', (0, 9)),
+    ('bytes=3-100', (3, 9)),
+    ('bytes=0-1,5-6', None),  # multiple ranges are ignored.
+    ('items=0-1', None),
+    ('bytes=-', None),
+    ('bytes=5-2', None),
+])
+def test_parse_range(header, expected):
+    assert parse_range(header, 10) == expected
+
+
+@pytest.mark.parametrize('header', [
+    'bytes=10-',
+    'bytes=20-30',
+    'bytes=-0',
+])
+def test_parse_range_unsatisfiable(header):
+    with pytest.raises(aiohttp.web.HTTPRequestRangeNotSatisfiable) as error:
+        parse_range(header, 10)
+    assert error.value.headers['Content-Range'] == 'bytes */10'
+
+
+@pytest.mark.parametrize('header,expected', [
+    ('bytes 0-4/10', (0, 4, 10)),
+    ('bytes 9-9/10', (9, 9, 10)),
+    ('bytes */10', (None, None, 10)),
+])
+def test_parse_content_range(header, expected):
+    assert parse_content_range(header) == expected
+
+
+@pytest.mark.parametrize('header', [
+    'bytes 0-4/*',
+    'bytes 5-4/10',
+    'bytes 0-10/10',
+    'items 0-4/10',
+])
+def test_parse_content_range_invalid(header):
+    with pytest.raises(aiohttp.web.HTTPBadRequest):
+        parse_content_range(header)
+
+
+@pytest.mark.asyncio
+async def test_download_range(event_loop, unused_tcp_port, tempdir):
+    """Downloads can be resumed using byte ranges."""
+
+    with open('hello.txt', 'wb') as stream:
+        stream.write(b'Hello, world!')
+
+    host = '127.0.0.1'
+    task = await start_server(event_loop, host, unused_tcp_port)
+    try:
+        async with aiohttp.ClientSession(loop=event_loop) as client:
+            url = 'http://%s:%d/hello.txt' % (host, unused_tcp_port)
+
+            async with client.get(url, headers={
+                'Range': 'bytes=7-',
+            }) as response:
+                assert response.status == 206
+                assert response.headers['Accept-Ranges'] == 'bytes'
+                assert response.headers['Content-Range'] == 'bytes 7-12/13'
+                assert (await response.read()) == b'world!'
+                last_modified = response.headers['Last-Modified']
+
+            # Range applies while the file is unchanged.
+            async with client.get(url, headers={
+                'Range': 'bytes=0-4',
+                'If-Range': last_modified,
+            }) as response:
+                assert response.status == 206
+                assert (await response.read()) == b'Hello'
+
+            # The whole file is sent if it changed (or for unknown ETags).
+            for validator in ('Sat, 01 Jan 2000 00:00:00 GMT', '"abc"', '?'):
+                async with client.get(url, headers={
+                    'Range': 'bytes=0-4',
+                    'If-Range': validator,
+                }) as response:
+                    assert response.status == 200
+                    assert (await response.read()) == b'Hello, world!'
+
+            async with client.get(url, headers={
+                'Range': 'bytes=13-',
+            }) as response:
+                assert response.status == 416
+                assert response.headers['Content-Range'] == 'bytes */13'
+    finally:
+        await stop_server(task)
+
+
+@pytest.mark.asyncio
+async def test_upload_resumable(event_loop, unused_tcp_port, tempdir):
+    """Uploads can be sent in pieces and resumed after a failure."""
+
+    host = '127.0.0.1'
+    task = await start_server(event_loop, host, unused_tcp_port)
+    try:
+        async with aiohttp.ClientSession(loop=event_loop) as client:
+            url = 'http://%s:%d/hello.txt' % (host, unused_tcp_port)
+
+            async def put(content_range, data=b''):
+                async with client.put(url, data=data, headers={
+                    'Content-Range': content_range,
+                }) as response:
+                    return response.status, response.headers.get('Range')
+
+            assert (await put('bytes */13')) == (202, None)
+            assert (await put('bytes 0-4/13', b'Hello')) == \
+                (202, 'bytes=0-4')
+
+            # Gaps are not allowed.
+            assert (await put('bytes 8-12/13', b'orld!')) == \
+                (416, 'bytes=0-4')
+
+            # Overlaps are fine.
+            assert (await put('bytes 3-7/13', b'lo, w')) == \
+                (202, 'bytes=0-7')
+
+            # Short bodies are kept, but the request fails.
+            assert (await put('bytes 8-11/13', b'or')) == \
+                (400, None)
+            assert (await put('bytes */13')) == (202, 'bytes=0-9')
+
+            # Long bodies are rejected, but the file can still complete.
+            assert (await put('bytes 10-12/13', b'ld!!')) == \
+                (400, None)
+            assert (await put('bytes */13')) == (201, None)
+
+            async with client.get(url) as response:
+                assert response.status == 200
+                assert (await response.read()) == b'Hello, world!'
+
+            # Partial uploads are not visible in the staging area.
+            async with client.get(url.replace('hello.txt', '.staging/'))\
+                    as response:
+                assert response.status == 404
+    finally:
+        await stop_server(task)
+
+    assert os.listdir('.staging') == []
+
+
+@pytest.mark.asyncio
+async def test_upload_resumable_total(event_loop, unused_tcp_port, tempdir):
+    """Chunks must all declare the same total size."""
+
+    host = '127.0.0.1'
+    task = await start_server(event_loop, host, unused_tcp_port)
+    try:
+        async with aiohttp.ClientSession(loop=event_loop) as client:
+            url = 'http://%s:%d/hello.txt' % (host, unused_tcp_port)
+
+            async def put(content_range, data=b''):
+                async with client.put(url, data=data, headers={
+                    'Content-Range': content_range,
+                }) as response:
+                    return response.status, response.headers.get('Range')
+
+            assert (await put('bytes 0-4/13', b'Hello')) == \
+                (202, 'bytes=0-4')
+            assert (await put('bytes 5-5/6', b'!')) == (400, None)
+            assert (await put('bytes */14')) == (400, None)
+            assert (await put('bytes */13')) == (202, 'bytes=0-4')
+
+            # Partial files without a recorded total can't shrink.
+            for name in os.listdir('.staging'):
+                if name.endswith('.total'):
+                    os.unlink(os.path.join('.staging', name))
+            assert (await put('bytes */3')) == (400, None)
+
+            assert (await put('bytes 5-12/13', b', world!')) == (201, None)
+            async with client.get(url) as response:
+                assert (await response.read()) == b'Hello, world!'
+    finally:
+        await stop_server(task)
+
+    assert os.listdir('.staging') == []
+
+
+@pytest.mark.parametrize('options', [
+    [],
+    ['--dedup'],
+    ['--layout=sharded'],
+    ['--backend=pack'],
+    ['--cache-bytes=1024', '--compress'],
+    ['--durability=group'],
+])
+@pytest.mark.asyncio
+async def test_upload_resumable_empty(event_loop, unused_tcp_port, tempdir,
+                                      options):
+    """Empty files can be uploaded without sending any chunk."""
+
+    host = '127.0.0.1'
+    task = await start_server(event_loop, host, unused_tcp_port, *options)
+    try:
+        async with aiohttp.ClientSession(loop=event_loop) as client:
+            url = 'http://%s:%d/empty.txt' % (host, unused_tcp_port)
+            rep = await put(client, url, b'', headers={
+                'Content-Range': 'bytes */0',
+            })
+            assert rep.status == 201
+            assert rep.headers['ETag'] == '"%s"' % sha256(b'')
+            async with client.get(url) as rep:
+                assert rep.status == 200
+                assert (await rep.read()) == b''
+    finally:
+        await stop_server(task)
+
+    assert os.listdir('.staging') == []
+
+
+def test_clean_staging(tempdir):
+    """Temporary files are removed and partial uploads expire."""
+
+    os.makedirs('.staging/nested')
+    names = [
+        'upload-1', 'archive-2', 'backup-3',
+        'partial-old', 'partial-old.total',
+        'partial-new', 'partial-new.total',
+        'partial-orphan.total',
+    ]
+    for name in names:
+        with open(os.path.join('.staging', name), 'wb') as stream:
+            stream.write(b'...')
+    os.utime('.staging/partial-old', (1000.0, 1000.0))
+    os.utime('.staging/partial-new', (5000.0, 5000.0))
+
+    clean_staging('.', now=5010.0)
+    assert sorted(os.listdir('.staging')) == [
+        'nested',
+        'partial-new', 'partial-new.total',
+        'partial-old', 'partial-old.total',
+        'partial-orphan.total',
+    ]
+
+    clean_staging('.', 60.0, now=5010.0)
+    assert sorted(os.listdir('.staging')) == [
+        'nested', 'partial-new', 'partial-new.total',
+    ]
+
+
+@pytest.mark.parametrize('options', [
+    [],
+    ['--dedup'],
+])
+@pytest.mark.asyncio
+async def test_upload_conflict(event_loop, unused_tcp_port, tempdir,
+                               options):
+    """Directories are created as needed, but files can't replace them."""
+
+    host = '127.0.0.1'
+    task = await start_server(event_loop, host, unused_tcp_port, *options)
+    try:
+        async with aiohttp.ClientSession(loop=event_loop) as client:
+            url = 'http://%s:%d/' % (host, unused_tcp_port)
+            ranged = {'Content-Range': 'bytes 0-5/6'}
+            for path, headers in (('a/b/c.txt', {}), ('d/e.txt', ranged)):
+                rep = await put(client, url + path, b'Hello!',
+                                headers=headers)
+                assert rep.status == 201
+            for path in ('a/b', 'a/b/c.txt/f.txt'):
+                for headers in ({}, ranged):
+                    async with client.put(url + path, data=b'Hello!',
+                                          headers=headers) as rep:
+                        assert rep.status == 409
+                        assert (await rep.text()) == \
+                            'Conflicting path: "%s".' % path
+            async with client.get(url + 'a/b/c.txt') as rep:
+                assert (await rep.read()) == b'Hello!'
+    finally:
+        await stop_server(task)
+
+    assert sorted(os.listdir('.staging')) == []
+
+
+def sha256_digest(data):
+    return 'SHA-256=%s' % base64.b64encode(
+        hashlib.sha256(data).digest(),
+    ).decode('ascii')
+
+
+@pytest.mark.asyncio
+async def test_upload_dedup(event_loop, unused_tcp_port, tempdir):
+    """Identical files are stored once."""
+
+    host = '127.0.0.1'
+    task = await start_server(event_loop, host, unused_tcp_port, '--dedup')
+    try:
+        async with aiohttp.ClientSession(loop=event_loop) as client:
+            url = 'http://%s:%d/' % (host, unused_tcp_port)
+
+            for path in ('a.txt', 'b.txt'):
+                async with client.put(url + path, data=b'Hello!') as rep:
+                    assert rep.status == 201
+
+            # Known content doesn't need to be sent again.
+            async with client.put(url + 'c.txt', data=b'', expect100=True,
+                                  headers={
+                                      'Digest': sha256_digest(b'Hello!'),
+                                  }) as rep:
+                assert rep.status == 201
+
+            # Unknown content is sent after "100 Continue".
+            async with client.put(url + 'd.txt', data=b'World!',
+                                  expect100=True, headers={
+                                      'Digest': sha256_digest(b'World!'),
+                                  }) as rep:
+                assert rep.status == 201
+
+            # Resumable uploads are deduplicated too.
+            async with client.put(url + 'e.txt', data=b'World!', headers={
+                'Content-Range': 'bytes 0-5/6',
+            }) as rep:
+                assert rep.status == 201
+
+            async with client.get(url + 'c.txt') as rep:
+                assert rep.status == 200
+                assert (await rep.read()) == b'Hello!'
+    finally:
+        await stop_server(task)
+
+    assert os.stat('a.txt').st_ino == os.stat('b.txt').st_ino
+    assert os.stat('a.txt').st_ino == os.stat('c.txt').st_ino
+    assert os.stat('d.txt').st_ino == os.stat('e.txt').st_ino
+    assert collect_blobs('.') == {
+        'blobs': 2,
+        'bytes_stored': 12,
+        'bytes_saved': 18,
+    }
+
+
+@pytest.mark.parametrize('headers,expected_status', [
+    ({'Digest': sha256_digest(b'World!')}, 400),
+    ({'Digest': 'SHA-256=???'}, 400),
+    ({'Digest': 'MD5=abc, SHA-256=%s' % sha256_digest(b'Hello!')[8:]}, 201),
+    ({'Expect': 'the-unexpected'}, 417),
+])
+@pytest.mark.asyncio
+async def test_upload_digest(headers, expected_status, event_loop,
+                             unused_tcp_port, tempdir):
+    """Uploads are checked against the ``Digest`` header."""
+
+    host = '127.0.0.1'
+    task = await start_server(event_loop, host, unused_tcp_port, '--dedup')
+    try:
+        async with aiohttp.ClientSession(loop=event_loop) as client:
+            url = 'http://%s:%d/hello.txt' % (host, unused_tcp_port)
+            async with client.put(url, data=b'Hello!',
+                                  headers=headers) as rep:
+                assert rep.status == expected_status
+    finally:
+        await stop_server(task)
+
+    assert os.listdir('.staging') == []
+
+
+def test_collect_blobs(tempdir):
+    """Unreferenced blobs are removed."""
+
+    os.makedirs('.staging')
+    for name, data in (('a.txt', b'Hello!'), ('b.txt', b'World!')):
+        with open('.staging/temp', 'wb') as stream:
+            stream.write(data)
+        commit_blob('.staging/temp',
+                    blob_path('.', hashlib.sha256(data).hexdigest()), name)
+    os.unlink('b.txt')
+    assert collect_blobs('.') == {
+        'blobs': 1,
+        'bytes_stored': 6,
+        'bytes_saved': 0,
+    }
+    assert len(os.listdir('.blobs/' + os.listdir('.blobs')[0])) == 1
+
+
+@pytest.mark.parametrize('header,weak,expected', [
+    ('"abc"', False, True),
+    ('"xyz", "abc"', False, True),
+    ('*', False, True),
+    ('"xyz"', False, False),
+    ('W/"abc"', False, False),
+    ('W/"abc"', True, True),
+])
+def test_etag_matches(header, weak, expected):
+    assert etag_matches(header, 'abc', weak=weak) == expected
+    assert not etag_matches(header, None, weak=weak)
+
+
+def test_digest_index(tempdir):
+    """Digests are computed lazily and recomputed when files change."""
+
+    os.makedirs('.index')
+    index = DigestIndex('.')
+    try:
+        assert index.lookup('./missing.txt') is None
+
+        with open('hello.txt', 'wb') as stream:
+            stream.write(b'Hello!')
+        digest = hashlib.sha256(b'Hello!').hexdigest()
+        assert index.lookup('./hello.txt') == digest
+
+        # Cached digests are used while the file is unchanged.
+        with mock.patch('smartmob_filestore.hash_file') as hash_file:
+            assert index.lookup('./hello.txt') == digest
+            hash_file.assert_not_called()
+
+        # Files changed behind the server's back are hashed again.
+        with open('hello.txt', 'wb') as stream:
+            stream.write(b'Hello, world!')
+        digest = hashlib.sha256(b'Hello, world!').hexdigest()
+        assert index.lookup('./hello.txt') == digest
+    finally:
+        index.close()
+
+    # The index is persistent.
+    index = DigestIndex('.')
+    try:
+        with mock.patch('smartmob_filestore.hash_file') as hash_file:
+            assert index.lookup('./hello.txt') == digest
+            hash_file.assert_not_called()
+    finally:
+        index.close()
+
+
+def test_digest_index_scan(tempdir):
+    """Scans reconcile the index with files changed while it was offline."""
+
+    os.makedirs('.index')
+    os.makedirs('.staging')
+    os.makedirs('docs')
+    for path in ('a.txt', 'docs/1.txt', 'docs/2.txt', '.staging/x'):
+        with open(path, 'wb') as stream:
+            stream.write(b'...')
+
+    index = DigestIndex('.')
+    try:
+        assert index.scan() == 3
+        assert [row[0] for row in index.list()] == [
+            'a.txt', 'docs/1.txt', 'docs/2.txt',
+        ]
+        assert [row[0] for row in index.list('docs/', 'docs/1.txt')] == [
+            'docs/2.txt',
+        ]
+        assert [row[0] for row in index.list(limit=1)] == ['a.txt']
+        digest = index.lookup('./a.txt')
+
+        # Digests of unchanged files are kept.
+        with mock.patch('smartmob_filestore.hash_file') as hash_file:
+            assert index.scan() == 3
+            assert index.lookup('./a.txt') == digest
+            hash_file.assert_not_called()
+
+        # Removed files are dropped from the index.
+        os.unlink('docs/1.txt')
+        with open('b.txt', 'wb') as stream:
+            stream.write(b'...')
+        assert index.scan() == 3
+        assert [row[0] for row in index.list()] == [
+            'a.txt', 'b.txt', 'docs/2.txt',
+        ]
+
+        # Failed scans leave the index untouched.
+        os.unlink('a.txt')
+        with mock.patch('smartmob_filestore.walk_storage') as walk_storage:
+            walk_storage.side_effect = OSError()
+            with pytest.raises(OSError):
+                index.scan()
+        assert [row[0] for row in index.list()] == [
+            'a.txt', 'b.txt', 'docs/2.txt',
+        ]
+    finally:
+        index.close()
+
+
+def test_digest_index_concurrent_change(tempdir):
+    """Files changed while they're hashed are not indexed."""
+
+    os.makedirs('.index')
+    with open('hello.txt', 'wb') as stream:
+        stream.write(b'Hello!')
+
+    def hash_and_change(path):
+        with open(path, 'ab') as stream:
+            stream.write(b'!!')
+        return 'abc'
+
+    index = DigestIndex('.')
+    try:
+        with mock.patch('smartmob_filestore.hash_file') as hash_file:
+            hash_file.side_effect = hash_and_change
+            assert index.lookup('./hello.txt') == 'abc'
+        assert index.lookup('./hello.txt') == \
+            hashlib.sha256(b'Hello!!!').hexdigest()
+    finally:
+        index.close()
+
+
+@pytest.mark.asyncio
+async def test_conditional_get(event_loop, unused_tcp_port, tempdir):
+    """Clients can revalidate downloads using ETags."""
+
+    with open('hello.txt', 'wb') as stream:
+        stream.write(b'Hello, world!')
+    etag = '"%s"' % hashlib.sha256(b'Hello, world!').hexdigest()
+
+    host = '127.0.0.1'
+    task = await start_server(event_loop, host, unused_tcp_port)
+    try:
+        async with aiohttp.ClientSession(loop=event_loop) as client:
+            url = 'http://%s:%d/hello.txt' % (host, unused_tcp_port)
+
+            async with client.get(url) as response:
+                assert response.status == 200
+                assert response.headers['ETag'] == etag
+
+            for validator in (etag, 'W/' + etag, '"abc", ' + etag, '*'):
+                async with client.get(url, headers={
+                    'If-None-Match': validator,
+                }) as response:
+                    assert response.status == 304
+                    assert response.headers['ETag'] == etag
+
+            # If-None-Match has precedence over If-Modified-Since.
+            async with client.get(url, headers={
+                'If-None-Match': '"abc"',
+                'If-Modified-Since': 'Fri, 01 Jan 2100 00:00:00 GMT',
+            }) as response:
+                assert response.status == 200
+
+            async with client.get(url, headers={
+                'Range': 'bytes=7-',
+                'If-Range': etag,
+            }) as response:
+                assert response.status == 206
+                assert (await response.read()) == b'world!'
+    finally:
+        await stop_server(task)
+
+
+@pytest.mark.asyncio
+async def test_conditional_put(event_loop, unused_tcp_port, tempdir):
+    """Clients can use ETags for optimistic concurrency control."""
+
+    host = '127.0.0.1'
+    task = await start_server(event_loop, host, unused_tcp_port)
+    try:
+        async with aiohttp.ClientSession(loop=event_loop) as client:
+            url = 'http://%s:%d/hello.txt' % (host, unused_tcp_port)
+
+            async def put(data, **headers):
+                async with client.put(url, data=data,
+                                      headers=headers) as response:
+                    return response.status, response.headers.get('ETag')
+
+            # Create-only.
+            status, etag = await put(b'Hello!', **{'If-None-Match': '*'})
+            assert status == 201
+            assert etag == '"%s"' % hashlib.sha256(b'Hello!').hexdigest()
+            assert (await put(b'Hello!', **{'If-None-Match': '*'})) == \
+                (412, None)
+
+            # Update-only if unchanged.
+            assert (await put(b'Hi!', **{'If-Match': '"abc"'})) == \
+                (412, None)
+            status, etag = await put(b'Hi!', **{'If-Match': etag})
+            assert status == 201
+
+            # Preconditions are checked again when resumable uploads end.
+            status, _ = await put(b'Hello', **{
+                'If-Match': etag,
+                'Content-Range': 'bytes 0-4/13',
+            })
+            assert status == 202
+            assert (await put(b'Bye!')) == \
+                (201, '"%s"' % hashlib.sha256(b'Bye!').hexdigest())
+            assert (await put(b', world!', **{
+                'If-Match': etag,
+                'Content-Range': 'bytes 5-12/13',
+            })) == (412, None)
+
+            async with client.get(url) as response:
+                assert (await response.read()) == b'Bye!'
+    finally:
+        await stop_server(task)
+
+    assert os.listdir('.staging') == []
+
+
+@pytest.mark.asyncio
+async def test_conditional_put_race(event_loop, unused_tcp_port, tempdir):
+    """Preconditions are checked atomically with the upload's completion."""
+
+    host = '127.0.0.1'
+    task = await start_server(event_loop, host, unused_tcp_port)
+    try:
+        async with aiohttp.ClientSession(loop=event_loop) as client:
+            url = 'http://%s:%d/hello.txt' % (host, unused_tcp_port)
+            async with client.put(url, data=b'Hi!') as response:
+                assert response.status == 201
+                etag = response.headers['ETag']
+
+            # Someone changes the file right after the early check.
+            with open('hello.txt', 'wb') as stream:
+                stream.write(b'Bye!')
+            with mock.patch('smartmob_filestore.DigestIndex.lookup') as lookup:
+                lookup.return_value = etag[1:-1]
+                async with client.put(url, data=b'Hello!', headers={
+                    'If-Match': etag,
+                    'Content-Range': 'bytes 0-5/6',
+                }) as response:
+                    assert response.status == 412
+    finally:
+        await stop_server(task)
+
+    assert os.listdir('.staging') == []
+    with open('hello.txt', 'rb') as stream:
+        assert stream.read() == b'Bye!'
+
+
+def cache_entry(data):
+    info = mock.MagicMock()
+    return CacheEntry(info, data, hashlib.sha256(data).hexdigest())
+
+
+def test_content_cache():
+    """The cache evicts the least recently used files first."""
+
+    cache = ContentCache(10, 6)
+    assert cache.admits(6)
+    assert not cache.admits(7)
+
+    cache.put('a', cache_entry(b'aaaa'), cache.token())
+    cache.put('b', cache_entry(b'bbbb'), cache.token())
+    assert cache.get('a').data == b'aaaa'
+    assert cache.size == 8
+
+    # "b" is the least recently used.
+    cache.put('c', cache_entry(b'cccc'), cache.token())
+    assert cache.get('b') is None
+    assert cache.get('a').data == b'aaaa'
+    assert cache.get('c').data == b'cccc'
+    assert cache.size == 8
+    assert (cache.hits, cache.misses, cache.evictions) == (3, 1, 1)
+
+    # Replacing an entry.
+    cache.put('c', cache_entry(b'cc'), cache.token())
+    assert cache.get('c').data == b'cc'
+    assert cache.size == 6
+
+    # Large files are not cached.
+    cache.put('d', cache_entry(b'ddddddd'), cache.token())
+    assert cache.get('d') is None
+    assert cache.size == 6
+
+    # Contents read before an invalidation are not cached.
+    token = cache.token()
+    cache.invalidate('c')
+    cache.invalidate('e')
+    cache.put('e', cache_entry(b'ee'), token)
+    assert cache.get('c') is None
+    assert cache.get('e') is None
+    assert cache.size == 4
+
+
+def read_access_log(capsys):
+    out, _ = capsys.readouterr()
+    events = [json.loads(line) for line in out.split('\n') if line]
+    return [event for event in events if event['event'] == 'http.access']
+
+
+@pytest.mark.asyncio
+async def test_download_cache(event_loop, unused_tcp_port, tempdir, capsys):
+    """Small files are served from memory."""
+
+    with open('big.txt', 'wb') as stream:
+        stream.write(b'.' * 101)
+
+    host = '127.0.0.1'
+    task = await start_server(event_loop, host, unused_tcp_port,
+                              '--cache-bytes=1024', '--cache-max-object=100')
+    try:
+        async with aiohttp.ClientSession(loop=event_loop) as client:
+            url = 'http://%s:%d/' % (host, unused_tcp_port)
+
+            async with client.put(url + 'hello.txt', data=b'Hello!') as rep:
+                assert rep.status == 201
+            for _ in range(2):
+                async with client.get(url + 'hello.txt') as rep:
+                    assert rep.status == 200
+                    assert (await rep.read()) == b'Hello!'
+                    etag = rep.headers['ETag']
+            async with client.head(url + 'hello.txt') as rep:
+                assert rep.status == 200
+                assert rep.headers['Content-Length'] == '6'
+            async with client.get(url + 'hello.txt', headers={
+                'Range': 'bytes=1-2',
+            }) as rep:
+                assert rep.status == 206
+                assert (await rep.read()) == b'el'
+            async with client.get(url + 'hello.txt', headers={
+                'If-None-Match': etag,
+            }) as rep:
+                assert rep.status == 304
+
+            # Uploads invalidate the cache.
+            async with client.put(url + 'hello.txt', data=b'Bye!') as rep:
+                assert rep.status == 201
+            async with client.get(url + 'hello.txt') as rep:
+                assert (await rep.read()) == b'Bye!'
+
+            # Large files are not cached.
+            for _ in range(2):
+                async with client.get(url + 'big.txt') as rep:
+                    assert (await rep.read()) == b'.' * 101
+    finally:
+        await stop_server(task)
+
+    events = read_access_log(capsys)
+    assert [(e['cache_hits'], e['cache_misses']) for e in events] == [
+        (0, 0),  # PUT
+        (0, 1),
+        (1, 1),
+        (2, 1),  # HEAD
+        (3, 1),  # Range
+        (4, 1),  # If-None-Match
+        (4, 1),  # PUT
+        (4, 2),
+        (4, 3),
+        (4, 4),
+    ]
+    assert events[-1]['cache_evictions'] == 0
+    assert events[-1]['cache_size'] == 4
+
+
+@pytest.mark.asyncio
+async def test_download_cache_validate(event_loop, unused_tcp_port, tempdir):
+    """Workers check cached files against the disk."""
+
+    with open('hello.txt', 'wb') as stream:
+        stream.write(b'Hello!')
+
+    host = '127.0.0.1'
+    sock = bind_socket(host, unused_tcp_port)
+    task = await start_server(event_loop, host, unused_tcp_port,
+                              '--socket-fd=%d' % sock.fileno(),
+                              '--cache-bytes=1024')
+    try:
+        async with aiohttp.ClientSession(loop=event_loop) as client:
+            url = 'http://%s:%d/hello.txt' % (host, unused_tcp_port)
+            async with client.get(url) as rep:
+                assert (await rep.read()) == b'Hello!'
+
+            # Another worker changes the file.
+            with open('hello.txt', 'wb') as stream:
+                stream.write(b'Hello, world!')
+            async with client.get(url) as rep:
+                assert (await rep.read()) == b'Hello, world!'
+            async with client.get(url) as rep:
+                assert (await rep.read()) == b'Hello, world!'
+
+            # Another worker deletes the file.
+            os.unlink('hello.txt')
+            async with client.get(url) as rep:
+                assert rep.status == 404
+    finally:
+        await stop_server(task)
+
+
+@pytest.mark.asyncio
+async def test_listing(event_loop, unused_tcp_port, tempdir):
+    """Stored files are listed in pages, sorted by path."""
+
+    os.makedirs('docs')
+    for path in ('a.txt', 'docs/1.txt', 'docs/2.txt'):
+        with open(path, 'wb') as stream:
+            stream.write(b'...')
+
+    host = '127.0.0.1'
+    task = await start_server(event_loop, host, unused_tcp_port)
+    try:
+        async with aiohttp.ClientSession(loop=event_loop) as client:
+            url = 'http://%s:%d/' % (host, unused_tcp_port)
+            async with client.put(url + 'docs/3.txt', data=b'3!') as rep:
+                assert rep.status == 201
+
+            async with client.get(url, params={'list': ''}) as rep:
+                assert rep.status == 200
+                assert rep.headers['Content-Type'].startswith(
+                    'application/json'
+                )
+                page = await rep.json()
+            assert page['cursor'] is None
+            assert [f['path'] for f in page['files']] == [
+                'a.txt', 'docs/1.txt', 'docs/2.txt', 'docs/3.txt',
+            ]
+            assert page['files'][3]['size'] == 2
+            assert page['files'][3]['mtime'].endswith('+00:00')
+
+            paths = []
+            params = {'list': '', 'prefix': 'docs/', 'limit': '2'}
+            while True:
+                async with client.get(url, params=params) as rep:
+                    assert rep.status == 200
+                    page = await rep.json()
+                assert len(page['files']) <= 2
+                paths.extend(f['path'] for f in page['files'])
+                if page['cursor'] is None:
+                    break
+                params['cursor'] = page['cursor']
+            assert paths == ['docs/1.txt', 'docs/2.txt', 'docs/3.txt']
+
+            for params in ({}, {'limit': '2'}):
+                async with client.get(url, params=params) as rep:
+                    assert rep.status == 403
+            async with client.get(url + 'docs') as rep:
+                assert rep.status == 403
+
+            for params in (
+                {'limit': 'x'},
+                {'limit': '0'},
+                {'limit': '1001'},
+                {'cursor': 'a'},
+                {'cursor': '_w=='},
+            ):
+                params['list'] = ''
+                async with client.get(url, params=params) as rep:
+                    assert rep.status == 400
+    finally:
+        await stop_server(task)
+
+
+@pytest.mark.parametrize('path,expected', [
+    ('index.html', True),
+    ('data.json', True),
+    ('feed.atom', True),
+    ('logo.svg', True),
+    ('logo.png', False),
+    ('notes.txt.gz', False),
+    ('unknown', False),
+])
+def test_compressible(path, expected):
+    assert compressible(path) is expected
+
+
+@pytest.mark.parametrize('header,expected', [
+    ('', None),
+    ('gzip', 'gzip'),
+    ('br, gzip, deflate', 'gzip'),
+    ('GZIP;q=0.5', None),
+    ('gzip;q=0.5, identity;q=0.1', 'gzip'),
+    ('gzip;q=0', None),
+    ('gzip;q=x', None),
+    ('gzip;level=1', 'gzip'),
+    ('*', 'gzip'),
+    ('*;q=0, identity', None),
+    ('identity;q=0, *', 'gzip'),
+])
+def test_negotiate_encoding(header, expected):
+    assert negotiate_encoding(header, ('gzip',)) == expected
+
+
+def test_compress_file(tempdir):
+    """Compressed copies are only stored when they're useful."""
+
+    data = b'Hello, world!\n' * 100
+    digest = hashlib.sha256(data).hexdigest()
+    with open('hello.txt', 'wb') as stream:
+        stream.write(data)
+    variant = variant_path('.', digest, 'gzip')
+
+    # Too small.
+    assert compress_file('hello.txt', digest, variant, 'temp', 2000) is None
+    assert not os.path.exists(variant)
+
+    # Changed since the upload.
+    assert compress_file('hello.txt', 'abc', variant, 'temp', 0) is None
+    assert not os.path.exists(variant)
+    assert not os.path.exists('temp')
+
+    size = compress_file('hello.txt', digest, variant, 'temp', 0)
+    assert size == os.path.getsize(variant)
+    assert size < len(data)
+    with gzip.open(variant, 'rb') as stream:
+        assert stream.read() == data
+    assert compress_file('hello.txt', digest, variant, 'temp', 0) == size
+
+    # Doesn't compress.
+    data = os.urandom(1024)
+    digest = hashlib.sha256(data).hexdigest()
+    with open('random.txt', 'wb') as stream:
+        stream.write(data)
+    variant = variant_path('.', digest, 'gzip')
+    assert compress_file('random.txt', digest, variant, 'temp', 0) is None
+    assert not os.path.exists(variant)
+    assert not os.path.exists('temp')
+
+
+def test_collect_variants(tempdir):
+    """Compressed copies of files that are gone are removed."""
+
+    for digest in ('ab12', 'ab34', 'cd56'):
+        path = variant_path('.', digest, 'gzip')
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as stream:
+            stream.write(b'...')
+    collect_variants('.', {'ab12', 'cd56'})
+    assert os.path.exists(variant_path('.', 'ab12', 'gzip'))
+    assert not os.path.exists(variant_path('.', 'ab34', 'gzip'))
+    assert os.path.exists(variant_path('.', 'cd56', 'gzip'))
+
+
+@pytest.mark.asyncio
+async def test_download_compressed(event_loop, unused_tcp_port, tempdir):
+    """Compressed copies are stored on upload and served on demand."""
+
+    data = b'{"hello": "world"}\n' * 100
+    digest = hashlib.sha256(data).hexdigest()
+
+    host = '127.0.0.1'
+    task = await start_server(event_loop, host, unused_tcp_port,
+                              '--compress', '--compress-min-size=64')
+    try:
+        async with aiohttp.ClientSession(loop=event_loop) as client:
+            url = 'http://%s:%d/' % (host, unused_tcp_port)
+            async with client.put(url + 'data.json', data=data) as rep:
+                assert rep.status == 201
+            async with client.put(url + 'small.json', data=b'{}') as rep:
+                assert rep.status == 201
+            with mock.patch('smartmob_filestore.compress_file') as compress:
+                compress.side_effect = OSError('Disk full.')
+                async with client.put(url + 'fail.json',
+                                      data=data + b'{}') as rep:
+                    assert rep.status == 201
+
+            # Compression happens in the background.
+            ref = default_timer()
+            gzip_only = {'Accept-Encoding': 'gzip'}
+            while True:
+                async with client.head(url + 'data.json',
+                                       headers=gzip_only) as rep:
+                    assert rep.status == 200
+                    if 'Content-Encoding' in rep.headers:
+                        break
+                assert (default_timer() - ref) < 5.0
+                await asyncio.sleep(0.05)
+            assert rep.headers['Content-Encoding'] == 'gzip'
+            assert rep.headers['Vary'] == 'Accept-Encoding'
+            assert rep.headers['ETag'] == '"%s-gzip"' % digest
+            assert int(rep.headers['Content-Length']) < len(data)
+            async with client.get(url + 'data.json',
+                                  headers=gzip_only) as rep:
+                assert rep.status == 200
+                assert (await rep.read()) == data
+            async with client.get(url + 'data.json', headers={
+                'Accept-Encoding': 'gzip',
+                'If-None-Match': '"%s-gzip"' % digest,
+            }) as rep:
+                assert rep.status == 304
+                assert rep.headers['Vary'] == 'Accept-Encoding'
+
+            # Clients that don't accept it get the original.
+            async with client.head(url + 'data.json', headers={
+                'Accept-Encoding': 'identity',
+            }) as rep:
+                assert rep.status == 200
+                assert 'Content-Encoding' not in rep.headers
+                assert rep.headers['Vary'] == 'Accept-Encoding'
+                assert rep.headers['ETag'] == '"%s"' % digest
+                assert rep.headers['Content-Length'] == str(len(data))
+
+            # Files without a compressed copy.
+            for path in ('small.json', 'fail.json'):
+                async with client.head(url + path, headers=gzip_only) as rep:
+                    assert rep.status == 200
+                    assert 'Content-Encoding' not in rep.headers
+                    assert rep.headers['Vary'] == 'Accept-Encoding'
+    finally:
+        await stop_server(task)
+    assert os.path.exists(variant_path('.', digest, 'gzip'))
+
+
+@pytest.mark.asyncio
+async def test_compress_on_shutdown(event_loop, unused_tcp_port, tempdir):
+    """The server waits for background compression before it stops."""
+
+    release = threading.Event()
+
+    def compress_file(*args):
+        release.wait()
+        return None
+
+    host = '127.0.0.1'
+    with mock.patch('smartmob_filestore.compress_file') as compress:
+        compress.side_effect = compress_file
+        task = await start_server(event_loop, host, unused_tcp_port,
+                                  '--compress')
+        try:
+            async with aiohttp.ClientSession(loop=event_loop) as client:
+                url = 'http://%s:%d/hello.txt' % (host, unused_tcp_port)
+                async with client.put(url, data=b'Hello!') as rep:
+                    assert rep.status == 201
+        finally:
+            event_loop.call_later(0.1, release.set)
+            await stop_server(task)
+    assert compress.call_count == 1
+
+
+@pytest.mark.asyncio
+async def test_metrics(event_loop, unused_tcp_port_factory, tempdir):
+    """Metrics are served on a separate port."""
+
+    host = '127.0.0.1'
+    port = unused_tcp_port_factory()
+    metrics_port = unused_tcp_port_factory()
+    task = await start_server(event_loop, host, port,
+                              '--metrics-port=%d' % metrics_port)
+    try:
+        async with aiohttp.ClientSession(loop=event_loop) as client:
+            url = 'http://%s:%d/' % (host, port)
+            async with client.put(url + 'hello.txt', data=b'Hello!') as rep:
+                assert rep.status == 201
+            async with client.put(url + 'world.txt', data=b'world', headers={
+                'Content-Range': 'bytes 0-4/5',
+            }) as rep:
+                assert rep.status == 201
+            async with client.get(url + 'metrics') as rep:
+                assert rep.status == 404
+
+            url = 'http://%s:%d/metrics' % (host, metrics_port)
+            async with client.get(url) as rep:
+                assert rep.status == 200
+                assert rep.headers['Content-Type'] == (
+                    'text/plain; version=0.0.4; charset=utf-8'
+                )
+                lines = (await rep.text()).splitlines()
+    finally:
+        await stop_server(task)
+
+    assert 'http_requests_in_flight 0' in lines
+    assert 'http_request_duration_seconds_count' \
+        '{method="PUT",status="201"} 2' in lines
+    assert 'http_request_duration_seconds_count' \
+        '{method="GET",status="404"} 1' in lines
+    assert 'http_request_bytes_total{method="PUT"} 11' in lines
+    assert 'upload_size_bytes_count 2' in lines
+    assert 'upload_size_bytes_sum 11' in lines
+
+
+def make_archive(members, mode='w'):
+    """Build a tar archive from ``(name, data)`` pairs.
+
+    Members with ``None`` data are directories, members with ``bytes`` data
+    are regular files and members with a ``TarInfo`` are added as is.
+    """
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode=mode) as archive:
+        for name, data in members:
+            if isinstance(data, tarfile.TarInfo):
+                data.name = name
+                archive.addfile(data)
+            elif data is None:
+                info = tarfile.TarInfo(name)
+                info.type = tarfile.DIRTYPE
+                archive.addfile(info)
+            else:
+                info = tarfile.TarInfo(name)
+                info.size = len(data)
+                archive.addfile(info, io.BytesIO(data))
+    return buffer.getvalue()
+
+
+def symlink(target):
+    info = tarfile.TarInfo()
+    info.type = tarfile.SYMTYPE
+    info.linkname = target
+    return info
+
+
+@pytest.mark.parametrize('mode,options', [
+    ('w', []),
+    ('w:gz', ['--dedup']),
+    ('w:bz2', ['--cache-bytes=1024']),
+])
+@pytest.mark.asyncio
+async def test_upload_archive(event_loop, unused_tcp_port, tempdir,
+                              mode, options):
+    """Archives are extracted and committed as a set."""
+
+    payload = os.urandom(3 * UPLOAD_CHUNK_SIZE + 17)
+    archive = make_archive([
+        ('a.txt', b'Old!'),
+        ('dir', None),
+        ('dir/b.bin', payload),
+        ('a.txt', b'Hello!'),
+    ], mode=mode)
+    host = '127.0.0.1'
+    task = await start_server(event_loop, host, unused_tcp_port, *options)
+    try:
+        async with aiohttp.ClientSession(loop=event_loop) as client:
+            url = 'http://%s:%d/' % (host, unused_tcp_port)
+            async with client.get(url + 'releases/a.txt') as rep:
+                assert rep.status == 404
+            async with client.post(url + 'releases', data=archive) as rep:
+                assert rep.status == 201
+                manifest = await rep.json()
+
+            # Archives can overwrite existing files.
+            async with client.post(url + 'releases', data=archive) as rep:
+                assert rep.status == 201
+                assert (await rep.json()) == manifest
+            async with client.get(url + 'releases/a.txt') as rep:
+                assert rep.status == 200
+                assert (await rep.read()) == b'Hello!'
+    finally:
+        await stop_server(task)
+
+    assert manifest == {'files': [
+        {
+            'path': 'releases/dir/b.bin',
+            'size': len(payload),
+            'digest': hashlib.sha256(payload).hexdigest(),
+        },
+        {
+            'path': 'releases/a.txt',
+            'size': 6,
+            'digest': hashlib.sha256(b'Hello!').hexdigest(),
+        },
+    ]}
+    with open('releases/dir/b.bin', 'rb') as stream:
+        assert stream.read() == payload
+    assert os.listdir('.staging') == []
+
+
+@pytest.mark.parametrize('archive,status', [
+    (make_archive([('../evil.txt', b'Evil!')]), 400),
+    (make_archive([('/evil.txt', b'Evil!')]), 400),
+    (make_archive([('ok/../../evil.txt', b'Evil!')]), 400),
+    (make_archive([('ok.txt', b'Ok'), ('.index/evil', b'Evil!')]), 400),
+    (make_archive([('ok.txt', b'Ok'), ('link', symlink('/etc/passwd'))]),
+     400),
+    (make_archive([('ok.bin', os.urandom(4096))])[:2048], 400),
+    (b'Not an archive.', 400),
+    (ZSTD_MAGIC + make_archive([('ok.txt', b'Ok')]), 415),
+])
+@pytest.mark.asyncio
+async def test_upload_archive_invalid(event_loop, unused_tcp_port, tempdir,
+                                      archive, status):
+    """Invalid archives and unsafe paths fail the whole upload."""
+
+    host = '127.0.0.1'
+    task = await start_server(event_loop, host, unused_tcp_port)
+    try:
+        async with aiohttp.ClientSession(loop=event_loop) as client:
+            url = 'http://%s:%d/' % (host, unused_tcp_port)
+            async with client.post(url, data=archive) as rep:
+                assert rep.status == status
+    finally:
+        await stop_server(task)
+
+    assert sorted(os.listdir('.')) == ['.index', '.staging']
+    assert os.listdir('.staging') == []
+
+
+@pytest.mark.parametrize('options', [
+    [],
+    ['--cache-bytes=1024'],
+])
+@pytest.mark.asyncio
+async def test_upload_archive_conflict(event_loop, unused_tcp_port, tempdir,
+                                       options):
+    """Files are restored when one file of the archive can't be placed."""
+
+    os.mkdir('dir')
+    with open('a.txt', 'wb') as stream:
+        stream.write(b'Old!')
+    host = '127.0.0.1'
+    task = await start_server(event_loop, host, unused_tcp_port, *options)
+    try:
+        async with aiohttp.ClientSession(loop=event_loop) as client:
+            url = 'http://%s:%d/' % (host, unused_tcp_port)
+            for archive, path in [
+                (make_archive([('a.txt', b'New!'), ('dir', b'File!')]),
+                 'dir'),
+                (make_archive([('b.txt', b'New!'), ('a.txt/c', b'File!')]),
+                 'a.txt/c'),
+                (make_archive([('b.txt', b'New!'), ('b.txt/c', b'File!')]),
+                 'b.txt/c'),
+            ]:
+                async with client.post(url, data=archive) as rep:
+                    assert rep.status == 409
+                    assert (await rep.text()) == \
+                        'Conflicting path: "%s".' % path
+            async with client.get(url + 'a.txt') as rep:
+                assert rep.status == 200
+                assert (await rep.read()) == b'Old!'
+    finally:
+        await stop_server(task)
+
+    assert sorted(os.listdir('.')) == [
+        '.index', '.staging', 'a.txt', 'dir',
+    ]
+    assert os.listdir('.staging') == []
+
+
+def test_open_archive_zstd():
+    """zstd archives are decompressed with the ``zstandard`` package."""
+
+    archive = make_archive([('a.txt', b'Hello!')])
+
+    def stream_reader(stream):
+        assert stream.read(len(ZSTD_MAGIC)) == ZSTD_MAGIC
+        return stream
+
+    with mock.patch('smartmob_filestore.zstandard') as zstandard:
+        zstandard.ZstdDecompressor.return_value.stream_reader.side_effect = \
+            stream_reader
+        stream = io.BufferedReader(io.BytesIO(ZSTD_MAGIC + archive))
+        with open_archive(stream) as archive:
+            member = archive.next()
+            assert member.name == 'a.txt'
+            assert archive.extractfile(member).read() == b'Hello!'
+
+
+@pytest.mark.asyncio
+async def test_upload_archive_failure_cleanup(event_loop, unused_tcp_port,
+                                              tempdir):
+    """Extracted files are removed when they can't be committed."""
+
+    host = '127.0.0.1'
+    task = await start_server(event_loop, host, unused_tcp_port)
+    try:
+        async with aiohttp.ClientSession(loop=event_loop) as client:
+            url = 'http://%s:%d/' % (host, unused_tcp_port)
+            with mock.patch('smartmob_filestore.install') as install:
+                install.side_effect = PermissionError
+                archive = make_archive([('a.txt', b'Hello!')])
+                async with client.post(url, data=archive) as rep:
+                    assert rep.status == 500
+    finally:
+        await stop_server(task)
+
+    assert sorted(os.listdir('.')) == ['.index', '.staging']
+    assert os.listdir('.staging') == []
+
+
+@pytest.mark.asyncio
+async def test_upload_archive_stalled(event_loop, unused_tcp_port, tempdir):
+    """Stalled archive uploads don't hold the I/O threads and time out."""
+
+    host = '127.0.0.1'
+    task = await start_server(event_loop, host, unused_tcp_port,
+                              '--io-threads=1', '--archive-read-timeout=1')
+    try:
+        async with aiohttp.ClientSession(loop=event_loop) as client:
+            url = 'http://%s:%d/' % (host, unused_tcp_port)
+            rep = await put(client, url + 'a.txt', b'Hello!')
+            assert rep.status == 201
+            archive = make_archive([('b.txt', b'Hello!')])
+            body = slow_body(event_loop, archive[:100])
+            upload = event_loop.create_task(client.post(
+                url, data=body,
+                headers={'Content-Length': str(len(archive))},
+            ))
+            await asyncio.sleep(0.1)
+
+            async with client.get(url + 'a.txt') as rep:
+                assert rep.status == 200
+                assert (await rep.read()) == b'Hello!'
+            assert not upload.done()
+
+            async with (await upload) as rep:
+                assert rep.status == 408
+    finally:
+        await stop_server(task)
+
+    assert sorted(os.listdir('.')) == ['.index', '.staging', 'a.txt']
+    assert os.listdir('.staging') == []
+
+
+def read_archive(data):
+    """Map the names of files in a tar archive to their contents."""
+    files = {}
+    with tarfile.open(fileobj=io.BytesIO(data)) as archive:
+        for member in archive:
+            files[member.name] = archive.extractfile(member).read()
+    return files
+
+
+@pytest.mark.asyncio
+async def test_download_archive(event_loop, unused_tcp_port, tempdir):
+    """Directories are downloaded as (compressed) tar archives."""
+
+    files = {
+        'a.txt': b'Hello!',
+        'dir/b.bin': os.urandom(SENDFILE_MIN_SIZE + 17),
+        'dir/c.bin': os.urandom(3 * DOWNLOAD_CHUNK_SIZE + 17),
+        'dir/empty.txt': b'',
+    }
+    host = '127.0.0.1'
+    task = await start_server(event_loop, host, unused_tcp_port)
+    try:
+        async with aiohttp.ClientSession(loop=event_loop) as client:
+            url = 'http://%s:%d/' % (host, unused_tcp_port)
+            archive = make_archive(sorted(files.items()))
+            async with client.post(url + 'releases', data=archive) as rep:
+                assert rep.status == 201
+            async with client.put(url + 'other.txt', data=b'Other') as rep:
+                assert rep.status == 201
+
+            async with client.get(url + 'releases?archive') as rep:
+                assert rep.status == 200
+                assert rep.headers['Content-Type'] == 'application/x-tar'
+                assert rep.headers['Transfer-Encoding'] == 'chunked'
+                assert rep.headers['Content-Disposition'] == \
+                    'attachment; filename="releases.tar"'
+                data = await rep.read()
+            assert len(data) % tarfile.RECORDSIZE == 0
+            assert read_archive(data) == files
+
+            async with client.get(url + 'releases/dir?archive=gz') as rep:
+                assert rep.status == 200
+                assert rep.headers['Content-Type'] == 'application/gzip'
+                assert rep.headers['Content-Disposition'] == \
+                    'attachment; filename="dir.tar.gz"'
+                data = await rep.read()
+            assert read_archive(gzip.decompress(data)) == {
+                name[4:]: content for name, content in files.items()
+                if name.startswith('dir/')
+            }
+
+            # Files removed behind the server's back are skipped.
+            os.unlink('releases/a.txt')
+            async with client.get(url + '?archive=tar') as rep:
+                assert rep.status == 200
+                assert rep.headers['Content-Disposition'] == \
+                    'attachment; filename="archive.tar"'
+                data = await rep.read()
+            expected = {
+                'releases/' + name: content
+                for name, content in files.items() if name != 'a.txt'
+            }
+            expected['other.txt'] = b'Other'
+            assert read_archive(data) == expected
+
+            async with client.head(url + 'releases?archive') as rep:
+                assert rep.status == 200
+                assert rep.headers['Content-Type'] == 'application/x-tar'
+
+            for path, status in [
+                ('releases?archive=zip', 400),
+                ('missing?archive', 404),
+                ('other.txt?archive', 404),
+                ('other.txt/x?archive', 404),
+                ('.index?archive', 404),
+            ]:
+                async with client.get(url + path) as rep:
+                    assert rep.status == status
+    finally:
+        await stop_server(task)
+
+
+@pytest.mark.asyncio
+async def test_sendfile(event_loop, tempdir):
+    """Files are sent on non-blocking sockets until they are complete."""
+
+    payload = os.urandom(4 * 1024 * 1024)
+    with open('data.bin', 'wb') as stream:
+        stream.write(payload)
+    server, client = socket.socketpair()
+    with server, client:
+        server.setblocking(False)
+        client.setblocking(False)
+
+        async def receive(size):
+            data = b''
+            while len(data) < size:
+                data += await event_loop.sock_recv(client, size - len(data))
+            return data
+
+        with open('data.bin', 'rb') as stream:
+            received = event_loop.create_task(receive(len(payload)))
+            await sendfile(server, stream, len(payload), event_loop)
+            assert (await received) == payload
+
+        # Files may be truncated in the mean time.
+        with open('data.bin', 'wb') as stream:
+            stream.write(b'Hello!')
+        with open('data.bin', 'rb') as stream:
+            with pytest.raises(EOFError):
+                await sendfile(server, stream, 7, event_loop)
+        assert (await receive(6)) == b'Hello!'
+
+
+def test_archive_writer_without_socket():
+    """Files are copied when the transport doesn't expose its socket."""
+
+    request = mock.MagicMock()
+    request.transport.get_extra_info.return_value = None
+    writer = ArchiveWriter(request, mock.MagicMock(), compress=False)
+    assert writer._socket is None
+    writer.close()
+    assert not request.transport.set_write_buffer_limits.called
+
+
+def test_read_chunk(tempdir):
+    with open('data.bin', 'wb') as stream:
+        stream.write(b'Hello!')
+    with open('data.bin', 'rb') as stream:
+        assert read_chunk(stream, 4) == (4, b'Hell')
+        assert read_chunk(stream, 4) == (2, b'o!')
+        with pytest.raises(EOFError):
+            read_chunk(stream, 4)
+
+
+@pytest.mark.asyncio
+async def test_admission_control(event_loop):
+    """Uploads over the limits wait for their turn, in order."""
+
+    admission = AdmissionControl(2, 100, 5.0, loop=event_loop)
+    assert admission.limited
+    await admission.acquire(60)
+    await admission.acquire(30)
+    waiters = [
+        event_loop.create_task(admission.acquire(size)) for size in (50, 10)
+    ]
+    await asyncio.sleep(0.01)
+    assert admission.queued == 2
+    assert not any(waiter.done() for waiter in waiters)
+
+    # The first waiter doesn't fit yet and the second one waits behind it.
+    admission.release(30)
+    await asyncio.sleep(0.01)
+    assert admission.queued == 2
+    admission.release(60)
+    await waiters[0]
+    await waiters[1]
+    assert admission.queued == 0
+    assert (admission.uploads, admission.bytes) == (2, 60)
+    admission.release(50)
+    admission.release(10)
+
+    # Uploads larger than the limit are admitted one at a time.
+    await admission.acquire(1000)
+    assert (admission.uploads, admission.bytes) == (1, 1000)
+    admission.release(1000)
+    assert (admission.uploads, admission.bytes) == (0, 0)
+    assert admission.rejected == 0
+
+
+@pytest.mark.asyncio
+async def test_admission_control_reject(event_loop):
+    """Uploads are rejected once they waited for too long."""
+
+    admission = AdmissionControl(1, 0, 0.0, loop=event_loop)
+    await admission.acquire(10)
+    with pytest.raises(aiohttp.web.HTTPServiceUnavailable) as error:
+        await admission.acquire(10)
+    assert error.value.headers['Retry-After'] == '1'
+
+    admission = AdmissionControl(1, 0, 0.05, loop=event_loop)
+    await admission.acquire(10)
+    with pytest.raises(aiohttp.web.HTTPServiceUnavailable) as error:
+        await admission.acquire(10)
+    assert error.value.headers['Retry-After'] == '1'
+    assert admission.queued == 0
+    assert admission.rejected == 1
+
+
+@pytest.mark.asyncio
+async def test_admission_control_cancel(event_loop):
+    """Cancelled uploads give their place back."""
+
+    admission = AdmissionControl(1, 0, 5.0, loop=event_loop)
+    await admission.acquire(10)
+
+    # Cancelled while waiting.
+    waiter = event_loop.create_task(admission.acquire(10))
+    await asyncio.sleep(0.01)
+    waiter.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await waiter
+    assert admission.queued == 0
+
+    # Cancelled after its turn came.
+    waiter = event_loop.create_task(admission.acquire(10))
+    await asyncio.sleep(0.01)
+    admission.release(10)
+    waiter.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await waiter
+    assert admission.queued == 0
+    assert (admission.uploads, admission.bytes) == (0, 0)
+
+    assert not AdmissionControl(0, 0, 0.0, loop=event_loop).limited
+
+
+@pytest.mark.asyncio
+async def test_admission_control_wake(event_loop):
+    """Waiters that give up let the ones behind them in."""
+
+    admission = AdmissionControl(0, 100, 0.2, loop=event_loop)
+    await admission.acquire(80)
+
+    # Cancelled while waiting.
+    first = event_loop.create_task(admission.acquire(50))
+    await asyncio.sleep(0.01)
+    second = event_loop.create_task(admission.acquire(10))
+    await asyncio.sleep(0.01)
+    first.cancel()
+    await asyncio.wait_for(second, 0.05, loop=event_loop)
+    assert (admission.uploads, admission.bytes) == (2, 90)
+    admission.release(10)
+
+    # Timed out while waiting.
+    first = event_loop.create_task(admission.acquire(50))
+    await asyncio.sleep(0.1)
+    second = event_loop.create_task(admission.acquire(10))
+    with pytest.raises(aiohttp.web.HTTPServiceUnavailable):
+        await first
+    await asyncio.wait_for(second, 0.05, loop=event_loop)
+    assert admission.queued == 0
+    assert (admission.uploads, admission.bytes) == (2, 90)
+
+
+@pytest.mark.asyncio
+async def test_path_locks(event_loop):
+    """Writes to the same path are serialized."""
+
+    locks = PathLocks(loop=event_loop)
+    await locks.acquire('a.txt')
+    await locks.acquire('b.txt')
+    waiter = event_loop.create_task(locks.acquire('a.txt'))
+    await asyncio.sleep(0.01)
+    assert not waiter.done()
+    locks.release('a.txt')
+    await waiter
+    locks.release('a.txt')
+    locks.release('b.txt')
+    assert len(locks) == 0
+
+    # Cancelled while waiting.
+    async with locks.hold('a.txt'):
+        waiter = event_loop.create_task(locks.acquire('a.txt'))
+        await asyncio.sleep(0.01)
+        waiter.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await waiter
+        assert len(locks) == 1
+    assert len(locks) == 0
+
+
+async def put(client, url, data, **kwds):
+    async with client.put(url, data=data, **kwds) as response:
+        await response.read()
+        return response
+
+
+def slow_body(event_loop, data):
+    """Request body that is only complete after ``feed_eof()``."""
+    body = asyncio.StreamReader(loop=event_loop)
+    body.feed_data(data)
+    return body
+
+
+@pytest.mark.asyncio
+async def test_upload_admission(event_loop, unused_tcp_port, tempdir,
+                                capsys):
+    """Uploads over the limits are rejected with a 503."""
+
+    host = '127.0.0.1'
+    task = await start_server(event_loop, host, unused_tcp_port,
+                              '--max-uploads=1')
+    try:
+        async with aiohttp.ClientSession(loop=event_loop) as client:
+            url = 'http://%s:%d/' % (host, unused_tcp_port)
+            body = slow_body(event_loop, b'Hello, ')
+            first = event_loop.create_task(put(
+                client, url + 'a.txt', body, headers={'Content-Length': '13'},
+            ))
+            await asyncio.sleep(0.1)
+
+            rep = await put(client, url + 'b.txt', b'Hello!')
+            assert rep.status == 503
+            assert rep.headers['Retry-After'] == '1'
+            archive = make_archive([('c.txt', b'Hello!')])
+            async with client.post(url, data=archive) as rep:
+                assert rep.status == 503
+
+            body.feed_data(b'world!')
+            body.feed_eof()
+            assert (await first).status == 201
+            rep = await put(client, url + 'b.txt', b'Hello!')
+            assert rep.status == 201
+    finally:
+        await stop_server(task)
+
+    events = read_access_log(capsys)
+    assert [event['outcome'] for event in events] == [503, 503, 201, 201]
+    assert [event['upload_rejects'] for event in events] == [1, 2, 2, 2]
+    assert [event['upload_queue'] for event in events] == [0, 0, 0, 0]
+
+
+@pytest.mark.asyncio
+async def test_upload_queue(event_loop, unused_tcp_port, tempdir):
+    """Uploads over the limits and to the same path wait for their turn."""
+
+    host = '127.0.0.1'
+    task = await start_server(event_loop, host, unused_tcp_port,
+                              '--max-uploads=1', '--upload-queue-timeout=5')
+    try:
+        async with aiohttp.ClientSession(loop=event_loop) as client:
+            url = 'http://%s:%d/' % (host, unused_tcp_port)
+            for path in ('a.txt', 'b.txt'):
+                body = slow_body(event_loop, b'Hello, ')
+                first = event_loop.create_task(put(
+                    client, url + 'a.txt', body,
+                    headers={'Content-Length': '13'},
+                ))
+                await asyncio.sleep(0.1)
+                second = event_loop.create_task(put(
+                    client, url + path, b'Hello!',
+                ))
+                await asyncio.sleep(0.1)
+                assert not second.done()
+                body.feed_data(b'world!')
+                body.feed_eof()
+                assert (await first).status == 201
+                assert (await second).status == 201
+                with open(path, 'rb') as stream:
+                    assert stream.read() == b'Hello!'
+    finally:
+        await stop_server(task)
+
+
+@pytest.mark.asyncio
+async def test_durability(event_loop, tempdir):
+    """Files and directories are flushed according to the mode."""
+
+    os.mkdir('dir')
+    with open('dir/a.txt', 'wb') as stream:
+        stream.write(b'Hello!')
+    with IOExecutor(2, loop=event_loop) as executor:
+        with pytest.raises(ValueError):
+            Durability('always', executor)
+
+        durability = Durability('none', executor, loop=event_loop)
+        with mock.patch('os.fsync') as fsync, mock.patch('os.sync') as sync:
+            await durability.sync_files(['dir/a.txt'])
+            await durability.sync_dirs(['dir/a.txt'])
+        fsync.assert_not_called()
+        sync.assert_not_called()
+
+        # Each file is flushed, and each directory only once.
+        durability = Durability('fsync', executor, loop=event_loop)
+        assert durability.mode == 'fsync'
+        with mock.patch('os.fsync') as fsync:
+            await durability.sync_files(['dir/a.txt'])
+            assert fsync.call_count == 1
+            await durability.sync_dirs(['dir/a.txt', 'dir/b.txt', 'c.txt'])
+            assert fsync.call_count == 3
+        fsync_paths(['dir/a.txt', 'dir'])
+        with pytest.raises(FileNotFoundError):
+            fsync_paths(['dir/b.txt'])
+
+
+def test_make_parents(tempdir):
+    """Missing parent directories are created and reported top-down."""
+
+    assert make_parents('a.txt') == []
+    assert make_parents('a/b/c.txt') == ['a', 'a/b']
+    assert make_parents('a/b/d.txt') == []
+    assert make_parents('a/e/f.txt') == ['a/e']
+    with open('g', 'wb'):
+        pass
+    with pytest.raises(FileExistsError):
+        make_parents('g/h/i.txt')
+
+    # Directories created concurrently are not reported.
+    mkdir = os.mkdir
+
+    def racing_mkdir(path):
+        mkdir(path)
+        raise FileExistsError(errno.EEXIST, os.strerror(errno.EEXIST), path)
+
+    with mock.patch('os.mkdir', side_effect=racing_mkdir):
+        assert make_parents('j/k.txt') == []
+    assert os.path.isdir('j')
+
+
+def new_dirs(path):
+    """Directories that will be flushed when ``path`` is created."""
+    dirs = {os.path.dirname(path)}
+    parent = os.path.dirname(path)
+    while not os.path.isdir(parent):
+        parent = os.path.dirname(parent)
+        dirs.add(parent)
+    return dirs
+
+
+@pytest.mark.asyncio
+async def test_durability_new_dirs(event_loop, unused_tcp_port, tempdir):
+    """Directories created for uploads are flushed, top-down."""
+
+    archive = make_archive([
+        ('dir', None),
+        ('dir/sub', None),
+        ('dir/sub/a.txt', b'Hello!'),
+        ('b.txt', b'World!'),
+    ])
+    layout = ShardedLayout(os.path.abspath('.'))
+    host = '127.0.0.1'
+    calls = []
+    with mock.patch('smartmob_filestore.fsync_paths',
+                    side_effect=calls.append):
+        task = await start_server(event_loop, host, unused_tcp_port,
+                                  '--layout=sharded', '--durability=fsync')
+        try:
+            async with aiohttp.ClientSession(loop=event_loop) as client:
+                url = 'http://%s:%d/' % (host, unused_tcp_port)
+                expected = new_dirs(layout.locate('x/dir/sub/a.txt')) | \
+                    new_dirs(layout.locate('x/b.txt'))
+                assert os.path.abspath('.') in expected
+                async with client.post(url + 'x', data=archive) as rep:
+                    assert rep.status == 201
+                assert calls[-1] == sorted(expected)
+
+                expected = new_dirs(layout.locate('y/c.txt'))
+                rep = await put(client, url + 'y/c.txt', b'Hi!')
+                assert rep.status == 201
+                assert calls[-1] == sorted(expected)
+        finally:
+            await stop_server(task)
+
+
+@pytest.mark.asyncio
+async def test_durability_group(event_loop, tempdir):
+    """Concurrent uploads share the same flush."""
+
+    with IOExecutor(2, loop=event_loop) as executor:
+        durability = Durability('group', executor, 0.05, loop=event_loop)
+        with mock.patch('os.sync') as sync:
+            first = event_loop.create_task(durability.sync_files(['a.txt']))
+            await asyncio.sleep(0.01)
+            others = [
+                event_loop.create_task(durability.sync_files(['b.txt'])),
+                event_loop.create_task(durability.sync_dirs(['c.txt'])),
+            ]
+            await asyncio.gather(first, *others, loop=event_loop)
+            assert sync.call_count == 1
+            assert durability.flushes == 1
+
+            # The next uploads start a new batch.
+            await durability.sync_dirs(['a.txt'])
+            assert sync.call_count == 2
+
+            # Errors are reported to every upload in the batch.
+            sync.side_effect = OSError('I/O error')
+            waiters = [
+                event_loop.create_task(durability.sync_files([path]))
+                for path in ('a.txt', 'b.txt')
+            ]
+            for waiter in waiters:
+                with pytest.raises(OSError):
+                    await waiter
+            assert sync.call_count == 3
+
+            # Cancelled uploads don't cancel the flush for others.
+            waiters = [
+                event_loop.create_task(durability.sync_files([path]))
+                for path in ('a.txt', 'b.txt')
+            ]
+            sync.side_effect = None
+            await asyncio.sleep(0.01)
+            waiters[0].cancel()
+            await waiters[1]
+            assert sync.call_count == 4
+
+
+@pytest.mark.parametrize('mode', ['none', 'fsync', 'group'])
+@pytest.mark.asyncio
+async def test_upload_durability(event_loop, unused_tcp_port, tempdir, mode):
+    """Uploads of all kinds complete in all durability modes."""
+
+    host = '127.0.0.1'
+    task = await start_server(event_loop, host, unused_tcp_port,
+                              '--durability=%s' % mode,
+                              '--group-commit-window=0.01')
+    try:
+        async with aiohttp.ClientSession(loop=event_loop) as client:
+            url = 'http://%s:%d/' % (host, unused_tcp_port)
+            responses = await asyncio.gather(*[
+                put(client, url + path, b'Hello!')
+                for path in ('a.txt', 'b.txt', 'c.txt')
+            ], loop=event_loop)
+            assert [response.status for response in responses] == [201] * 3
+
+            response = await put(client, url + 'd.txt', b'Hello', headers={
+                'Content-Range': 'bytes 0-4/6',
+            })
+            assert response.status == 202
+            response = await put(client, url + 'd.txt', b'!', headers={
+                'Content-Range': 'bytes 5-5/6',
+            })
+            assert response.status == 201
+
+            archive = make_archive([('e.txt', b'Hello!')])
+            async with client.post(url + 'dir', data=archive) as response:
+                assert response.status == 201
+    finally:
+        await stop_server(task)
+
+    for path in ('a.txt', 'b.txt', 'c.txt', 'd.txt', 'dir/e.txt'):
+        with open(path, 'rb') as stream:
+            assert stream.read() == b'Hello!'
+
+
+def test_sharded_layout(tempdir):
+    """Names are mapped onto fan-out directories, and back."""
+
+    layout = ShardedLayout('.')
+    path = layout.resolve('dir/../a/b.txt')
+    assert os.path.relpath(path, os.path.abspath('.')).split(os.sep)[:3] == [
+        '.objects',
+        hashlib.sha256(b'a/b.txt').hexdigest()[:2],
+        hashlib.sha256(b'a/b.txt').hexdigest()[2:4],
+    ]
+    assert os.path.basename(path) == 'a%2Fb.txt'
+    assert layout.key(path) == 'a/b.txt'
+    assert layout.locate('a/b.txt') == path
+    assert layout.resolve('') is None
+    assert layout.resolve('.staging/a') is None
+    assert layout.resolve('a' * 255) is not None
+    assert layout.resolve('a/' + 'a' * 252) is None
+    assert layout.isdir('')
+    assert not layout.isdir('a')
+
+
+@pytest.mark.asyncio
+async def test_sharded_storage(event_loop, unused_tcp_port, tempdir):
+    """The sharded layout keeps the URL space unchanged."""
+
+    host = '127.0.0.1'
+    url = 'http://%s:%d/' % (host, unused_tcp_port)
+    layout = ShardedLayout('.')
+    task = await start_server(event_loop, host, unused_tcp_port,
+                              '--layout=sharded', '--dedup')
+    try:
+        async with aiohttp.ClientSession(loop=event_loop) as client:
+            # Files can be stored in any directory.
+            for path in ('a.txt', 'dir/b.txt', 'dir/sub/c.txt'):
+                response = await put(client, url + path, b'Hello!')
+                assert response.status == 201
+            response = await put(client, url + 'dir/d.txt', b'Hello', headers={
+                'Content-Range': 'bytes 0-4/6',
+            })
+            assert response.status == 202
+            response = await put(client, url + 'dir/d.txt', b'!', headers={
+                'Content-Range': 'bytes 5-5/6',
+            })
+            assert response.status == 201
+            archive = make_archive([('e.txt', b'Hello!'), ('a.txt', None)])
+            async with client.post(url + 'dir', data=archive) as response:
+                assert response.status == 201
+                assert [file['path'] for file in
+                        (await response.json())['files']] == ['dir/e.txt']
+            names = ['a.txt', 'dir/b.txt', 'dir/d.txt', 'dir/e.txt',
+                     'dir/sub/c.txt']
+            for name in names:
+                with open(layout.locate(name), 'rb') as stream:
+                    assert stream.read() == b'Hello!'
+                async with client.get(url + name) as response:
+                    assert response.status == 200
+                    assert response.content_type == 'text/plain'
+                    assert (await response.read()) == b'Hello!'
+            assert not os.path.exists('dir')
+
+            async with client.get(url + '?list') as response:
+                assert [file['path'] for file in
+                        (await response.json())['files']] == names
+            with mock.patch('smartmob_filestore.LIST_MAX_LIMIT', 2):
+                async with client.get(url + 'dir?archive') as response:
+                    assert response.status == 200
+                    assert read_archive(await response.read()) == {
+                        name[4:]: b'Hello!' for name in names[1:]
+                    }
+            async with client.get(url + '?archive') as response:
+                assert response.status == 200
+            for path, status in [
+                ('dir', 404),
+                ('dir/b.txt/x', 404),
+                ('missing?archive', 404),
+                ('a.txt?archive', 404),
+                ('a/' + 'a' * 300, 404),
+            ]:
+                async with client.get(url + path) as response:
+                    assert response.status == status
+            response = await put(client, url + 'a/' + 'a' * 300, b'Hello!')
+            assert response.status == 404
+            async with client.post(url + '.staging', data=archive) as rep:
+                assert rep.status == 404
+    finally:
+        await stop_server(task)
+
+    # The index can be rebuilt from the storage root.
+    os.unlink(os.path.join('.index', 'digests.sqlite3'))
+    task = await start_server(event_loop, host, unused_tcp_port,
+                              '--layout=sharded')
+    try:
+        async with aiohttp.ClientSession(loop=event_loop) as client:
+            async with client.get(url + '?list') as response:
+                assert [file['path'] for file in
+                        (await response.json())['files']] == names
+    finally:
+        await stop_server(task)
+
+    # The server won't mix layouts.
+    with pytest.raises(ValueError):
+        await main(['--port=%d' % unused_tcp_port], loop=event_loop)
+
+
+@pytest.mark.asyncio
+async def test_memory_backend_list(event_loop):
+    """Listings are sorted by name and paginated."""
+
+    backend = MemoryBackend(clock=lambda: 1.5)
+    for name in ('b', 'a/2', 'a/1', 'a0', 'c'):
+        writer = await backend.create(name)
+        await writer.write(name.encode('utf-8'))
+        await writer.commit(None)
+    assert await backend.list('', '', 10) == [
+        (name, len(name), 1500000000)
+        for name in ('a/1', 'a/2', 'a0', 'b', 'c')
+    ]
+    assert [row[0] for row in await backend.list('a/', '', 10)] == \
+        ['a/1', 'a/2']
+    assert [row[0] for row in await backend.list('a', 'a/1', 2)] == \
+        ['a/2', 'a0']
+    assert await backend.list('d', '', 10) == []
+
+    # Replacing a file.
+    writer = await backend.create('b')
+    await writer.write(b'bb')
+    await writer.commit(None)
+    assert await backend.list('b', '', 10) == [('b', 2, 1500000000)]
+
+    # Aborted uploads leave no trace.
+    writer = await backend.create('d')
+    await writer.write(b'd')
+    await writer.abort()
+    assert [row[0] for row in await backend.list('', 'b', 10)] == ['c']
+
+
+@pytest.mark.parametrize('option', [
+    '--dedup',
+    '--compress',
+    '--layout=sharded',
+    '--durability=fsync',
+    '--workers=2',
+])
+@pytest.mark.asyncio
+async def test_memory_backend_options(event_loop, tempdir, option):
+    """Options that need files on disk are rejected."""
+
+    with pytest.raises(ValueError) as error:
+        await main(['--backend=memory', option], loop=event_loop)
+    assert str(error.value) == '--%s requires the local backend.' % (
+        option[2:].partition('=')[0],
+    )
+
+
+@pytest.mark.asyncio
+async def test_memory_backend(event_loop, unused_tcp_port, tempdir):
+    """Files can be stored in memory, without touching the disk."""
+
+    host = '127.0.0.1'
+    task = await start_server(event_loop, host, unused_tcp_port,
+                              '--backend=memory', '--cache-bytes=1024',
+                              '--cache-max-object=5')
+    try:
+        async with aiohttp.ClientSession(loop=event_loop) as client:
+            url = 'http://%s:%d/' % (host, unused_tcp_port)
+            etag = '"%s"' % hashlib.sha256(b'Hello!').hexdigest()
+            for path in ('a.txt', 'dir/b.txt', 'dir/c.bin'):
+                response = await put(client, url + path, b'Hello!')
+                assert response.status == 201
+                assert response.headers['ETag'] == etag
+            response = await put(client, url + 'd.txt', b'Hi!', headers={
+                'Digest': 'SHA-256=%s' % base64.b64encode(
+                    hashlib.sha256(b'Hello!').digest(),
+                ).decode('ascii'),
+            })
+            assert response.status == 400
+            response = await put(client, url + 'a.txt', b'Hi!', headers={
+                'If-None-Match': '*',
+            })
+            assert response.status == 412
+            response = await put(client, url + 'e.txt', b'Hi!', headers={
+                'If-None-Match': '*',
+            })
+            assert response.status == 201
+
+            async with client.get(url + 'dir/c.bin') as response:
+                assert response.status == 200
+                assert response.headers['ETag'] == etag
+                assert response.content_type == 'application/octet-stream'
+                assert (await response.read()) == b'Hello!'
+            async with client.get(url + 'a.txt', headers={
+                'Range': 'bytes=1-3',
+            }) as response:
+                assert response.status == 206
+                assert (await response.read()) == b'ell'
+            async with client.get(url + 'a.txt', headers={
+                'If-None-Match': etag,
+            }) as response:
+                assert response.status == 304
+            for _ in range(2):
+                async with client.get(url + 'e.txt') as response:
+                    assert response.status == 200
+                    assert (await response.read()) == b'Hi!'
+            for path, status in [
+                ('dir', 403),
+                ('d.txt', 404),
+                ('di', 404),
+                ('dir/b.txt?archive', 501),
+            ]:
+                async with client.get(url + path) as response:
+                    assert response.status == status
+
+            async with client.get(url + '?list&limit=2') as response:
+                body = await response.json()
+                assert [f['path'] for f in body['files']] == \
+                    ['a.txt', 'dir/b.txt']
+            async with client.get(url + '?list&cursor=%s' % (
+                body['cursor'],
+            )) as response:
+                body = await response.json()
+                assert [f['path'] for f in body['files']] == \
+                    ['dir/c.bin', 'e.txt']
+
+            # Features that need files on disk.
+            response = await put(client, url + 'f.txt', b'Hi!', headers={
+                'Content-Range': 'bytes 0-2/3',
+            })
+            assert response.status == 501
+            archive = make_archive([('f.txt', b'Hi!')])
+            async with client.post(url + 'dir', data=archive) as response:
+                assert response.status == 501
+
+            # Removal.
+            async with client.delete(url + 'e.txt', headers={
+                'If-Match': etag,
+            }) as response:
+                assert response.status == 412
+            async with client.delete(url + 'e.txt') as response:
+                assert response.status == 204
+            for path, status in [('e.txt', 404), ('dir', 403)]:
+                async with client.delete(url + path) as response:
+                    assert response.status == status
+            async with client.get(url + 'e.txt') as response:
+                assert response.status == 404
+    finally:
+        await stop_server(task)
+
+    assert sorted(os.listdir('.')) == []
+
+
+@pytest.mark.parametrize('options', [[], ['--dedup', '--cache-bytes=1024']])
+@pytest.mark.asyncio
+async def test_delete(event_loop, unused_tcp_port, tempdir, options):
+    """Files can be removed."""
+
+    os.mkdir('dir')
+    host = '127.0.0.1'
+    task = await start_server(event_loop, host, unused_tcp_port, *options)
+    try:
+        async with aiohttp.ClientSession(loop=event_loop) as client:
+            url = 'http://%s:%d/' % (host, unused_tcp_port)
+            for path in ('a.txt', 'dir/b.txt'):
+                response = await put(client, url + path, b'Hello!')
+                assert response.status == 201
+            async with client.get(url + 'a.txt') as response:
+                assert response.status == 200
+
+            async with client.delete(url + 'a.txt', headers={
+                'If-None-Match': '*',
+            }) as response:
+                assert response.status == 412
+            async with client.delete(url + 'a.txt') as response:
+                assert response.status == 204
+            for path, status in [
+                ('a.txt', 404),
+                ('a.txt/x', 404),
+                ('dir', 403),
+                ('.staging/x', 404),
+            ]:
+                async with client.delete(url + path) as response:
+                    assert response.status == status
+            async with client.get(url + 'a.txt') as response:
+                assert response.status == 404
+            async with client.get(url + '?list') as response:
+                assert [f['path'] for f in (await response.json())['files']] \
+                    == ['dir/b.txt']
+    finally:
+        await stop_server(task)
+
+    assert not os.path.exists('a.txt')
+
+
+def sha256(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def read_packs(store):
+    return {
+        name: store.read(name).data for name, _, _ in store.list('', '', 100)
+    }
+
+
+def last_segment(path):
+    return os.path.join(path, sorted(
+        name for name in os.listdir(path) if name.startswith('segment-')
+    )[-1])
+
+
+def test_pack_store(tempdir):
+    """Small files are appended to segments and indexed in memory."""
+
+    store = PackStore('packs', segment_size=256)
+    try:
+        files = {}
+        for i in range(10):
+            name, data = 'dir/%d.txt' % i, b'file %d' % i * 4
+            path, _ = store.put(name, data, sha256(data))
+            assert path.startswith(os.path.join('packs', 'segment-'))
+            files[name] = data
+        store.delete('dir/0.txt')
+        del files['dir/0.txt']
+        with pytest.raises(FileNotFoundError):
+            store.delete('dir/0.txt')
+        store.put('dir/1.txt', b'new', sha256(b'new'))
+        files['dir/1.txt'] = b'new'
+
+        assert store.get('dir/0.txt') is None
+        assert store.read('dir/0.txt') is None
+        entry = store.read('dir/3.txt')
+        assert entry.data == files['dir/3.txt']
+        assert entry.digest == sha256(files['dir/3.txt'])
+        assert entry.info.size == len(files['dir/3.txt'])
+        assert [row[0] for row in store.list('dir/', 'dir/1.txt', 2)] == [
+            'dir/2.txt', 'dir/3.txt',
+        ]
+        assert [row[:2] for row in store.list('dir/2', '', 10)] == [
+            ('dir/2.txt', 24),
+        ]
+        assert read_packs(store) == files
+    finally:
+        store.close()
+    assert len(os.listdir('packs')) > 2
+
+    # The index is saved, records appended since are replayed.
+    store = PackStore('packs', segment_size=256)
+    try:
+        assert read_packs(store) == files
+        os.link('packs/index', 'index')
+        store.put('dir/a.txt', b'A', sha256(b'A'))
+        store.delete('dir/2.txt')
+    finally:
+        store.close()
+    files['dir/a.txt'] = b'A'
+    del files['dir/2.txt']
+    os.replace('index', 'packs/index')
+    store = PackStore('packs', segment_size=256)
+    try:
+        assert read_packs(store) == files
+    finally:
+        store.close()
+
+    # Torn and corrupt records are truncated.
+    record = bytearray(pack_record(
+        PACK_PUT, 'dir/z.txt', b'zzz', 0.0, 1000, sha256(b'zzz'),
+    ))
+    record[-1] ^= 1
+    for tail in (record[:-1], b'x' * 100, record, b'x'):
+        path = last_segment('packs')
+        size = os.path.getsize(path)
+        with open(path, 'ab') as stream:
+            stream.write(tail)
+        os.unlink('packs/index')
+        store = PackStore('packs', segment_size=256)
+        try:
+            assert read_packs(store) == files
+        finally:
+            store.close()
+        assert os.path.getsize(path) == size
+
+    # Copies of old records don't win over newer ones.
+    with open(last_segment('packs'), 'rb') as stream:
+        data = stream.read()
+    for segment in sorted(os.listdir('packs')):
+        if segment.startswith('segment-'):
+            with open(os.path.join('packs', segment), 'rb') as stream:
+                data = stream.read() + data
+    with open('packs/segment-00000099.pack', 'wb') as stream:
+        stream.write(data)
+    os.unlink('packs/index')
+    store = PackStore('packs', segment_size=256)
+    try:
+        assert read_packs(store) == files
+
+        # Compaction reclaims space.
+        for _ in range(10):
+            store.put('dir/5.txt', b'five', sha256(b'five'))
+        files['dir/5.txt'] = b'five'
+        assert store.wasteful()
+        before = sum(
+            os.path.getsize(os.path.join('packs', name))
+            for name in os.listdir('packs') if name.startswith('segment-')
+        )
+        store.save()
+        os.link('packs/index', 'index')
+        assert store.compact() > before / 2
+        assert not store.wasteful()
+        assert read_packs(store) == files
+        segments = sorted(os.listdir('packs'))
+
+        # Compaction gives up on errors.
+        with mock.patch('smartmob_filestore.write_all') as write_all:
+            write_all.side_effect = OSError('boom')
+            with pytest.raises(OSError):
+                store.compact()
+        with mock.patch('os.pread') as pread:
+            pread.side_effect = OSError('boom')
+            with pytest.raises(OSError):
+                store.compact()
+        assert read_packs(store) == files
+
+        # Files may change while they are copied.
+        copy = store._copy
+
+        def racing_copy(files):
+            store.put('dir/4.txt', b'before', sha256(b'before'))
+            result = copy(files)
+            store.put('dir/6.txt', b'after', sha256(b'after'))
+            return result
+
+        with mock.patch.object(store, '_copy', racing_copy):
+            store.compact()
+        files['dir/4.txt'] = b'before'
+        files['dir/6.txt'] = b'after'
+        assert read_packs(store) == files
+
+        # Segments that are being read outlive compaction.
+        pread = os.pread
+
+        def racing_pread(*args):
+            if not racing_pread.compacted:
+                racing_pread.compacted = True
+                assert store.read('dir/3.txt').data == files['dir/3.txt']
+                for _ in range(10):
+                    store.put('dir/5.txt', b'five', sha256(b'five'))
+                store.compact()
+            return pread(*args)
+
+        racing_pread.compacted = False
+        with mock.patch('os.pread', racing_pread):
+            assert store.read('dir/3.txt').data == files['dir/3.txt']
+        assert store._pins == {}
+        assert store._retired == set()
+        assert read_packs(store) == files
+    finally:
+        store.close()
+
+    # The index saved before compaction is stale.
+    assert segments != sorted(os.listdir('packs'))
+    os.replace('index', 'packs/index')
+    store = PackStore('packs', segment_size=256)
+    try:
+        assert read_packs(store) == files
+        for name in files:
+            store.delete(name)
+        store.compact()
+    finally:
+        store.close()
+    assert os.listdir('packs') == ['index']
+    store = PackStore('packs', segment_size=256)
+    try:
+        assert read_packs(store) == {}
+    finally:
+        store.close()
+
+    # Storage roots without pack files don't need the pack backend.
+    os.rename('packs', '.packs')
+    check_packs('.')
+
+
+@pytest.mark.parametrize('options', [
+    [],
+    ['--cache-bytes=1024', '--durability=fsync', '--dedup'],
+])
+@pytest.mark.asyncio
+async def test_pack_backend(event_loop, unused_tcp_port, tempdir, options):
+    """Small files are stored in pack files, others as files."""
+
+    os.mkdir('dir')
+    small, large = b'Hello!', b'Hello, world!'
+    host = '127.0.0.1'
+    task = await start_server(event_loop, host, unused_tcp_port,
+                              '--backend=pack', '--pack-max-size=10',
+                              *options)
+    try:
+        async with aiohttp.ClientSession(loop=event_loop) as client:
+            url = 'http://%s:%d/' % (host, unused_tcp_port)
+            for path, data in [
+                ('a.txt', small),
+                ('dir/b.txt', large),
+                ('dir/c.txt', small),
+            ]:
+                response = await put(client, url + path, data)
+                assert response.status == 201
+                assert response.headers['ETag'] == '"%s"' % sha256(data)
+            assert not os.path.exists('a.txt')
+            assert os.path.exists('dir/b.txt')
+            assert not os.path.exists('dir/c.txt')
+
+            for path, data in [('a.txt', small), ('dir/b.txt', large)]:
+                async with client.get(url + path) as response:
+                    assert response.status == 200
+                    assert (await response.read()) == data
+            async with client.get(url + 'a.txt', headers={
+                'Range': 'bytes=1-3',
+            }) as response:
+                assert response.status == 206
+                assert (await response.read()) == b'ell'
+            async with client.get(url + 'a.txt', headers={
+                'If-None-Match': '"%s"' % sha256(small),
+            }) as response:
+                assert response.status == 304
+            async with client.get(url + '?list&limit=2') as response:
+                body = await response.json()
+                assert [(f['path'], f['size']) for f in body['files']] == [
+                    ('a.txt', 6), ('dir/b.txt', 13),
+                ]
+            async with client.get(url + '?list&cursor=%s' % (
+                body['cursor'],
+            )) as response:
+                body = await response.json()
+                assert [f['path'] for f in body['files']] == ['dir/c.txt']
+            async with client.get(url + 'dir?archive') as response:
+                assert response.status == 200
+                assert read_archive(await response.read()) == {
+                    'b.txt': large, 'c.txt': small,
+                }
+
+            # Uploads check the packed copy.
+            response = await put(client, url + 'dir', small)
+            assert response.status == 409
+            response = await put(client, url + 'a.txt', small, headers={
+                'If-None-Match': '*',
+            })
+            assert response.status == 412
+            response = await put(client, url + 'f.txt', small, headers={
+                'If-None-Match': '*',
+            })
+            assert response.status == 201
+            for data in (small, large):
+                response = await put(client, url + 'x.txt', data, headers={
+                    'Digest': 'SHA-256=%s' % base64.b64encode(
+                        hashlib.sha256(b'other').digest(),
+                    ).decode('ascii'),
+                })
+                assert response.status == 400
+
+            # Files move in and out of pack files.
+            response = await put(client, url + 'a.txt', large, headers={
+                'If-Match': '"%s"' % sha256(small),
+            })
+            assert response.status == 201
+            response = await put(client, url + 'dir/b.txt', small)
+            assert response.status == 201
+            response = await put(client, url + 'dir/c.txt', large, headers={
+                'Content-Range': 'bytes 0-12/13',
+            })
+            assert response.status == 201
+            for path, data in [
+                ('a.txt', large),
+                ('dir/b.txt', small),
+                ('dir/c.txt', large),
+            ]:
+                async with client.get(url + path) as response:
+                    assert (await response.read()) == data
+                assert os.path.exists(path) == (data == large)
+            response = await put(client, url + 'dir/d.txt', small)
+            assert response.status == 201
+            archive = make_archive([
+                ('b.txt', large), ('d.txt', large), ('g.txt', large),
+            ])
+            async with client.post(url + 'dir', data=archive) as response:
+                assert response.status == 201
+            for path in ('dir/b.txt', 'dir/d.txt', 'dir/g.txt'):
+                assert os.path.exists(path)
+
+            # Removal.
+            response = await put(client, url + 'e.txt', small)
+            assert response.status == 201
+            async with client.delete(url + 'e.txt', headers={
+                'If-Match': '"%s"' % sha256(large),
+            }) as response:
+                assert response.status == 412
+            for path in ('e.txt', 'a.txt', 'f.txt'):
+                async with client.delete(url + path) as response:
+                    assert response.status == 204
+                async with client.get(url + path) as response:
+                    assert response.status == 404
+            async with client.get(url + '?list') as response:
+                body = await response.json()
+                assert [f['path'] for f in body['files']] == [
+                    'dir/b.txt', 'dir/c.txt', 'dir/d.txt', 'dir/g.txt',
+                ]
+    finally:
+        await stop_server(task)
+
+    assert os.path.exists('.packs/index')
+
+
+@pytest.mark.asyncio
+async def test_pack_backend_reconcile(event_loop, unused_tcp_port, tempdir):
+    """Files stored both ways after a crash keep their latest copy."""
+
+    host = '127.0.0.1'
+    url = 'http://%s:%d/' % (host, unused_tcp_port)
+    task = await start_server(event_loop, host, unused_tcp_port,
+                              '--backend=pack')
+    try:
+        async with aiohttp.ClientSession(loop=event_loop) as client:
+            for path in ('a.txt', 'b.txt', 'c.txt'):
+                response = await put(client, url + path, b'Packed')
+                assert response.status == 201
+            response = await put(client, url + 'd.txt', b'-' * 20000)
+            assert response.status == 201
+    finally:
+        await stop_server(task)
+
+    for path, mtime in [('a.txt', None), ('b.txt', (1e9, 1e9))]:
+        with open(path, 'wb') as stream:
+            stream.write(b'File')
+        os.utime(path, mtime)
+    with mock.patch('smartmob_filestore.LIST_MAX_LIMIT', 1):
+        task = await start_server(event_loop, host, unused_tcp_port,
+                                  '--backend=pack')
+    try:
+        async with aiohttp.ClientSession(loop=event_loop) as client:
+            for path, data in [
+                ('a.txt', b'File'),
+                ('b.txt', b'Packed'),
+                ('c.txt', b'Packed'),
+            ]:
+                async with client.get(url + path) as response:
+                    assert (await response.read()) == data
+    finally:
+        await stop_server(task)
+    assert os.path.exists('a.txt')
+    assert not os.path.exists('b.txt')
+
+    # Pack files need the pack backend.
+    with pytest.raises(ValueError):
+        await main([
+            '--host=%s' % host, '--port=%d' % unused_tcp_port,
+        ], loop=event_loop)
+
+
+@pytest.mark.parametrize('option', ['--compress', '--workers=2'])
+@pytest.mark.asyncio
+async def test_pack_backend_options(event_loop, tempdir, option):
+    """Options that don't apply to pack files are rejected."""
+
+    with pytest.raises(ValueError) as error:
+        await main(['--backend=pack', option], loop=event_loop)
+    assert str(error.value).endswith('requires the local backend.')
+
+
+def read_events(capsys, name):
+    out, _ = capsys.readouterr()
+    events = [json.loads(line) for line in out.split('\n') if line]
+    return [event for event in events if event['event'] == name]
+
+
+@pytest.mark.asyncio
+async def test_pack_compaction(event_loop, unused_tcp_port, tempdir, capsys):
+    """Pack files are compacted in the background."""
+
+    release = threading.Event()
+
+    def compact(self):
+        release.wait()
+        raise OSError('boom')
+
+    host = '127.0.0.1'
+    url = 'http://%s:%d/' % (host, unused_tcp_port)
+    with mock.patch('smartmob_filestore.PackStore.compact', compact):
+        task = await start_server(event_loop, host, unused_tcp_port,
+                                  '--backend=pack',
+                                  '--pack-segment-size=1024')
+        try:
+            async with aiohttp.ClientSession(loop=event_loop) as client:
+                for i in range(20):
+                    response = await put(client, url + 'a.txt', b'%d' % i)
+                    assert response.status == 201
+        finally:
+            release.set()
+            await stop_server(task)
+    assert [event['error'] for event in read_events(
+        capsys, 'compact.failed',
+    )] == ['boom']
+
+    task = await start_server(event_loop, host, unused_tcp_port,
+                              '--backend=pack', '--pack-segment-size=1024')
+    try:
+        async with aiohttp.ClientSession(loop=event_loop) as client:
+            for i in range(20):
+                response = await put(client, url + 'b.txt', b'%d' % i)
+                assert response.status == 201
+            async with client.delete(url + 'a.txt') as response:
+                assert response.status == 204
+            async with client.get(url + 'b.txt') as response:
+                assert (await response.read()) == b'19'
+    finally:
+        await stop_server(task)
+    assert read_events(capsys, 'compact')
+    assert sum(
+        os.path.getsize(os.path.join('.packs', name))
+        for name in os.listdir('.packs') if name.startswith('segment-')
+    ) < 1024
+
+
+@pytest.mark.asyncio
+async def test_replicator(event_loop, unused_tcp_port, tempdir):
+    """Copies are retried until peers store or reject them."""
+
+    os.mkdir('.index')
+    backend = MemoryBackend()
+    backend.store('a.txt', b'A', sha256(b'A'), None)
+    backend.store('b.txt', b'B', sha256(b'B'), None)
+    received = []
+    responses = []
+
+    async def handle(request):
+        received.append((
+            request.method, request.path, await request.read(),
+            request.headers.get(REPLICA_HEADER),
+            request.headers.get(PEER_TOKEN_HEADER),
+            request.headers.get('Digest'),
+        ))
+        response = responses.pop(0)
+        if callable(response):
+            response = response()
+        return aiohttp.web.Response(status=response)
+
+    def change():
+        backend.store('b.txt', b'C', sha256(b'C'), None)
+        return 500
+
+    peer = aiohttp.web.Application(loop=event_loop)
+    peer.router.add_route('*', '/{path:.*}', handle)
+    url = 'http://127.0.0.1:%d' % unused_tcp_port
+    metrics = ServerMetrics()
+    event_log = mock.MagicMock()
+    with mock.patch('smartmob_filestore.REPLICATION_BACKOFF', (0.01, 0.02)), \
+            IOExecutor(1, loop=event_loop) as executor:
+        log = ReplicationLog('.')
+        # Jobs for peers that were removed from the configuration.
+        log.add(['http://127.0.0.1:1/'], [('a.txt', sha256(b'A'))])
+        replicator = Replicator(
+            [url], backend, log, executor, replicas=1, timeout=5.0,
+            token='secret', event_log=event_log, metrics=metrics,
+            loop=event_loop,
+        )
+        await replicator.start()
+        try:
+            assert log.jobs() == []
+
+            # Unreachable peers.
+            acks = await replicator.enqueue([('a.txt', sha256(b'A'))])
+            await asyncio.sleep(0.1, loop=event_loop)
+            assert replicator.pending(url + '/') == 1
+            lines = metrics.render().splitlines()
+            assert ('replication_queue_files{peer="%s/"} 1' % url) in lines
+            async with HTTPServer(peer, '127.0.0.1', unused_tcp_port,
+                                  loop=event_loop):
+                # Servers that are busy, then accept the file.
+                responses[:] = [503, 429, 201]
+                await replicator.wait(acks)
+                assert received == [('PUT', '/a.txt', b'A', '1', 'secret', (
+                    'SHA-256=%s' % base64.b64encode(
+                        hashlib.sha256(b'A').digest()
+                    ).decode('ascii')
+                ))] * 3
+
+                # Files that changed while they were copied.
+                del received[:]
+                responses[:] = [change]
+                await replicator.wait(await replicator.enqueue([
+                    ('b.txt', sha256(b'B')),
+                ]))
+                assert len(received) == 1
+
+                # Files that changed before they were copied.
+                await replicator.wait(await replicator.enqueue([
+                    ('b.txt', sha256(b'B')),
+                ]))
+                assert len(received) == 1
+
+                # Peers that reject the file.
+                responses[:] = [403]
+                with pytest.raises(aiohttp.web.HTTPBadGateway):
+                    await replicator.wait(await replicator.enqueue([
+                        ('b.txt', sha256(b'C')),
+                    ]))
+
+                # Removed files.
+                del received[:]
+                await backend.delete('a.txt', None)
+                responses[:] = [404]
+                await replicator.wait(await replicator.enqueue([
+                    ('a.txt', None),
+                ]))
+                assert received == [
+                    ('DELETE', '/a.txt', b'', '1', 'secret', None),
+                ]
+                assert log.jobs() == []
+        finally:
+            await replicator.close()
+
+    lines = metrics.render().splitlines()
+    for outcome, count in [('copied', 2), ('skipped', 2), ('failed', 1)]:
+        assert ('replication_copies_total{peer="%s/",outcome="%s"} %d' % (
+            url, outcome, count,
+        )) in lines
+    # Attempts that failed for lack of a connection (or a 5xx response).
+    assert any(line.startswith(
+        'replication_copies_total{peer="%s/",outcome="error"}' % url,
+    ) for line in lines)
+    assert ('replication_lag_seconds{peer="%s/"} 0.0' % url) in lines
+    event_log.error.assert_called_once_with(
+        'replication.failed', peer=url + '/', path='b.txt', status=403,
+    )
+
+
+async def start_peer(event_loop, port, storage, *args):
+    """Start a server that doesn't handle signals."""
+    done = asyncio.Future(loop=event_loop)
+    task = event_loop.create_task(run_server(cli.parse_args([
+        '--host=127.0.0.1', '--port=%d' % port, '--storage=%s' % storage,
+    ] + list(args)), structlog.get_logger(), done, event_loop))
+    while True:
+        try:
+            _, writer = await asyncio.open_connection(
+                '127.0.0.1', port, loop=event_loop,
+            )
+        except OSError:
+            await asyncio.sleep(0.1)
+        else:
+            writer.close()
+            return done, task
+
+
+async def stop_peer(peer):
+    done, task = peer
+    done.set_result(None)
+    await task
+
+
+@pytest.mark.asyncio
+async def test_replicator_errors(event_loop, unused_tcp_port, tempdir):
+    """Peers that hang and unexpected errors don't stop the copies."""
+
+    os.mkdir('.index')
+    backend = MemoryBackend()
+    backend.store('a.txt', b'A', sha256(b'A'), None)
+    hangs = [True]
+
+    async def handle(request):
+        await request.read()
+        if hangs and hangs.pop():
+            await asyncio.sleep(5.0, loop=event_loop)
+        return aiohttp.web.Response(status=201)
+
+    peer = aiohttp.web.Application(loop=event_loop)
+    peer.router.add_route('*', '/{path:.*}', handle)
+    url = 'http://127.0.0.1:%d' % unused_tcp_port
+    event_log = mock.MagicMock()
+    with mock.patch('smartmob_filestore.REPLICATION_BACKOFF', (0.01, 0.02)), \
+            mock.patch('smartmob_filestore.REPLICATION_REQUEST_TIMEOUT',
+                       0.1), \
+            IOExecutor(1, loop=event_loop) as executor:
+        log = ReplicationLog('.')
+        replicator = Replicator(
+            [url], backend, log, executor, replicas=1, timeout=5.0,
+            token='secret', event_log=event_log, loop=event_loop,
+        )
+        await replicator.start()
+        try:
+            async with HTTPServer(peer, '127.0.0.1', unused_tcp_port,
+                                  loop=event_loop):
+                # Peers that don't answer in time.
+                await replicator.wait(await replicator.enqueue([
+                    ('a.txt', sha256(b'A')),
+                ]))
+                event_log.warning.assert_any_call(
+                    'replication.retry', peer=url + '/', path='a.txt',
+                    error='timeout', delay=0.01,
+                )
+
+                # Unexpected errors.
+                with mock.patch.object(log, 'remove') as remove:
+                    remove.side_effect = [ValueError('Oops!'), None]
+                    await replicator.wait(await replicator.enqueue([
+                        ('a.txt', sha256(b'A')),
+                    ]))
+                assert remove.call_count == 2
+                event_log.error.assert_any_call(
+                    'replication.error', peer=url + '/', path='a.txt',
+                    error='Oops!', delay=0.01,
+                )
+        finally:
+            await replicator.close()
+
+
+async def wait_for(condition, event_loop):
+    ref = default_timer()
+    while not condition():
+        assert (default_timer() - ref) < 5.0
+        await asyncio.sleep(0.05, loop=event_loop)
+
+
+@pytest.mark.asyncio
+async def test_replication(event_loop, unused_tcp_port_factory, tempdir):
+    """Uploads and deletions are copied to peers."""
+
+    host = '127.0.0.1'
+    port, port1, port2 = (unused_tcp_port_factory() for _ in range(3))
+    peer1 = await start_peer(event_loop, port1, 'peer1')
+    args = [
+        '--storage=primary',
+        '--replicate-to=http://%s:%d' % (host, port1),
+        '--replicate-to=http://%s:%d/' % (host, port2),
+        '--replicas=1',
+        '--peer-token=secret',
+    ]
+    url = 'http://%s:%d/' % (host, port)
+    with mock.patch('smartmob_filestore.REPLICATION_BACKOFF', (0.05, 0.1)):
+        try:
+            task = await start_server(event_loop, host, port, *args)
+            try:
+                async with aiohttp.ClientSession(loop=event_loop) as client:
+                    await put(client, url + 'a.txt', b'A')
+                    # The first peer acknowledged the upload.
+                    with open('peer1/a.txt', 'rb') as stream:
+                        assert stream.read() == b'A'
+                    async with client.delete(url + 'a.txt') as rep:
+                        assert rep.status == 204
+                    assert not os.path.exists('peer1/a.txt')
+                    await put(client, url + 'b.txt', b'B' * 100000)
+                    async with client.post(url, data=make_archive([
+                        ('c.txt', b'C'),
+                    ])) as rep:
+                        assert rep.status == 201
+                    # Copies of copies aren't copied further.
+                    await put(client, url + 'd.txt', b'D', headers={
+                        REPLICA_HEADER: '1',
+                        PEER_TOKEN_HEADER: 'secret',
+                    })
+                    # Clients can't pass for peers.
+                    for token in ({}, {PEER_TOKEN_HEADER: 'guess'}):
+                        await put(client, url + 'e.txt', b'E', headers=dict(
+                            token, **{REPLICA_HEADER: '1'}
+                        ))
+            finally:
+                await stop_server(task)
+            assert not os.path.exists('peer2')
+            assert sorted(
+                name for name in os.listdir('peer1')
+                if name not in RESERVED_DIRS
+            ) == ['b.txt', 'c.txt', 'e.txt']
+
+            # Copies resume after a restart.
+            task = await start_server(event_loop, host, port, *args)
+            peer2 = await start_peer(event_loop, port2, 'peer2')
+            try:
+                await wait_for(lambda: os.path.exists('peer2/e.txt'),
+                               event_loop)
+            finally:
+                await stop_server(task)
+                await stop_peer(peer2)
+            with open('peer2/b.txt', 'rb') as stream:
+                assert stream.read() == b'B' * 100000
+            assert not os.path.exists('peer2/a.txt')
+            assert not os.path.exists('peer2/d.txt')
+        finally:
+            await stop_peer(peer1)
+
+
+@pytest.mark.asyncio
+async def test_replication_backpressure(event_loop, unused_tcp_port_factory,
+                                        tempdir):
+    """Uploads fail when peers fall too far behind."""
+
+    host = '127.0.0.1'
+    port, peer = unused_tcp_port_factory(), unused_tcp_port_factory()
+    task = await start_server(
+        event_loop, host, port,
+        '--replicate-to=http://%s:%d/' % (host, peer),
+        '--replicas=1',
+        '--replication-timeout=0.1',
+        '--replication-queue-size=1',
+        '--peer-token=secret',
+    )
+    try:
+        async with aiohttp.ClientSession(loop=event_loop) as client:
+            url = 'http://%s:%d/' % (host, port)
+            async with client.put(url + 'a.txt', data=b'A') as rep:
+                assert rep.status == 504
+            async with client.put(url + 'b.txt', data=b'B') as rep:
+                assert rep.status == 503
+                assert rep.headers['Retry-After']
+            async with client.delete(url + 'a.txt') as rep:
+                assert rep.status == 503
+            async with client.post(url, data=make_archive([
+                ('c.txt', b'C'),
+            ])) as rep:
+                assert rep.status == 503
+            # Copies from peers are still accepted.
+            rep = await put(client, url + 'b.txt', b'B', headers={
+                REPLICA_HEADER: '1',
+                PEER_TOKEN_HEADER: 'secret',
+            })
+            assert rep.status == 201
+            rep = await put(client, url + 'b.txt', b'B', headers={
+                REPLICA_HEADER: '1',
+            })
+            assert rep.status == 503
+    finally:
+        await stop_server(task)
+    assert os.path.exists('a.txt')
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize('args', [
+    ['--replicas=1'],
+    ['--replicate-to=http://127.0.0.1:1/', '--replicas=2'],
+    ['--replicate-to=http://127.0.0.1:1/'],
+    ['--replicate-to=http://127.0.0.1:1/', '--peer-token=secret',
+     '--workers=2'],
+    ['--replicate-to=http://127.0.0.1:1/', '--backend=memory'],
+])
+async def test_replication_options(args, event_loop):
+    with pytest.raises(ValueError):
+        await main(args, loop=event_loop)
+
+
+@pytest.mark.asyncio
+async def test_logging_rotation_workers(event_loop, tempdir):
+    """Log files can't be rotated by several processes."""
+
+    with pytest.raises(ValueError) as error:
+        await main(['--workers=2',
+                    '--logging-endpoint=file://./app.log?max-bytes=1024'],
+                   loop=event_loop)
+    assert str(error.value) == 'max-bytes requires a single process.'
+    with mock.patch.dict(os.environ, {
+        'SMARTMOB_LOGGING_ENDPOINT': 'file://./app.log?max-bytes=1024',
+    }):
+        with pytest.raises(ValueError):
+            await main(['--workers=2'], loop=event_loop)
+    assert not os.path.exists('app.log')
+
+
+def test_hash_ring():
+    """Members own similar shares and changes move few files."""
+
+    names = ['file-%d.txt' % i for i in range(3000)]
+    members = ['http://node%d/' % i for i in range(3)]
+    ring = HashRing(members, 64)
+    owners = {name: ring.owner(name) for name in names}
+    for member in members:
+        assert 700 < list(owners.values()).count(member) < 1300
+    # The order of members doesn't matter.
+    assert {
+        name: HashRing(reversed(members), 64).owner(name) for name in names
+    } == owners
+
+    # Adding a member only moves files to the new member.
+    bigger = HashRing(members + ['http://node3/'], 64)
+    moved = [name for name in names if bigger.owner(name) != owners[name]]
+    assert 500 < len(moved) < 1000
+    assert {bigger.owner(name) for name in moved} == {'http://node3/'}
+
+
+def owned_by(ring, member, count=1):
+    """Names of files that belong to a cluster member."""
+    names = ('file-%d.txt' % i for i in itertools.count())
+    return list(itertools.islice(
+        (name for name in names if ring.owner(name) == member), count,
+    ))
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize('routing', ['redirect', 'proxy'])
+async def test_cluster(routing, event_loop, unused_tcp_port_factory,
+                       tempdir):
+    """Requests are routed to the member that owns the file."""
+
+    host = '127.0.0.1'
+    ports = [unused_tcp_port_factory() for _ in range(3)]
+    urls = ['http://%s:%d/' % (host, port) for port in ports]
+    args = ['--cluster-member=%s' % url for url in urls] + [
+        '--cluster-routing=%s' % routing, '--cluster-vnodes=16',
+        '--peer-token=secret',
+    ]
+    ring = HashRing(urls, 16)
+    local, remote = owned_by(ring, urls[0])[0], owned_by(ring, urls[1])[0]
+    nodes = [
+        await start_peer(event_loop, ports[i], 'node%d' % i,
+                         '--cluster-self=%s' % urls[i], *args)
+        for i in range(2)
+    ]
+    try:
+        async with aiohttp.ClientSession(loop=event_loop) as client:
+            for name in (local, remote):
+                rep = await put(client, urls[0] + name, name.encode('utf-8'))
+                assert rep.status == 201
+                async with client.get(urls[0] + name) as rep:
+                    assert rep.status == 200
+                    assert (await rep.read()) == name.encode('utf-8')
+            assert [
+                name for name in os.listdir('node0')
+                if name not in RESERVED_DIRS
+            ] == [local]
+            assert os.path.exists(os.path.join('node1', remote))
+
+            async with client.head(urls[0] + remote,
+                                   allow_redirects=True) as rep:
+                assert rep.status == 200
+                assert rep.headers['Content-Length'] == str(len(remote))
+            async with client.get(urls[0] + remote,
+                                  allow_redirects=False) as rep:
+                if routing == 'redirect':
+                    assert rep.status == 307
+                    assert rep.headers['Location'] == urls[1] + remote
+                else:
+                    assert rep.status == 200
+
+            # Members handle forwarded requests themselves.
+            async with client.get(urls[0] + remote, headers={
+                CLUSTER_HEADER: urls[1],
+                PEER_TOKEN_HEADER: 'secret',
+            }) as rep:
+                assert rep.status == 404
+
+            # Clients can't pass for members.
+            for headers in ({CLUSTER_HEADER: urls[1]},
+                            {REPLICA_HEADER: '1'},
+                            {CLUSTER_HEADER: urls[1],
+                             PEER_TOKEN_HEADER: 'guess'}):
+                async with client.get(urls[0] + remote,
+                                      headers=headers) as rep:
+                    assert rep.status == 200
+
+            # Listings only cover the member's own files.
+            async with client.get(urls[0] + '?list') as rep:
+                assert rep.status == 200
+                assert [
+                    entry['path'] for entry in (await rep.json())['files']
+                ] == [local]
+
+            # Archives may hold files of several members.
+            async with client.post(urls[0], data=make_archive([
+                (local, b'?'),
+            ])) as rep:
+                assert rep.status == 400
+
+            async with client.delete(urls[0] + remote) as rep:
+                assert rep.status == 204
+            assert not os.path.exists(os.path.join('node1', remote))
+
+            # Members that are down.
+            name = owned_by(ring, urls[2])[0]
+            async with client.get(urls[0] + name,
+                                  allow_redirects=False) as rep:
+                if routing == 'redirect':
+                    assert rep.status == 307
+                else:
+                    assert rep.status == 502
+    finally:
+        for node in nodes:
+            await stop_peer(node)
+
+
+@pytest.mark.asyncio
+async def test_cluster_proxy_timeout(event_loop, unused_tcp_port_factory,
+                                     tempdir):
+    """Members that don't answer proxied requests in time yield a 504."""
+
+    host = '127.0.0.1'
+    ports = [unused_tcp_port_factory() for _ in range(2)]
+    urls = ['http://%s:%d/' % (host, port) for port in ports]
+    name = owned_by(HashRing(urls, 16), urls[1])[0]
+
+    async def hang(request):
+        await asyncio.sleep(5.0, loop=event_loop)
+
+    member = aiohttp.web.Application(loop=event_loop)
+    member.router.add_route('*', '/{path:.*}', hang)
+    with mock.patch('smartmob_filestore.CLUSTER_PROXY_TIMEOUT', 0.1):
+        node = await start_peer(
+            event_loop, ports[0], 'node0',
+            '--cluster-self=%s' % urls[0], '--cluster-routing=proxy',
+            '--cluster-vnodes=16', '--peer-token=secret',
+            *('--cluster-member=%s' % url for url in urls)
+        )
+        try:
+            async with HTTPServer(member, host, ports[1], loop=event_loop), \
+                    aiohttp.ClientSession(loop=event_loop) as client:
+                async with client.get(urls[0] + name) as rep:
+                    assert rep.status == 504
+        finally:
+            await stop_peer(node)
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize('args', [
+    ['--cluster-member=http://127.0.0.1:1/'],
+    ['--cluster-member=http://127.0.0.1:1/',
+     '--cluster-self=http://127.0.0.1:2/'],
+    ['--cluster-member=http://127.0.0.1:1/',
+     '--cluster-self=http://127.0.0.1:1', '--cluster-vnodes=0',
+     '--peer-token=secret'],
+    ['--cluster-member=http://127.0.0.1:1/',
+     '--cluster-self=http://127.0.0.1:1'],
+])
+async def test_cluster_options(args, event_loop):
+    with pytest.raises(ValueError):
+        await main(args, loop=event_loop)
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize('args', [
+    ['--durability=fsync', '--cache-bytes=1024'],
+    ['--backend=pack', '--cache-bytes=1024'],
+])
+async def test_request_timing(args, event_loop, unused_tcp_port, tempdir,
+                              capsys):
+    """Sampled requests log the time spent in each stage."""
+
+    host = '127.0.0.1'
+    task = await start_server(event_loop, host, unused_tcp_port,
+                              '--timing-sample-rate=1', *args)
+    try:
+        async with aiohttp.ClientSession(loop=event_loop) as client:
+            url = 'http://%s:%d/' % (host, unused_tcp_port)
+            capsys.readouterr()
+            await put(client, url + 'small.txt', b'Hello!')
+            await put(client, url + 'large.txt', b'.' * 100000)
+            for name in ('small.txt', 'large.txt'):
+                async with client.get(url + name) as rep:
+                    assert rep.status == 200
+                    await rep.read()
+            await put(client, url + 'range.txt', b'Hello!', headers={
+                'Content-Range': 'bytes 0-5/6',
+            })
+    finally:
+        await stop_server(task)
+    spans = [event['spans'] for event in read_access_log(capsys)]
+    assert len(spans) == 5
+    for span in spans:
+        assert all(duration >= 0.0 for duration in span.values())
+    upload = {'lock', 'admission', 'recv', 'write'}
+    assert set(spans[0]) >= upload
+    assert set(spans[1]) == upload | {'fsync', 'rename'}
+    assert set(spans[2]) == {'cache_lookup', 'stat', 'read', 'send'}
+    assert set(spans[3]) == {
+        'cache_lookup', 'stat', 'hash', 'open', 'read', 'send',
+    }
+    assert set(spans[4]) == upload | {'hash', 'fsync', 'rename'}
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize('rate', ['-0.1', '1.5'])
+async def test_request_timing_options(rate, event_loop):
+    with pytest.raises(ValueError):
+        await main(['--timing-sample-rate=%s' % rate], loop=event_loop)
+
+
+def busy(seconds):
+    """Keep the event loop busy."""
+    ref = default_timer()
+    while default_timer() - ref < seconds:
+        pass
+
+
+async def wait_for_files(directory, count, event_loop):
+    """Wait until a profile wrote its results."""
+    await wait_for(lambda: (
+        os.path.isdir(directory) and len(os.listdir(directory)) >= count
+    ), event_loop)
+    return sorted(
+        os.path.join(directory, name) for name in os.listdir(directory)
+    )
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize('format', ['collapsed', 'pstats'])
+async def test_profiler(format, event_loop, tempdir):
+    """Profiles show where the event loop spends its time."""
+
+    event_log = mock.MagicMock()
+    with IOExecutor(1, loop=event_loop) as executor:
+        profiler = Profiler('profiles', executor, seconds=0.3, format=format,
+                            event_log=event_log, loop=event_loop)
+        path = profiler.start()
+        assert profiler.running
+        with pytest.raises(RuntimeError):
+            profiler.start()
+        # Signals don't interrupt the profile.
+        profiler.trigger()
+        for _ in range(5):
+            busy(0.02)
+            await asyncio.sleep(0.01, loop=event_loop)
+        assert (await wait_for_files('profiles', 1, event_loop)) == [path]
+        await wait_for(lambda: not profiler.running, event_loop)
+        await profiler.close()
+
+        # Aborted profiles.
+        profiler.trigger()
+        await asyncio.sleep(0.01, loop=event_loop)
+        await profiler.close()
+        assert os.listdir('profiles') == [os.path.basename(path)]
+
+    if format == 'pstats':
+        stats = pstats.Stats(path)
+        assert any(function == 'busy' for _, _, function in stats.stats)
+    else:
+        with open(path, 'r') as stream:
+            lines = stream.read().splitlines()
+        assert any(
+            frame.startswith('busy (')
+            for line in lines for frame in line.split(';')
+        )
+        assert all(int(line.rsplit(' ', 1)[1]) > 0 for line in lines)
+    assert mock.call('profile.done', path=path) in \
+        event_log.info.call_args_list
+
+
+@pytest.mark.asyncio
+async def test_profiler_failure(event_loop, tempdir):
+    """Profiles that can't be saved are reported."""
+
+    with open('profiles', 'w'):
+        pass
+    event_log = mock.MagicMock()
+    with IOExecutor(1, loop=event_loop) as executor:
+        profiler = Profiler('profiles', executor, seconds=0.01,
+                            event_log=event_log, loop=event_loop)
+        path = profiler.start()
+        await wait_for(lambda: not profiler.running, event_loop)
+    event_log.error.assert_called_once_with(
+        'profile.failed', path=path, error=mock.ANY,
+    )
+
+
+@pytest.mark.asyncio
+async def test_profile_server(event_loop, unused_tcp_port_factory, tempdir):
+    """Live servers are profiled on demand."""
+
+    host = '127.0.0.1'
+    port, metrics_port = unused_tcp_port_factory(), unused_tcp_port_factory()
+    task = await start_server(event_loop, host, port,
+                              '--metrics-port=%d' % metrics_port,
+                              '--profile-dir=profiles',
+                              '--profile-seconds=0.1',
+                              '--profile-format=pstats')
+    try:
+        async with aiohttp.ClientSession(loop=event_loop) as client:
+            url = 'http://%s:%d/profile' % (host, metrics_port)
+            for seconds in ('?', '0', '1000'):
+                async with client.post(url, params={
+                    'seconds': seconds,
+                }) as rep:
+                    assert rep.status == 400
+            async with client.post(url, params={'seconds': '0.2'}) as rep:
+                assert rep.status == 202
+                report = await rep.json()
+            assert report['seconds'] == 0.2
+            assert report['format'] == 'pstats'
+            assert report['path'].startswith('profiles/profile-')
+            async with client.post(url) as rep:
+                assert rep.status == 409
+            assert (await wait_for_files('profiles', 1, event_loop)) == [
+                report['path'],
+            ]
+    finally:
+        await stop_server(task)
+
+
+@pytest.mark.asyncio
+async def test_profile_token(event_loop, unused_tcp_port_factory, tempdir):
+    """Profiles can require a token, and the metrics port is local."""
+
+    assert cli.parse_args([]).metrics_host == '127.0.0.1'
+    host = '127.0.0.1'
+    port, metrics_port = unused_tcp_port_factory(), unused_tcp_port_factory()
+    task = await start_server(event_loop, host, port,
+                              '--metrics-port=%d' % metrics_port,
+                              '--metrics-host=%s' % host,
+                              '--profile-dir=profiles',
+                              '--profile-seconds=0.1',
+                              '--profile-token=secret')
+    try:
+        async with aiohttp.ClientSession(loop=event_loop) as client:
+            url = 'http://%s:%d/profile' % (host, metrics_port)
+            for headers in ({}, {PROFILE_TOKEN_HEADER: 'guess'}):
+                async with client.post(url, headers=headers) as rep:
+                    assert rep.status == 403
+            async with client.post(url, headers={
+                PROFILE_TOKEN_HEADER: 'secret',
+            }) as rep:
+                assert rep.status == 202
+            await wait_for_files('profiles', 1, event_loop)
+    finally:
+        await stop_server(task)
+
+
+@pytest.mark.asyncio
+async def test_profile_signal(event_loop, unused_tcp_port, tempdir):
+    """Profiles also start on SIGUSR1."""
+
+    task = await start_server(event_loop, '127.0.0.1', unused_tcp_port,
+                              '--profile-dir=profiles',
+                              '--profile-seconds=0.1')
+    try:
+        os.kill(os.getpid(), signal.SIGUSR1)
+        path, = await wait_for_files('profiles', 1, event_loop)
+    finally:
+        await stop_server(task)
+    assert path.endswith('.folded')
+
+
+@pytest.mark.asyncio
+async def test_profile_workers(event_loop, unused_tcp_port, tempdir):
+    """Each worker process profiles itself."""
+
+    host = '127.0.0.1'
+    metrics_port = unused_tcp_ports(host, 2, exclude=[unused_tcp_port])
+    task = await start_server(event_loop, host, unused_tcp_port,
+                              '--workers=2', '--profile-dir=profiles',
+                              '--profile-seconds=0.1',
+                              '--metrics-port=%d' % metrics_port)
+    try:
+        # Wait until both workers are ready.
+        async with aiohttp.ClientSession(loop=event_loop) as client:
+            for port in (metrics_port, metrics_port + 1):
+                url = 'http://%s:%d/metrics' % (host, port)
+                ref = default_timer()
+                while True:
+                    try:
+                        async with client.get(url) as response:
+                            assert response.status == 200
+                        break
+                    except aiohttp.errors.ClientOSError:
+                        assert (default_timer() - ref) < 5.0
+                        await asyncio.sleep(0.1)
+        os.kill(os.getpid(), signal.SIGUSR1)
+        paths = await wait_for_files('profiles', 2, event_loop)
+    finally:
+        await stop_server(task, signal.SIGTERM)
+    assert len({path.split('-')[1] for path in paths}) == 2
+
+
+def test_forward_signal():
+    workers = [mock.MagicMock(returncode=None), mock.MagicMock(returncode=1)]
+    forward_signal(workers, signal.SIGUSR1)
+    workers[0].send_signal.assert_called_once_with(signal.SIGUSR1)
+    assert not workers[1].send_signal.called
+
+
+@pytest.mark.asyncio
+async def test_profile_options(event_loop):
+    with pytest.raises(ValueError):
+        await main(['--profile-seconds=0'], loop=event_loop)
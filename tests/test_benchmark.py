@@ -0,0 +1,205 @@
+# -*- coding: utf-8 -*-
+
+
+import argparse
+import json
+import os
+import pytest
+import signal
+
+from smartmob_filestore.benchmark import (
+    benchmark,
+    compare,
+    format_size,
+    parse_size,
+    payload,
+    percentile,
+    wait_for_server,
+)
+from smartmob_filestore import main
+
+
+@pytest.mark.parametrize('value,expected', [
+    ('512', 512),
+    ('1k', 1024),
+    ('64M', 64 * 1024 ** 2),
+    ('1G', 1024 ** 3),
+])
+def test_parse_size(value, expected):
+    assert parse_size(value) == expected
+    assert parse_size(format_size(expected)) == expected
+
+
+@pytest.mark.parametrize('value', ['', 'K', '1T', '-1K', '0'])
+def test_parse_size_invalid(value):
+    with pytest.raises(argparse.ArgumentTypeError):
+        parse_size(value)
+
+
+def test_percentile():
+    values = list(range(1, 1001))
+    assert percentile(values, 0.5) == 500
+    assert percentile(values, 0.99) == 990
+    assert percentile(values, 0.999) == 999
+    assert percentile([1], 0.001) == 1
+    assert percentile([], 0.5) is None
+
+
+def test_payload():
+    assert len(b''.join(payload(10))) == 10
+    assert len(b''.join(payload(200 * 1024))) == 200 * 1024
+
+
+def scenario(size, concurrency, throughput, put_p99, get_p99):
+    return {
+        'size': size,
+        'concurrency': concurrency,
+        'throughput': {'requests': throughput},
+        'latency': {'put': {'p99': put_p99}, 'get': {'p99': get_p99}},
+    }
+
+
+def test_compare():
+    baseline = {'scenarios': [
+        scenario(1024, 1, 100.0, 0.010, 0.010),
+        scenario(1024, 10, 100.0, 0.010, None),
+        scenario(2048, 1, 0.0, 0.010, 0.010),
+    ]}
+    report = {'scenarios': [
+        scenario(1024, 1, 85.0, 0.0105, 0.020),
+        scenario(1024, 10, 200.0, 0.001, 0.010),
+        scenario(2048, 1, 1.0, 0.010, 0.010),
+        scenario(4096, 1, 1.0, 1.0, 1.0),
+    ]}
+    regressions = compare(report, baseline, 0.1)
+    assert [(r['size'], r['concurrency'], r['metric'])
+            for r in regressions] == [
+        (1024, 1, 'throughput'),
+        (1024, 1, 'get.p99'),
+    ]
+    assert abs(regressions[0]['change'] + 0.15) < 1e-9
+    assert compare(report, baseline, 1.5) == []
+
+
+def read_report(capsys):
+    return json.loads(capsys.readouterr()[0])
+
+
+@pytest.mark.asyncio
+async def test_benchmark(event_loop, tempdir, capsys):
+    """Benchmarks report on each scenario and compare with a baseline."""
+
+    status = await benchmark([
+        '--sizes=1K,100K',
+        '--concurrency=1,4',
+        '--requests=20',
+        '--put-ratio=0.5',
+        '--output=baseline.json',
+        '--', '--io-threads=2',
+    ], loop=event_loop)
+    assert status == 0
+    report = read_report(capsys)
+    with open('baseline.json', 'r') as stream:
+        assert json.load(stream) == report
+
+    assert report['server'] == 'in-process'
+    assert report['server_args'] == ['--io-threads=2']
+    assert report['peak_rss'] > 0
+    assert 'regressions' not in report
+    assert [(s['size'], s['concurrency']) for s in report['scenarios']] == [
+        (1024, 1), (1024, 4), (100 * 1024, 1), (100 * 1024, 4),
+    ]
+    for result in report['scenarios']:
+        assert result['requests'] == 20
+        assert result['errors'] == 0
+        latency = result['latency']
+        assert latency['put']['count'] + latency['get']['count'] == 20
+        assert latency['put']['count'] >= result['concurrency']
+        assert latency['put']['p50'] <= latency['put']['p99']
+        assert abs(
+            result['throughput']['bytes'] -
+            result['throughput']['requests'] * result['size']
+        ) < 1e-6 * result['throughput']['bytes']
+
+    # Compare with a baseline that was impossibly fast.
+    with open('baseline.json', 'r') as stream:
+        baseline = json.load(stream)
+    for result in baseline['scenarios']:
+        result['throughput']['requests'] *= 1000.0
+        for latency in result['latency'].values():
+            latency['p99'] *= 1000.0
+    with open('baseline.json', 'w') as stream:
+        json.dump(baseline, stream)
+    status = await benchmark([
+        '--subprocess',
+        '--sizes=1K',
+        '--concurrency=4',
+        '--requests=10',
+        '--baseline=baseline.json',
+    ], loop=event_loop)
+    assert status == 1
+    report = read_report(capsys)
+    assert report['server'] == 'subprocess'
+    assert [r['metric'] for r in report['regressions']] == ['throughput']
+
+
+@pytest.mark.asyncio
+async def test_benchmark_errors(event_loop, unused_tcp_port, tempdir,
+                                capsys):
+    """Failed requests are counted as errors."""
+
+    url = 'http://127.0.0.1:%d' % unused_tcp_port
+    status = await benchmark([
+        '--url=%s' % url,
+        '--sizes=1K',
+        '--concurrency=2',
+        '--requests=4',
+    ], loop=event_loop)
+    assert status == 0
+    report = read_report(capsys)
+    assert report['server'] == 'external'
+    assert report['scenarios'][0]['errors'] == 4
+
+    # Requests that fail.
+    task = event_loop.create_task(main([
+        '--host=127.0.0.1', '--port=%d' % unused_tcp_port,
+        '--logging-endpoint=file:///dev/null',
+    ], loop=event_loop))
+    try:
+        await wait_for_server('127.0.0.1', unused_tcp_port, task, event_loop)
+        status = await benchmark([
+            '--url=%s/.staging' % url,
+            '--sizes=1K',
+            '--concurrency=2',
+            '--requests=4',
+        ], loop=event_loop)
+    finally:
+        os.kill(os.getpid(), signal.SIGINT)
+        await task
+    assert status == 0
+    report = read_report(capsys)
+    assert report['scenarios'][0]['errors'] == 4
+
+    # Servers that fail to start.
+    with pytest.raises(ValueError):
+        await benchmark([
+            '--sizes=1K', '--concurrency=1', '--requests=1',
+            '--', '--io-threads=0',
+        ], loop=event_loop)
+    with pytest.raises(RuntimeError):
+        await benchmark([
+            '--subprocess', '--sizes=1K', '--concurrency=1', '--requests=1',
+            '--', '--unknown-option',
+        ], loop=event_loop)
+
+
+@pytest.mark.asyncio
+async def test_benchmark_log_rendering(event_loop, tempdir, capsys):
+    """Log rendering is measured on its own, without a server."""
+
+    status = await benchmark(['--log-rendering=100'], loop=event_loop)
+    assert status == 0
+    report = read_report(capsys)['log_rendering']
+    assert report['standard'] > 0
+    assert report['fast'] > 0
+    assert report['speedup'] == report['standard'] / report['fast']
@@ -5,15 +5,22 @@ import os
 import pytest
 import structlog
 import testfixtures
+import time
 
 from contextlib import contextmanager
-from datetime import datetime
+from datetime import datetime, timezone
 from freezegun import freeze_time
 from itertools import chain
 from smartmob_filestore import (
+    CachedTimeStamper,
     configure_logging,
+    FastJSONRenderer,
+    FileLoggerFactory,
+    FileSink,
     FluentLoggerFactory,
+    FluentShipper,
 )
+from timeit import default_timer
 from unittest import mock
 
 
@@ -58,13 +65,14 @@ def test_configure_logging_stderr(capsys):
 
 def test_configure_logging_file(capsys, tempdir):
     with freeze_time("2016-05-08 21:19:00"):
-        configure_logging(
+        logger_factory = configure_logging(
             log_format='kv',
             utc=False,
             endpoint='file://./gitmesh.log',
         )
         log = structlog.get_logger()
         log.info('teh.event', a=1)
+    logger_factory.close()
     out, err = capsys.readouterr()
     assert out == ""
     assert err == ""
@@ -104,6 +112,65 @@ def test_log_format(log_format, expected):
         capture.compare(expected)
 
 
+def test_log_format_fast():
+    with freeze_time("2016-05-08 21:19:00"):
+        with testfixtures.OutputCapture() as capture:
+            configure_logging(
+                log_format='json',
+                utc=True,
+                endpoint='file:///dev/stderr',
+                fast=True,
+            )
+            log = structlog.get_logger()
+            log.info('teh.event', a=1, b=2)
+            log.info('teh.event', a={1})
+        capture.compare('\n'.join([
+            ('{"@timestamp": "2016-05-08T21:19:00.000000+00:00"'
+             ', "a": 1, "b": 2, "event": "teh.event"}'),
+            ('{"@timestamp": "2016-05-08T21:19:00.000000+00:00"'
+             ', "a": "{1}"'
+             ', "event": "teh.event"}'),
+        ]))
+
+
+@pytest.mark.parametrize('utc', [True, False])
+def test_cached_timestamper(utc):
+    """Cached timestamps match the ones rendered by ``datetime``."""
+
+    zone = timezone.utc if utc else None
+    stamper = CachedTimeStamper(key='@timestamp', utc=utc)
+    for timestamp in (1462742340.25, 1462742340.5, 1462742341.000001):
+        event = stamper(None, None, {'@timestamp': timestamp})
+        expected = datetime.fromtimestamp(timestamp, zone).isoformat()
+        assert event['@timestamp'] == expected
+
+    # Other timestamps are rendered as usual.
+    event = stamper(None, None, {'@timestamp': datetime(2016, 5, 8)})
+    assert event['@timestamp'] == '2016-05-08T00:00:00'
+    event = stamper(None, None, {'@timestamp': 'now'})
+    assert event['@timestamp'] == 'now'
+
+    # Microseconds are always rendered.
+    event = stamper(None, None, {'@timestamp': 1462742340.0})
+    assert event['@timestamp'][19:26] == '.000000'
+    event = stamper(None, None, {})
+    assert event['@timestamp'][19] == '.'
+
+
+def test_fast_json_renderer_ujson():
+    renderer = FastJSONRenderer()
+    with mock.patch('smartmob_filestore.ujson') as ujson:
+        ujson.dumps.return_value = '{"a":1}'
+        assert renderer(None, None, {'a': 1}) == '{"a":1}'
+        ujson.dumps.assert_called_once_with(
+            {'a': 1}, sort_keys=True, escape_forward_slashes=False,
+        )
+
+        # Values ujson can't encode fall back to the standard encoder.
+        ujson.dumps.side_effect = TypeError
+        assert renderer(None, None, {'a': 1}) == '{"a": 1}'
+
+
 @pytest.mark.parametrize('url,host,port,app', [
     ('fluent://127.0.0.1:24224/the-app', '127.0.0.1', 24224, 'the-app'),
     ('fluent://127.0.0.1/the-app', '127.0.0.1', 24224, 'the-app'),
@@ -119,7 +186,10 @@ def test_fluent_url_parser(url, host, port, app):
 @pytest.mark.parametrize('url', [
     'fluent://127.0.0.1:abcd/the-app',
     'fluentd://127.0.0.1:abcd/the-app',  # typo in scheme.
-    'fluent://127.0.0.1:24224/the-app?hello=1',  # query strings not allowed.
+    'fluent://127.0.0.1:24224/the-app?hello=1',  # unknown option.
+    'fluent://127.0.0.1:24224/the-app#hello',  # fragments not allowed.
+    'fluent://127.0.0.1:24224/the-app?queue-size=abc',
+    'fluent://127.0.0.1:24224/the-app?overflow=never',
 ])
 def test_fluent_url_parser_invalid_url(url):
     with pytest.raises(ValueError) as error:
@@ -132,7 +202,7 @@ def test_fluent_url_parser_invalid_url(url):
     ('fluent://127.0.0.1:24224/the-app', True, '2016-05-08T21:19:00+00:00'),
     ('fluent://127.0.0.1:24224/the-app', False, '2016-05-08T21:19:00'),
 ])
-@mock.patch('fluent.sender.FluentSender.emit')
+@mock.patch('smartmob_filestore.FluentShipper.emit')
 def test_logging_fluentd(emit, logging_endpoint, utc, expected_timestamp):
     with freeze_time("2016-05-08 21:19:00"):
         configure_logging(
@@ -155,7 +225,7 @@ def test_logging_fluentd(emit, logging_endpoint, utc, expected_timestamp):
     ('2016-05-08T21:19:00', '2016-05-08T21:19:00'),
     (datetime(2016, 5, 8, 21, 19, 0), '2016-05-08T21:19:00'),
 ])
-@mock.patch('fluent.sender.FluentSender.emit')
+@mock.patch('smartmob_filestore.FluentShipper.emit')
 def test_logging_fluentd_override_timestamp(emit, timestamp,
                                             expected_timestamp):
     with freeze_time("2016-05-08 21:19:00"):
@@ -173,3 +243,235 @@ def test_logging_fluentd_override_timestamp(emit, timestamp,
             'b': 2,
             '@timestamp': expected_timestamp,
         })
+
+
+def test_fluent_url_options():
+    factory = FluentLoggerFactory.from_url(
+        'fluent://127.0.0.1/the-app?queue-size=5&batch-size=2&overflow=block'
+    )
+    assert factory.app == 'the-app'
+    assert factory.shipper.dropped == 0
+    assert factory.shipper.batches == 0
+    factory.close()
+
+
+@pytest.mark.asyncio
+async def test_fluent_shipper_batches(fluent_server, wait_for_records):
+    host, port, records = fluent_server
+    shipper = FluentShipper('the-app', host, port, batch_size=2)
+    with shipper._ready:  # Hold the background thread back.
+        shipper.emit('a', {'x': 1})
+        shipper.emit('a', {'x': 2})
+        shipper.emit('b', {'x': 3})
+        shipper.emit('', {'x': 4})
+    shipper.close()
+    await wait_for_records(records, 4)
+    assert records == [
+        [b'the-app.a', mock.ANY, {b'x': 1}],
+        [b'the-app.a', mock.ANY, {b'x': 2}],
+        [b'the-app.b', mock.ANY, {b'x': 3}],
+        [b'the-app', mock.ANY, {b'x': 4}],
+    ]
+    assert shipper.batches == 2
+    assert shipper.dropped == 0
+
+
+@pytest.mark.parametrize('overflow,expected', [
+    ('drop-oldest', [2, 3]),
+    ('drop-newest', [1, 2]),
+])
+@pytest.mark.asyncio
+async def test_fluent_shipper_overflow(overflow, expected, fluent_server,
+                                       wait_for_records):
+    host, port, records = fluent_server
+    shipper = FluentShipper('the-app', host, port,
+                            queue_size=2, overflow=overflow)
+    with shipper._ready:  # Hold the background thread back.
+        shipper.emit('a', {'x': 1})
+        shipper.emit('a', {'x': 2})
+        shipper.emit('a', {'x': 3})
+        assert shipper.dropped == 1
+    shipper.close()
+    await wait_for_records(records, 2)
+    assert [record[2][b'x'] for record in records] == expected
+    assert shipper.dropped == 1
+
+
+@pytest.mark.asyncio
+async def test_fluent_shipper_overflow_block(fluent_server,
+                                             wait_for_records):
+    host, port, records = fluent_server
+    shipper = FluentShipper('the-app', host, port,
+                            queue_size=1, overflow='block')
+    with shipper._ready:
+        shipper.emit('a', {'x': 1})
+        shipper.emit('a', {'x': 2})  # Waits for the background thread.
+    shipper.close()
+    await wait_for_records(records, 2)
+    assert [record[2][b'x'] for record in records] == [1, 2]
+    assert shipper.dropped == 0
+
+
+def test_fluent_shipper_unreachable(unused_tcp_port):
+    shipper = FluentShipper('the-app', '127.0.0.1', unused_tcp_port)
+    shipper.emit('a', {'x': 1})
+    shipper.close()
+    assert shipper.batches == 0
+    assert shipper.dropped == 1
+
+    # Events logged after shutdown are dropped too.
+    shipper.emit('a', {'x': 2})
+    assert shipper.dropped == 2
+
+
+@mock.patch('socket.create_connection')
+def test_fluent_shipper_connection_lost(create_connection):
+    connection = create_connection.return_value
+    connection.sendall.side_effect = [None, BrokenPipeError()]
+    shipper = FluentShipper('the-app', '127.0.0.1', 24224, batch_size=1)
+    with shipper._ready:
+        shipper.emit('a', {'x': 1})
+        shipper.emit('a', {'x': 2})
+    shipper.close()
+    assert shipper.batches == 1
+    assert shipper.dropped == 1
+    connection.close.assert_called_once_with()
+
+
+@mock.patch('socket.create_connection')
+def test_fluent_shipper_invalid_event(create_connection):
+    connection = create_connection.return_value
+    shipper = FluentShipper('the-app', '127.0.0.1', 24224, batch_size=3)
+    with shipper._ready:
+        shipper.emit('a', {'x': 1})
+        shipper.emit('b', {'x': object()})
+        shipper.emit('c', {'x': 3})
+    shipper.emit('b', {'x': object()})
+    shipper.close()
+    assert shipper.dropped == 2
+    assert shipper.batches == 1
+    assert connection.sendall.call_count == 1
+
+
+def read_file(path):
+    with open(path, 'r') as stream:
+        return stream.read()
+
+
+@pytest.mark.parametrize('url,expected', [
+    ('file://./app.log', {'path': './app.log'}),
+    ('file:///var/log/app.log?buffer-size=0&backups=2', {
+        'path': '/var/log/app.log', 'buffer_size': 0, 'backups': 2,
+    }),
+    ('file://./app.log?flush-interval=0.5&max-bytes=1024', {
+        'path': './app.log', 'flush_interval': 0.5, 'max_bytes': 1024,
+    }),
+    ('file:///dev/stdout', {'path': None, 'buffer_size': 0}),
+    ('file:///dev/stderr?buffer-size=4096', {
+        'path': None, 'buffer_size': 4096,
+    }),
+])
+def test_file_url_options(url, expected):
+    with mock.patch('smartmob_filestore.FileSink') as sink:
+        factory = FileLoggerFactory.from_url(url)
+    assert factory.sink is sink.return_value
+    path = expected.pop('path')
+    sink.assert_called_once_with(path, **dict(expected, **(
+        {'stream': mock.ANY} if path is None else {}
+    )))
+
+
+@pytest.mark.parametrize('url', [
+    'file://./app.log?buffer-size=x',
+    'file://./app.log?buffer-size=-1',
+    'file://./app.log?unknown=1',
+    'file://./app.log#fragment',
+    'file:///dev/stdout?max-bytes=1024',
+    'fluent://127.0.0.1/app',
+])
+def test_file_url_options_invalid(url):
+    with pytest.raises(ValueError):
+        FileLoggerFactory.from_url(url)
+
+
+def test_file_sink_buffer(tempdir):
+    """Lines are written in blocks, when enough of them are pending."""
+
+    sink = FileSink('app.log', buffer_size=20, flush_interval=60.0)
+    logger = FileLoggerFactory(sink)()
+    try:
+        logger.info('0123456789')
+        assert read_file('app.log') == ''
+        logger.error('0123456789')
+        assert read_file('app.log') == '0123456789\n' * 2
+        logger.info('abc')
+        sink.flush()
+        assert read_file('app.log') == '0123456789\n' * 2 + 'abc\n'
+        sink.flush()
+    finally:
+        sink.close()
+    assert sink.dropped == 0
+
+
+def test_file_sink_interval(tempdir):
+    """Lines don't stay in the buffer for long."""
+
+    sink = FileSink('app.log', flush_interval=0.05)
+    try:
+        for line in ('a', 'b'):
+            sink.write(line)
+            ref = default_timer()
+            while line + '\n' not in read_file('app.log'):
+                assert (default_timer() - ref) < 5.0
+                time.sleep(0.01)
+    finally:
+        sink.close()
+    assert read_file('app.log') == 'a\nb\n'
+
+    # Lines logged after shutdown are dropped (and counted).
+    sink = FileSink('app.log')
+    sink.close()
+    sink.write('c')
+    assert sink.dropped == 1
+
+
+def test_file_sink_rotation(tempdir):
+    """Log files are rotated before they grow too large."""
+
+    with open('app.log', 'w') as stream:
+        stream.write('old\n')
+    sink = FileSink('app.log', buffer_size=0, max_bytes=10, backups=2)
+    try:
+        for line in ('a', 'bb', 'ccc', 'dddd', 'eeeeeeeeeeee', 'f'):
+            sink.write(line)
+    finally:
+        sink.close()
+    assert sink.rotations == 3
+    assert sorted(os.listdir('.')) == ['app.log', 'app.log.1', 'app.log.2']
+    assert read_file('app.log') == 'f\n'
+    assert read_file('app.log.1') == 'eeeeeeeeeeee\n'
+    assert read_file('app.log.2') == 'ccc\ndddd\n'
+
+    # Without backups, the log file starts over.
+    sink = FileSink('app.log', buffer_size=0, max_bytes=3, backups=0)
+    try:
+        sink.write('g')
+    finally:
+        sink.close()
+    assert sorted(os.listdir('.')) == ['app.log', 'app.log.1', 'app.log.2']
+    assert read_file('app.log') == 'g\n'
+
+
+def test_file_sink_stream():
+    """Streams owned by someone else are flushed, but not closed."""
+
+    stream = mock.MagicMock()
+    sink = FileSink(None, stream=stream, buffer_size=0)
+    sink.write('a')
+    stream.write.assert_called_once_with('a\n')
+    stream.flush.assert_called_once_with()
+    stream.write.side_effect = OSError('Disk full.')
+    sink.write('b')
+    sink.close()
+    stream.close.assert_not_called()
+    assert sink.dropped == 1
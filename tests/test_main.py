@@ -25,7 +25,7 @@ def test_version(command):
 
 @pytest.mark.asyncio
 async def test_main_logging_arg(event_loop, unused_tcp_port_factory,
-                                tempdir, fluent_server):
+                                tempdir, fluent_server, wait_for_records):
     """Logging endpoint can be specified on the command-line."""
 
     # Start the server.
@@ -62,21 +62,27 @@ async def test_main_logging_arg(event_loop, unused_tcp_port_factory,
     await task
 
     # Access should have been logged.
+    await wait_for_records(fluent_server[2], 2)
     print(fluent_server[2])
     assert fluent_server[2] == [
         [b'smartmob-filestore.http.access', mock.ANY, {
             b'@timestamp': mock.ANY,
             b'request': mock.ANY,
             b'duration': mock.ANY,
+            b'io_queue': 0,
             b'outcome': 403,
             b'path': b'/',
         }],
+        [b'smartmob-filestore.stop', mock.ANY, {
+            b'@timestamp': mock.ANY,
+        }],
     ]
 
 
 @pytest.mark.asyncio
 async def test_main_logging_env(event_loop, unused_tcp_port_factory,
-                                tempdir, fluent_server, save_env):
+                                tempdir, fluent_server, save_env,
+                                wait_for_records):
     """Logging endpoint can be specified using an environment variable."""
 
     os.environ['SMARTMOB_LOGGING_ENDPOINT'] = \
@@ -112,21 +118,30 @@ async def test_main_logging_env(event_loop, unused_tcp_port_factory,
     await task
 
     # Access should have been logged.
+    await wait_for_records(fluent_server[2], 2)
     print(fluent_server[2])
     assert fluent_server[2] == [
         [b'smartmob-filestore.http.access', mock.ANY, {
             b'@timestamp': mock.ANY,
             b'request': mock.ANY,
             b'duration': mock.ANY,
+            b'io_queue': 0,
             b'outcome': 403,
             b'path': b'/',
         }],
+        [b'smartmob-filestore.stop', mock.ANY, {
+            b'@timestamp': mock.ANY,
+        }],
     ]
 
 
+@pytest.mark.parametrize('options', [
+    [],
+    ['--fast-logging'],
+])
 @pytest.mark.asyncio
 async def test_main_logging_std(event_loop, unused_tcp_port_factory,
-                                tempdir, capsys):
+                                tempdir, capsys, options):
     """Logging endpoint defaults to standard output."""
 
     assert not os.environ.get('SMARTMOB_LOGGING_ENDPOINT')
@@ -139,7 +154,7 @@ async def test_main_logging_std(event_loop, unused_tcp_port_factory,
     task = event_loop.create_task(main([
         '--host=%s' % host,
         '--port=%d' % port,
-    ], loop=event_loop))
+    ] + options, loop=event_loop))
 
     async with aiohttp.ClientSession(loop=event_loop) as client:
         url = 'http://%s:%d' % (host, port)
@@ -172,6 +187,7 @@ async def test_main_logging_std(event_loop, unused_tcp_port_factory,
             '@timestamp': mock.ANY,
             'request': mock.ANY,
             'duration': mock.ANY,
+            'io_queue': 0,
             'outcome': 403,
             'path': '/',
         },
@@ -180,3 +196,5 @@ async def test_main_logging_std(event_loop, unused_tcp_port_factory,
             '@timestamp': mock.ANY,
         },
     ]
+    for line in out:
+        assert line['@timestamp'].endswith('+00:00')
@@ -9,9 +9,16 @@ import testfixtures
 from aiohttp import web
 from smartmob_filestore import (
     access_log_middleware,
+    Counter,
     inject_request_id,
     echo_request_id,
+    Gauge,
+    Histogram,
     HTTPServer,
+    metrics_middleware,
+    MetricsRegistry,
+    request_timer,
+    ServerMetrics,
 )
 from unittest import mock
 
@@ -62,6 +69,58 @@ async def test_access_log_success_200(event_loop, unused_tcp_port):
     )
 
 
+@pytest.mark.asyncio
+async def test_access_log_timing(event_loop, unused_tcp_port):
+    event_log = mock.MagicMock()
+    clock = mock.MagicMock()
+    clock.side_effect = [0.0, 1.0, 3.0, 4.0, 4.5, 5.0, 0.0, 1.0]
+
+    app = aiohttp.web.Application(
+        loop=event_loop,
+        middlewares=[
+            inject_request_id,
+            access_log_middleware,
+        ],
+    )
+    app['smartmob.event_log'] = event_log
+    app['smartmob.clock'] = clock
+    app['smartmob.timing_sample_rate'] = 0.5
+
+    async def index(request):
+        timer = request_timer(request)
+        with timer.span('work'):
+            pass
+        timer.record('work', timer.now())
+        return aiohttp.web.Response(body=b'...')
+
+    app.router.add_route('GET', '/', index)
+
+    # Given the server is running.
+    async with HTTPServer(app, '127.0.0.1', unused_tcp_port):
+
+        # When I access the index twice, and only the first one is sampled.
+        index_url = 'http://127.0.0.1:%d' % (unused_tcp_port,)
+        with mock.patch('random.random') as random:
+            random.side_effect = [0.2, 0.7]
+            async with aiohttp.ClientSession(loop=event_loop) as client:
+                for _ in range(2):
+                    async with client.get(index_url) as rep:
+                        assert rep.status == 200
+
+    # Then the first request details the time spent in each stage.
+    assert event_log.info.call_args_list == [
+        mock.call(
+            'http.access', path='/', outcome=200, duration=5.0,
+            request=mock.ANY, spans={'work': 2.5},
+            **{'@timestamp': mock.ANY}
+        ),
+        mock.call(
+            'http.access', path='/', outcome=200, duration=1.0,
+            request=mock.ANY, **{'@timestamp': mock.ANY}
+        ),
+    ]
+
+
 @pytest.mark.parametrize('status', [
     201,
     204,
@@ -314,3 +373,132 @@ async def test_access_log_no_signal(event_loop, unused_tcp_port):
         request=mock.ANY,  # Not echoed in response, so value doesn't matter.
         **{'@timestamp': mock.ANY}
     )
+
+
+def test_metrics_registry():
+    metrics = MetricsRegistry()
+    counter = metrics.add(Counter('c_total', "A counter.", labels=('x',)))
+    gauge = metrics.add(Gauge('g', "A gauge."))
+    histogram = metrics.add(Histogram('h', "A histogram.", [1.0, 0.5]))
+    counter.inc(labels=('a"\\\n',))
+    counter.inc(2, labels=('b',))
+    counter.inc(3, labels=('b',))
+    gauge.inc()
+    gauge.inc()
+    gauge.dec()
+    for value in (0.25, 0.5, 0.75, 2.0):
+        histogram.observe(value)
+    assert metrics.render() == '\n'.join([
+        '# HELP c_total A counter.',
+        '# TYPE c_total counter',
+        'c_total{x="a\\"\\\\\\n"} 1',
+        'c_total{x="b"} 5',
+        '# HELP g A gauge.',
+        '# TYPE g gauge',
+        'g 1',
+        '# HELP h A histogram.',
+        '# TYPE h histogram',
+        'h_bucket{le="0.5"} 2',
+        'h_bucket{le="1.0"} 3',
+        'h_bucket{le="+Inf"} 4',
+        'h_sum 3.5',
+        'h_count 4',
+    ]) + '\n'
+
+
+@pytest.mark.asyncio
+async def test_metrics_middleware(event_loop, unused_tcp_port):
+    clock = mock.MagicMock()
+    clock.side_effect = [0.0, 0.002, 0.0, 0.2, 0.0, 7.0, 0.0, 0.002]
+    metrics = ServerMetrics()
+
+    app = aiohttp.web.Application(
+        loop=event_loop,
+        middlewares=[
+            metrics_middleware,
+        ],
+    )
+    app['smartmob.clock'] = clock
+    app['smartmob.metrics'] = metrics
+
+    async def index(request):
+        assert metrics.requests_in_flight._values[()] == 1
+        return aiohttp.web.Response(body=b'...')
+
+    async def upload(request):
+        await request.read()
+        request['smartmob.upload_size'] = 5000
+        return aiohttp.web.Response(status=201)
+
+    async def fail(request):
+        raise ValueError()
+
+    app.router.add_route('GET', '/', index)
+    app.router.add_route('HEAD', '/', index)
+    app.router.add_route('PUT', '/', upload)
+    app.router.add_route('GET', '/fail', fail)
+
+    # Given the server is running.
+    async with HTTPServer(app, '127.0.0.1', unused_tcp_port):
+
+        # When I send some requests.
+        index_url = 'http://127.0.0.1:%d/' % (unused_tcp_port,)
+        async with aiohttp.ClientSession(loop=event_loop) as client:
+            async with client.get(index_url) as rep:
+                assert rep.status == 200
+                assert (await rep.read()) == b'...'
+            async with client.put(index_url, data=b'Hello!') as rep:
+                assert rep.status == 201
+            with testfixtures.LogCapture(level=logging.WARNING):
+                async with client.get(index_url + 'fail') as rep:
+                    assert rep.status == 500
+            async with client.head(index_url) as rep:
+                assert rep.status == 200
+
+    # Then they're measured.
+    assert metrics.requests_in_flight._values[()] == 0
+    samples = {
+        (name, tuple(labels)): value
+        for metric in (
+            metrics.request_duration,
+            metrics.request_bytes,
+            metrics.response_bytes,
+            metrics.upload_size,
+        )
+        for name, labels, value in metric.samples()
+    }
+    get_200 = (('method', 'GET'), ('status', '200'))
+    assert samples['http_request_duration_seconds_count', get_200] == 1
+    assert samples['http_request_duration_seconds_bucket', get_200 + (
+        ('le', '0.001'),
+    )] == 0
+    assert samples['http_request_duration_seconds_bucket', get_200 + (
+        ('le', '0.0025'),
+    )] == 1
+    get_500 = (('method', 'GET'), ('status', '500'))
+    assert samples['http_request_duration_seconds_bucket', get_500 + (
+        ('le', '5.0'),
+    )] == 0
+    assert samples['http_request_duration_seconds_sum', get_500] == 7.0
+    put_201 = (('method', 'PUT'), ('status', '201'))
+    assert samples['http_request_duration_seconds_sum', put_201] == 0.2
+    head_200 = (('method', 'HEAD'), ('status', '200'))
+    assert samples['http_request_duration_seconds_count', head_200] == 1
+    assert samples['http_request_bytes_total', (('method', 'PUT'),)] == 6
+    assert samples['http_request_bytes_total', (('method', 'GET'),)] == 0
+    assert samples['http_response_bytes_total', (('method', 'GET'),)] == 3
+    assert ('http_response_bytes_total', (('method', 'HEAD'),)) not in samples
+    assert samples['upload_size_bytes_bucket', (('le', '4096'),)] == 0
+    assert samples['upload_size_bytes_bucket', (('le', '16384'),)] == 1
+    assert samples['upload_size_bytes_sum', ()] == 5000
+
+
+@pytest.mark.asyncio
+async def test_http_server_flushes_logs(event_loop, unused_tcp_port):
+    logger_factory = mock.MagicMock()
+    app = aiohttp.web.Application(loop=event_loop)
+    app['smartmob.logger_factory'] = logger_factory
+
+    async with HTTPServer(app, '127.0.0.1', unused_tcp_port):
+        logger_factory.flush.assert_not_called()
+    logger_factory.flush.assert_called_once_with()
@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+
+
+import json
+import os
+import pytest
+
+from smartmob_filestore import (
+    DigestIndex,
+    FlatLayout,
+    prepare_storage,
+    ShardedLayout,
+)
+from smartmob_filestore.migrate import migrate
+from unittest import mock
+
+
+FILES = {
+    'a.txt': b'Hello!',
+    'dir/b.txt': b'Hello!',
+    'dir/sub/c.bin': b'World!',
+}
+
+
+def read_report(capsys):
+    return json.loads(capsys.readouterr()[0])
+
+
+def read_files(layout):
+    files = {}
+    for path in layout.walk():
+        with open(path, 'rb') as stream:
+            files[layout.key(path)] = stream.read()
+    return files
+
+
+def test_migrate(tempdir, capsys):
+    """Storage roots are converted between layouts and back."""
+
+    for name, data in FILES.items():
+        os.makedirs(os.path.dirname(name) or '.', exist_ok=True)
+        with open(name, 'wb') as stream:
+            stream.write(data)
+    os.mkdir('empty')
+    prepare_storage('.', layout=FlatLayout('.'))
+    index = DigestIndex('.')
+    try:
+        digests = {name: index.lookup(name) for name in FILES}
+    finally:
+        index.close()
+
+    assert migrate(['--layout=sharded']) == 0
+    assert read_report(capsys) == {'layout': 'sharded', 'files': 3}
+    assert sorted(os.listdir('.')) == ['.index', '.objects', '.staging']
+    assert read_files(ShardedLayout('.')) == FILES
+
+    # Files keep their identity, so digests don't need to be computed again.
+    layout = ShardedLayout('.')
+    prepare_storage('.', layout=layout)
+    index = DigestIndex('.', layout)
+    try:
+        with mock.patch('smartmob_filestore.hash_file') as hash_file:
+            for name, digest in digests.items():
+                assert index.lookup(layout.locate(name)) == digest
+        hash_file.assert_not_called()
+    finally:
+        index.close()
+
+    # Migrations are idempotent.
+    assert migrate(['--layout=sharded']) == 0
+    assert read_report(capsys) == {'layout': 'sharded', 'files': 0}
+
+    assert migrate(['--layout=flat']) == 0
+    assert read_report(capsys) == {'layout': 'flat', 'files': 3}
+    assert os.listdir('.objects') == []
+    assert read_files(FlatLayout('.')) == FILES
+
+
+def test_migrate_invalid_name(tempdir, capsys):
+    """Nothing is moved when some file can't be migrated."""
+
+    os.mkdir('dir')
+    for name in ('a.txt', 'dir/' + 'a' * 252):
+        with open(name, 'wb') as stream:
+            stream.write(b'Hello!')
+    assert migrate(['--layout=sharded']) == 1
+    report = read_report(capsys)
+    assert report['layout'] == 'sharded'
+    assert 'a' * 252 in report['error']
+    assert not os.path.exists('.objects')
+    assert sorted(read_files(FlatLayout('.'))) == ['a.txt', 'dir/' + 'a' * 252]
+
+    with pytest.raises(SystemExit):
+        migrate([])
@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+
+
+import aiohttp
+import aiohttp.web
+import asyncio
+import itertools
+import json
+import os
+import pytest
+import structlog
+
+from smartmob_filestore import (
+    cli,
+    CLUSTER_HEADER,
+    HashRing,
+    HTTPServer,
+    PEER_TOKEN_HEADER,
+    RESERVED_DIRS,
+    run_server,
+)
+from smartmob_filestore.benchmark import wait_for_server
+from smartmob_filestore.rebalance import rebalance
+
+
+def read_report(capsys):
+    return json.loads(capsys.readouterr()[0])
+
+
+def owned_by(ring, member, count=1):
+    """Names of files that belong to a cluster member."""
+    names = ('file-%d.txt' % i for i in itertools.count())
+    return list(itertools.islice(
+        (name for name in names if ring.owner(name) == member), count,
+    ))
+
+
+def read_files(storage):
+    files = {}
+    for name in os.listdir(storage):
+        if name not in RESERVED_DIRS:
+            with open(os.path.join(storage, name), 'rb') as stream:
+                files[name] = stream.read()
+    return files
+
+
+@pytest.mark.asyncio
+async def test_rebalance(event_loop, unused_tcp_port_factory, tempdir,
+                         capsys):
+    """Files are moved to their owner once a member is added."""
+
+    ports = [unused_tcp_port_factory() for _ in range(2)]
+    urls = ['http://127.0.0.1:%d/' % port for port in ports]
+    ring = HashRing(urls, 64)
+    names = ['file-%d.txt' % i for i in range(40)]
+    moved = sorted(name for name in names if ring.owner(name) == urls[1])
+    assert moved
+
+    done = asyncio.Future(loop=event_loop)
+    servers = [
+        event_loop.create_task(run_server(cli.parse_args([
+            '--host=127.0.0.1', '--port=%d' % port, '--storage=node%d' % i,
+        ]), structlog.get_logger(), done, event_loop))
+        for i, port in enumerate(ports)
+    ]
+    try:
+        for port in ports:
+            await wait_for_server('127.0.0.1', port, done, event_loop)
+        async with aiohttp.ClientSession(loop=event_loop) as client:
+            for name in names:
+                async with client.put(urls[0] + name,
+                                      data=name.encode('utf-8')) as rep:
+                    assert rep.status == 201
+            # Files uploaded to their new owner in the mean time are newer.
+            async with client.put(urls[1] + moved[0], data=b'new') as rep:
+                assert rep.status == 201
+
+        args = ['--cluster-member=%s' % url for url in urls]
+        assert await rebalance(args + ['--dry-run'], loop=event_loop) == 0
+        report = read_report(capsys)
+        assert report == {
+            'files': len(names) + 1,
+            'moved': {'%s -> %s' % (urls[0], urls[1]): len(moved)},
+            'bytes': 0,
+            'errors': [],
+        }
+        assert len(read_files('node0')) == len(names)
+
+        assert await rebalance(args, loop=event_loop) == 0
+        report = read_report(capsys)
+        assert report['moved'] == {
+            '%s -> %s' % (urls[0], urls[1]): len(moved),
+        }
+        assert report['bytes'] == sum(len(name) for name in moved[1:])
+        files = read_files('node1')
+        assert sorted(files) == moved
+        assert files[moved[0]] == b'new'
+        assert sorted(read_files('node0')) == sorted(
+            name for name in names if name not in moved
+        )
+
+        # Nothing moves once files are in place.
+        assert await rebalance(args, loop=event_loop) == 0
+        assert read_report(capsys)['moved'] == {}
+    finally:
+        done.set_result(None)
+        await asyncio.gather(*servers, loop=event_loop)
+
+
+@pytest.mark.asyncio
+async def test_rebalance_errors(event_loop, unused_tcp_port_factory, capsys):
+    """Files that can't be moved are reported."""
+
+    ports = [unused_tcp_port_factory() for _ in range(2)]
+    urls = ['http://127.0.0.1:%d/' % port for port in ports]
+    members = urls + [urls[0] + 'broken/', 'http://127.0.0.1:1/']
+    ring = HashRing(members, 64)
+    missing, forbidden, rejected, changed, copied = owned_by(
+        ring, urls[1], 5,
+    )
+    downloads = {missing: 404, forbidden: 403}
+    uploads = {rejected: 403}
+    removals = {changed: 412}
+    requests = []
+
+    async def source(request):
+        name = request.match_info['path']
+        requests.append((request.method, name))
+        if name == 'broken/':
+            return aiohttp.web.Response(status=500)
+        if not name:
+            if 'cursor' in request.GET:
+                return aiohttp.web.json_response({
+                    'files': [{'path': copied}], 'cursor': None,
+                })
+            return aiohttp.web.json_response({'files': [
+                {'path': name}
+                for name in (missing, forbidden, rejected, changed)
+            ], 'cursor': 'next'})
+        assert request.headers[CLUSTER_HEADER] == 'rebalance'
+        assert request.headers[PEER_TOKEN_HEADER] == 'secret'
+        if request.method == 'GET':
+            return aiohttp.web.Response(
+                status=downloads.get(name, 200), body=b'data',
+                headers={'ETag': '"x"'},
+            )
+        assert request.headers['If-Match'] == '"x"'
+        return aiohttp.web.Response(status=removals.get(name, 204))
+
+    async def target(request):
+        name = request.match_info['path']
+        if not name:
+            return aiohttp.web.json_response({'files': [], 'cursor': None})
+        assert request.headers['If-None-Match'] == '*'
+        assert (await request.read()) == b'data'
+        return aiohttp.web.Response(status=uploads.get(name, 201))
+
+    apps = []
+    for handler in (source, target):
+        app = aiohttp.web.Application(loop=event_loop)
+        app.router.add_route('*', '/{path:.*}', handler)
+        apps.append(app)
+    async with HTTPServer(apps[0], '127.0.0.1', ports[0], loop=event_loop), \
+            HTTPServer(apps[1], '127.0.0.1', ports[1], loop=event_loop):
+        status = await rebalance([
+            '--cluster-member=%s' % member for member in members
+        ] + ['--peer-token=secret'], loop=event_loop)
+    assert status == 1
+    report = read_report(capsys)
+    assert report['files'] == 5
+    assert report['moved'] == {'%s -> %s' % (urls[0], urls[1]): 2}
+    assert report['bytes'] == 4
+    assert [
+        (error['member'], error.get('path')) for error in report['errors']
+    ] == [
+        (urls[0], forbidden),
+        (urls[0], rejected),
+        (urls[0], changed),
+        (members[2], None),
+        (members[3], None),
+    ]
+    assert ('DELETE', missing) not in requests
+    assert ('DELETE', copied) in requests